@@ -0,0 +1,104 @@
+"""Measure server CPU per broadcast message as the room grows.
+
+Each room is N in-process clients connected over socketpairs, so the
+numbers include the real send path (queueing, coalescing, sendmsg) but no
+network. Only the server loop's own CPU time is counted; draining the
+receiving ends is done outside the timed section.
+
+    python bench_broadcast.py --sizes 1 10 100 1000 --messages 2000
+
+The "naive" column replays the old path for comparison: encode the text
+again for every recipient and issue one write per recipient per message.
+"""
+import argparse
+import asyncio
+import socket
+import time
+
+import chat_protocol as proto
+from chat_server import ChatServer, ClientSession
+
+BATCH = 50
+
+
+async def build_room(server, size):
+    loop = asyncio.get_running_loop()
+    server.loop = loop
+    server.running = True
+    peers = []
+    sessions = []
+    for cid in range(size):
+        ours, theirs = socket.socketpair()
+        theirs.setblocking(False)
+        _, session = await loop.connect_accepted_socket(
+            lambda cid=cid: ClientSession(server, cid, server.max_queue), ours)
+        peers.append(theirs)
+        sessions.append(session)
+    # Announce now so no join notice fires in the middle of a measurement.
+    for session in sessions:
+        server._join(session)
+    await asyncio.sleep(0)
+    return peers
+
+
+def drain(peers):
+    for peer in peers:
+        try:
+            while peer.recv(1 << 20):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def naive_broadcast(server, text):
+    with server.lock:
+        sessions = list(server.clients.values())
+    for session in sessions:
+        session.transport.write(f"MSG::{text}\n".encode())
+
+
+async def measure(size, messages, naive):
+    # Fan-out only: no history database
+    server = ChatServer(max_queue=10 ** 6, history_path="")
+    peers = await build_room(server, size)
+    drain(peers)
+    text = "benchmark message " + "x" * 60
+    cpu = 0.0
+    sent = 0
+    while sent < messages:
+        t0 = time.thread_time()
+        for _ in range(BATCH):
+            if naive:
+                naive_broadcast(server, text)
+            else:
+                server.broadcast(proto.MSG, text)
+        # let the writer tasks flush what was queued
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        cpu += time.thread_time() - t0
+        sent += BATCH
+        drain(peers)
+    for session in list(server.clients.values()):
+        session.close(abort=True)
+    for peer in peers:
+        peer.close()
+    await asyncio.sleep(0)
+    return cpu / messages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 500, 1000])
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    print(f"{'clients':>8} {'us/msg':>10} {'us/recipient':>13} {'naive us/msg':>13} {'naive us/rcpt':>14}")
+    for size in args.sizes:
+        fast = asyncio.run(measure(size, args.messages, naive=False))
+        slow = asyncio.run(measure(size, args.messages, naive=True))
+        print(f"{size:>8} {fast * 1e6:>10.1f} {fast * 1e6 / size:>13.2f} "
+              f"{slow * 1e6:>13.1f} {slow * 1e6 / size:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
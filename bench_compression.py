@@ -0,0 +1,162 @@
+"""Measure the bandwidth chat compression saves and the CPU it costs.
+
+A room of N in-process clients on socketpairs (as in bench_broadcast)
+replays a typical chat: named users, short lines that reuse the same words,
+and now and then a join or leave notice. Three modes are compared:
+
+* off -- plain v2 frames
+* shared -- COMPRESS negotiated; each message is compressed once into the
+  room's shared stream
+* private -- COMPRESS negotiated, but every member on its own stream (the
+  cost of per-connection compression without the shared stream)
+
+"bytes/rcpt" is what one client receives per message on the wire. The
+server column is the loop's CPU per message; the client column is the CPU
+one client spends inflating it.
+
+    python bench_compression.py --sizes 10 100 500 --messages 2000
+"""
+import argparse
+import asyncio
+import random
+import socket
+import time
+
+import chat_protocol as proto
+from bench_broadcast import BATCH
+from chat_compress import DEFLATE_NAME, Inflater
+from chat_server import ChatServer, ClientSession
+
+WORDS = ("the", "a", "is", "it", "we", "you", "I", "to", "on", "in", "for", "and", "ok", "yes",
+         "no", "thanks", "meeting", "deploy", "build", "server", "branch", "today", "tomorrow",
+         "report", "link", "file", "check", "please", "done", "lunch", "call", "review", "fixed",
+         "ticket", "customer", "order", "price", "update", "lol", "sure", "can", "will", "now")
+
+
+class PrivateStreamsServer(ChatServer):
+    """Compression without the shared room stream: every member on its own."""
+
+    def _pack_shared(self, room, frame, sessions):
+        for session in sessions:
+            session.shared_synced = False
+        return None, None
+
+
+def chat_script(names, messages, seed=1):
+    """(sender index, text) for a chat line, or (None, notice) for a server notice."""
+    rng = random.Random(seed)
+    script = []
+    for i in range(messages):
+        if i % 25 == 24:
+            verb = rng.choice(("joined the chat.", "left the chat."))
+            script.append((None, f"Server: {rng.choice(names)} {verb}"))
+        else:
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 14)))
+            script.append((rng.randrange(len(names)), text))
+    return script
+
+
+class Peer:
+    """Client end of a socketpair: counts bytes and inflates what it receives."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = proto.FrameReader()
+        self.reader.version = 2
+        self.inflater = Inflater()
+        self.received = 0
+
+    def drain(self):
+        try:
+            while True:
+                n = self.sock.recv_into(self.reader.writable())
+                if not n:
+                    return
+                self.received += n
+                self.reader.commit(n)
+                for kind, payload in self.reader.events():
+                    if kind == proto.DEFLATE:
+                        self.inflater.unpack(payload)
+        except BlockingIOError:
+            pass
+
+
+async def measure(size, messages, mode):
+    server_class = PrivateStreamsServer if mode == "private" else ChatServer
+    # Fan-out only: no history database
+    server = server_class(max_queue=10 ** 6, history_path="")
+    loop = asyncio.get_running_loop()
+    server.loop = loop
+    server.running = True
+    socks = []
+    sessions = []
+    names = [f"user{i:04d}" for i in range(size)]
+    for cid, name in enumerate(names):
+        ours, theirs = socket.socketpair()
+        theirs.setblocking(False)
+        _, session = await loop.connect_accepted_socket(
+            lambda cid=cid: ClientSession(server, cid, server.max_queue), ours)
+        # As if the client had sent HELLO::2, COMPRESS and NAME
+        session.reader.version = 2
+        if mode != "off":
+            server._negotiate_compression(session, DEFLATE_NAME)
+        server._register_name(session, name)
+        socks.append(theirs)
+        sessions.append(session)
+    # Announce now so no join notice fires in the middle of a measurement.
+    for session in sessions:
+        server._join(session)
+    await asyncio.sleep(0)
+    peers = [Peer(sock) for sock in socks]
+    for peer in peers:
+        peer.drain()
+        peer.received = 0
+
+    room = sessions[0].room
+    cpu = 0.0
+    inflate = 0.0
+    script = chat_script(names, messages)
+    for start in range(0, messages, BATCH):
+        t0 = time.thread_time()
+        for sender, text in script[start:start + BATCH]:
+            if sender is None:
+                server.broadcast(proto.NOTIFY, text, room=room)
+            else:
+                server._relay_message(sessions[sender], text)
+        # let the writer tasks flush what was queued
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        cpu += time.thread_time() - t0
+        t0 = time.thread_time()
+        peers[0].drain()
+        inflate += time.thread_time() - t0
+        for peer in peers[1:]:
+            peer.drain()
+    for session in list(server.clients.values()):
+        session.close(abort=True)
+    for sock in socks:
+        sock.close()
+    await asyncio.sleep(0)
+    received = sum(peer.received for peer in peers)
+    return cpu / messages, received / size / messages, inflate / messages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    print(f"{'clients':>8} {'mode':>8} {'bytes/rcpt':>11} {'saved':>7} {'server us/msg':>14} "
+          f"{'client us/msg':>14}")
+    for size in args.sizes:
+        plain = None
+        for mode in ("off", "shared", "private"):
+            cpu, wire, inflate = asyncio.run(measure(size, args.messages, mode))
+            plain = plain or wire
+            print(f"{size:>8} {mode:>8} {wire:>11.1f} {1 - wire / plain:>7.0%} {cpu * 1e6:>14.1f} "
+                  f"{inflate * 1e6:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,504 @@
+"""Multi-process serving: N workers share one port with SO_REUSEPORT.
+
+Each worker is a whole ChatServer in its own process, with its own event
+loop and its own share of the connections. The kernel spreads new
+connections over the workers, so parsing and fan-out run on as many cores
+as there are workers. What the workers have to agree on goes over a local
+bus: one Unix socket from every worker to the hub in the supervisor process.
+
+* Broadcasts. A worker does not deliver a broadcast itself. It PUBLISHes it,
+  and the hub numbers it, stores it in history and sends it to every worker,
+  the sender's included, as DELIVER. Every worker therefore sees the same
+  stream in the same order, and each one fans it out to its own clients.
+  A hop through the hub costs tens of microseconds. The hub passes frames
+  on in batches, so it is not what limits throughput.
+* Presence. Workers report the member count of each room they have (ROOM)
+  and the user names their clients ask for and give up (CLAIM / RELEASE).
+  The hub passes room counts on to every worker for ROOMS and JOIN answers.
+  It is the one judge of names: it answers every CLAIM with GRANT, or with
+  REVOKE if another worker's client holds the name. A worker uses a name
+  only once it is granted.
+* Direct messages to a user on another worker go through the hub (DM). A
+  name nobody holds comes back as NOUSER.
+* Files. Uploads land in the shared blob store of the upload directory.
+  The worker that received one moves the content in and asks the hub for a
+  name (STORE). The hub alone names files and writes ``index.json``: it
+  answers with the name it gave (STORED, "photo (1).jpg" if another file
+  already had "photo.jpg") and tells the other workers (FILE) so that every
+  worker can serve it.
+* Data connections. The kernel may put a client's data connection on a
+  different worker from its chat connection. The worker that gets the
+  connection then passes the socket itself (SCM_RIGHTS) to the worker named
+  in the ATTACH token, over that worker's handoff socket.
+
+Bus frames use the v2 framing of chat_protocol with the kinds below;
+fields are separated by ``::`` and text always comes last.
+
+Needs SO_REUSEPORT and Unix sockets (Linux; BSD and macOS do not balance
+connections over the workers).
+"""
+import array
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+import chat_protocol as proto
+from chat_uploads import INDEX_FLUSH_DELAY, BlobStore
+
+# worker -> hub
+HELLO = 1        # <worker>
+PUBLISH = 2      # <exclude session id>::<kind>::<room>::<text>
+ROOM = 3         # <room>::<members here>            hub -> worker: <room>::<worker>::<members>
+CLAIM = 4        # <session id>::<user>
+RELEASE = 5      # <session id>::<user>
+DM = 6           # <session id>::<sender>::<user>::<text>   passed on unchanged to the user's worker
+STORE = 7        # <ticket>::<sha256>::<size>::<mimetype>::<name>
+# hub -> worker
+DELIVER = 8      # <seq>::<time>::<origin worker>::<exclude session id>::<kind>::<room>::<text>
+REVOKE = 9       # <session id>::<user>
+NOUSER = 10      # <session id>::<user>
+GONE = 11        # <worker>
+GRANT = 12       # <session id>::<user>
+FILE = 13        # <sha256>::<size>::<mimetype>::<name>     stored by another worker
+STORED = 14      # <ticket>::<sha256>::<size>::<mimetype>::<name>   the name the file got
+
+# Log levels of ChatServer.log() (see chat_server.LoggingObserver), for the hub.
+LEVELS = {"warning": logging.WARNING, "error": logging.ERROR}
+
+HUB_SOCKET = "hub.sock"
+# Most bytes a handed-off data connection may bring along (its ATTACH and
+# whatever the client sent right behind it).
+HANDOFF_MAX = 64 * 1024
+# How often the supervisor checks that its workers are alive.
+WATCH_INTERVAL = 0.5
+
+log = logging.getLogger("chat_cluster")
+
+
+def handoff_path(runtime_dir, worker):
+    return os.path.join(runtime_dir, f"worker-{worker}.sock")
+
+
+class BusConnection(asyncio.BufferedProtocol):
+    """One end of a bus link. Frames sent in one loop iteration go out in one write."""
+
+    def __init__(self, on_frame, on_lost):
+        self.reader = proto.FrameReader(version=2)
+        self.on_frame = on_frame
+        self.on_lost = on_lost
+        self.transport = None
+        self.worker = None
+        self.out = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.reader.writable()
+
+    def buffer_updated(self, nbytes):
+        self.reader.commit(nbytes)
+        for kind, payload in self.reader.events():
+            self.on_frame(self, kind, bytes(payload))
+
+    def connection_lost(self, exc):
+        self.on_lost(self)
+
+    def send(self, kind, payload):
+        if not self.out:
+            asyncio.get_running_loop().call_soon(self._flush)
+        self.out.append(proto.encode_v2(kind, payload))
+
+    def _flush(self):
+        out, self.out = self.out, []
+        if not self.transport.is_closing():
+            self.transport.writelines(out)
+
+
+class ClusterHub:
+    """The supervisor's end of the bus: orders broadcasts, tracks presence."""
+
+    def __init__(self, path, history=None, federation=None, upload_dir=None):
+        self.path = path
+        self.history = history
+        # The one writer of the shared blob index, and the judge of file
+        # names like it is of user names; None leaves names as they come.
+        self.blobs = None
+        if upload_dir is not None:
+            self.blobs = BlobStore(upload_dir, on_change=self._blobs_changed)
+            self.disk = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="chat-hub-index")
+        # The pending index write: a timer handle, then its future.
+        self._index_flush = None
+        self.closed = False
+        # Other servers' broadcasts come in here and ours go out from here
+        # (chat_federation.Federation), so every worker gets both in one order.
+        self.federation = federation
+        # worker -> BusConnection
+        self.links = {}
+        # user -> (worker, session id)
+        self.names = {}
+        # worker -> {room: members}
+        self.rooms = {}
+        self.server = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_unix_server(lambda: BusConnection(self._frame, self._lost), self.path)
+
+    def close(self):
+        self.closed = True
+        if self.server:
+            self.server.close()
+        for link in list(self.links.values()):
+            link.transport.close()
+        if self.blobs is not None:
+            if isinstance(self._index_flush, asyncio.TimerHandle):
+                self._index_flush.cancel()
+            self.disk.shutdown(wait=True)
+            try:
+                self.blobs.flush()
+            except OSError as e:
+                log.error("Cannot save the blob index: %s", e)
+
+    def log(self, text, level="info"):
+        log.log(LEVELS.get(level, logging.INFO), text)
+
+    def _others(self, link):
+        return [other for other in self.links.values() if other is not link]
+
+    def _frame(self, link, kind, payload):
+        if kind == PUBLISH:
+            self._publish(link, payload)
+        elif kind == ROOM:
+            room, _, count = payload.partition(b"::")
+            members = self.rooms.setdefault(link.worker, {})
+            if int(count):
+                members[room] = int(count)
+            else:
+                members.pop(room, None)
+            for other in self._others(link):
+                other.send(ROOM, b"%s::%d::%s" % (room, link.worker, count))
+        elif kind == CLAIM:
+            sid, _, name = payload.partition(b"::")
+            holder = self.names.get(name)
+            if holder is not None and holder != (link.worker, sid) and holder[0] in self.links:
+                link.send(REVOKE, payload)
+            else:
+                self.names[name] = (link.worker, sid)
+                link.send(GRANT, payload)
+        elif kind == RELEASE:
+            sid, _, name = payload.partition(b"::")
+            if self.names.get(name) == (link.worker, sid):
+                del self.names[name]
+        elif kind == DM:
+            sid, _, rest = payload.partition(b"::")
+            name = rest.split(b"::", 2)[1]
+            holder = self.names.get(name)
+            if holder is None or holder[0] not in self.links:
+                link.send(NOUSER, b"%s::%s" % (sid, name))
+            else:
+                self.links[holder[0]].send(DM, payload)
+        elif kind == STORE:
+            ticket, _, stored = payload.partition(b"::")
+            stored = self._store(stored)
+            link.send(STORED, b"%s::%s" % (ticket, stored))
+            for other in self._others(link):
+                other.send(FILE, stored)
+        elif kind == HELLO:
+            link.worker = int(payload)
+            self.links[link.worker] = link
+            log.info("Worker %d joined the bus", link.worker)
+            # What the others have, so its room counts start out right.
+            for worker, members in self.rooms.items():
+                for room, count in members.items():
+                    link.send(ROOM, b"%s::%d::%d" % (room, worker, count))
+
+    def _store(self, payload):
+        digest, size, mimetype, name = str(payload, "utf-8").split("::", 3)
+        if self.blobs is not None:
+            self.blobs.put(digest, int(size), mimetype)
+            name = self.blobs.assign(name, digest)
+        return f"{digest}::{size}::{mimetype}::{name}".encode()
+
+    def _blobs_changed(self):
+        # Batched and off the loop, like ChatServer._blobs_changed.
+        if self._index_flush is None and not self.closed:
+            self._index_flush = asyncio.get_running_loop().call_later(INDEX_FLUSH_DELAY, self._flush_index)
+
+    def _flush_index(self):
+        future = asyncio.get_running_loop().run_in_executor(self.disk, self.blobs.write_index,
+                                                            self.blobs.snapshot())
+        self._index_flush = future
+        future.add_done_callback(self._index_written)
+
+    def _index_written(self, future):
+        self._index_flush = None
+        try:
+            future.result()
+        except (OSError, asyncio.CancelledError) as e:
+            log.error("Cannot save the blob index: %s", e)
+            self.blobs.dirty = True
+        if self.blobs.dirty:
+            self._blobs_changed()
+
+    def _publish(self, link, payload):
+        _, kind, room, text = payload.split(b"::", 3)
+        self._deliver(link.worker, payload, int(kind), room, text)
+        if self.federation:
+            self.federation.relay(int(kind), str(text, "utf-8", "replace"), str(room, "utf-8"))
+
+    def _deliver_federated(self, kind, text, room_name):
+        """A broadcast relayed from another server: to every worker, as if published."""
+        room, text = room_name.encode(), text.encode()
+        self._deliver(-1, b"0::%d::%s::%s" % (kind, room, text), kind, room, text)
+
+    def _deliver(self, origin, payload, kind, room, text):
+        seq, now = 0, time.time()
+        if self.history is not None and kind == proto.MSG:
+            seq = self.history.append(str(text, "utf-8", "replace"), str(room, "utf-8"), now)
+        frame = b"%d::%r::%d::%s" % (seq, now, origin, payload)
+        for other in self.links.values():
+            other.send(DELIVER, frame)
+
+    def _lost(self, link):
+        worker = link.worker
+        if worker is None or self.links.get(worker) is not link:
+            return
+        del self.links[worker]
+        self.rooms.pop(worker, None)
+        for name, holder in list(self.names.items()):
+            if holder[0] == worker:
+                del self.names[name]
+        for other in self.links.values():
+            other.send(GONE, b"%d" % worker)
+        log.warning("Worker %d left the bus", worker)
+
+
+class ClusterLink:
+    """A worker's end of the bus; see ChatServer(cluster=...)."""
+
+    def __init__(self, worker, runtime_dir):
+        self.worker = worker
+        self.dir = runtime_dir
+        self.server = None
+        self.conn = None
+        self.handoff = None
+        # room -> {worker: members} for the other workers
+        self.remote_rooms = {}
+        # STORE ticket -> what to call with the name the hub gives the file
+        self.stores = {}
+        self._tickets = itertools.count(1)
+
+    async def connect(self, server):
+        self.server = server
+        loop = asyncio.get_running_loop()
+        _, self.conn = await loop.create_unix_connection(
+            lambda: BusConnection(self._frame, self._lost), os.path.join(self.dir, HUB_SOCKET))
+        self.conn.send(HELLO, b"%d" % self.worker)
+        self.handoff = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.handoff.bind(handoff_path(self.dir, self.worker))
+        self.handoff.setblocking(False)
+        loop.add_reader(self.handoff.fileno(), self._receive_handoffs)
+
+    def close(self):
+        if self.handoff is not None:
+            asyncio.get_running_loop().remove_reader(self.handoff.fileno())
+            self.handoff.close()
+            self.handoff = None
+        if self.conn is not None:
+            self.conn.transport.close()
+
+    # ---- to the hub
+
+    def publish(self, kind, text, exclude=None, room=None):
+        self.conn.send(PUBLISH, f"{exclude.id if exclude else 0}::{kind}::{room.name if room else ''}::"
+                                f"{text}".encode())
+
+    def room_changed(self, room):
+        self.conn.send(ROOM, f"{room.name}::{len(room.members)}".encode())
+
+    def claim(self, session, name):
+        self.conn.send(CLAIM, f"{session.id}::{name}".encode())
+
+    def release(self, session, name):
+        self.conn.send(RELEASE, f"{session.id}::{name}".encode())
+
+    def direct(self, session, name, text):
+        self.conn.send(DM, f"{session.id}::{session.name}::{name}::{text}".encode())
+
+    def store(self, name, digest, size, mimetype, then):
+        """Ask the hub for a name for blob ``digest``; ``then(name)`` once it answers."""
+        ticket = next(self._tickets)
+        self.stores[ticket] = then
+        self.conn.send(STORE, f"{ticket}::{digest}::{size}::{mimetype}::{name}".encode())
+
+    # ---- rooms on the other workers
+
+    def members(self, room):
+        return sum(self.remote_rooms.get(room, {}).values())
+
+    def room_names(self):
+        return list(self.remote_rooms)
+
+    # ---- data connections
+
+    def token(self, token):
+        """A data token that names this worker."""
+        return f"{self.worker}.{token}"
+
+    def token_worker(self, token):
+        worker, sep, _ = token.partition(".")
+        return int(worker) if sep and worker.isdigit() else None
+
+    def hand_off(self, session, token, worker):
+        """Pass a data connection to ``worker``; False if it has to stay here."""
+        reader = session.reader
+        data = proto.encode_v2(proto.ATTACH, token.encode()) + bytes(reader.view[reader.start:reader.end])
+        if session.version != 2 or len(data) > HANDOFF_MAX:
+            return False
+        # Our HELLO answer has to reach the client before the other worker talks.
+        session.flush()
+        if session.closed or session.transport.get_write_buffer_size():
+            return False
+        sock = session.transport.get_extra_info("socket")
+        fds = array.array("i", [sock.fileno()])
+        try:
+            self.handoff.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)], 0,
+                                 handoff_path(self.dir, worker))
+        except OSError:
+            return False
+        # The other worker holds the connection now; closing ours leaves it open.
+        reader.start = reader.end
+        session.close(abort=True)
+        self.server.log(f"📎 Passed the data connection from {session.addr} to worker {worker}", "system")
+        return True
+
+    def _receive_handoffs(self):
+        fd_size = array.array("i").itemsize
+        while True:
+            try:
+                data, ancdata, _, _ = self.handoff.recvmsg(HANDOFF_MAX, socket.CMSG_SPACE(fd_size))
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            fds = array.array("i")
+            for level, kind, cdata in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds.frombytes(cdata[:len(cdata) - len(cdata) % fd_size])
+            if not fds:
+                continue
+            for extra in fds[1:]:
+                os.close(extra)
+            asyncio.ensure_future(self.server._adopt_connection(socket.socket(fileno=fds[0]), data))
+
+    # ---- from the hub
+
+    def _frame(self, conn, kind, payload):
+        server = self.server
+        if kind == DELIVER:
+            seq, when, origin, exclude, chat_kind, room, text = payload.split(b"::", 6)
+            server._deliver_published(int(seq), float(when), int(origin) == self.worker, int(exclude),
+                                      int(chat_kind), str(room, "utf-8"), str(text, "utf-8", "replace"))
+        elif kind == ROOM:
+            room, worker, count = str(payload, "utf-8").split("::")
+            counts = self.remote_rooms.setdefault(room, {})
+            if int(count):
+                counts[int(worker)] = int(count)
+            else:
+                counts.pop(int(worker), None)
+                if not counts:
+                    del self.remote_rooms[room]
+        elif kind == GONE:
+            worker = int(payload)
+            for room, counts in list(self.remote_rooms.items()):
+                counts.pop(worker, None)
+                if not counts:
+                    del self.remote_rooms[room]
+        elif kind in (GRANT, REVOKE):
+            sid, _, name = str(payload, "utf-8").partition("::")
+            server._name_answered(int(sid), name, kind == GRANT)
+        elif kind == DM:
+            _, sender, name, text = str(payload, "utf-8", "replace").split("::", 3)
+            server._direct_from_peer(sender, name, text)
+        elif kind == NOUSER:
+            sid, _, name = str(payload, "utf-8").partition("::")
+            server._direct_missed(int(sid), name)
+        elif kind in (FILE, STORED):
+            ticket = None
+            if kind == STORED:
+                ticket, _, payload = payload.partition(b"::")
+            digest, size, mimetype, name = str(payload, "utf-8").split("::", 3)
+            server.blobs.adopt(name, digest, int(size), mimetype)
+            if ticket is not None:
+                self.stores.pop(int(ticket))(name)
+
+    def _lost(self, conn):
+        if self.server.running:
+            self.server.log("⚠️ Lost the cluster bus; stopping this worker", "error")
+            self.server.stop()
+
+
+def run_cluster(workers, target, options, history=None, federation=None, upload_dir=None):
+    """Supervisor: start ``target(worker, runtime_dir, options)`` in ``workers`` processes.
+
+    Runs the hub until SIGTERM/SIGINT or until a worker exits, then stops
+    every worker. ``history`` (a ChatHistory) and the blob index of
+    ``upload_dir`` are written here, once, for all of them, and
+    ``federation`` links the cluster to other servers.
+    """
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(socket, "AF_UNIX"):
+        raise OSError("multiple workers need SO_REUSEPORT and Unix sockets")
+    runtime_dir = tempfile.mkdtemp(prefix="chat-cluster-")
+    hub = ClusterHub(os.path.join(runtime_dir, HUB_SOCKET), history, federation, upload_dir)
+    context = multiprocessing.get_context("spawn")
+    processes = []
+
+    async def supervise():
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stopping.set)
+        await hub.start()
+        if federation:
+            await federation.start(hub)
+        for worker in range(workers):
+            process = context.Process(target=target, args=(worker, runtime_dir, options),
+                                      name=f"chat-worker-{worker}", daemon=True)
+            process.start()
+            processes.append(process)
+        log.info("Started %d workers", workers)
+        while not stopping.is_set():
+            try:
+                await asyncio.wait_for(stopping.wait(), WATCH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            dead = [p for p in processes if p.exitcode is not None]
+            if dead:
+                log.error("%s exited with code %s; stopping the cluster", dead[0].name, dead[0].exitcode)
+                break
+        for process in processes:
+            if process.exitcode is None:
+                process.terminate()
+        for process in processes:
+            await loop.run_in_executor(None, process.join, 5)
+            if process.exitcode is None:
+                process.kill()
+        if federation:
+            federation.close()
+        hub.close()
+
+    try:
+        asyncio.run(supervise())
+    finally:
+        if history is not None:
+            history.close()
+        shutil.rmtree(runtime_dir, ignore_errors=True)
@@ -0,0 +1,183 @@
+"""Streaming deflate for chat frames, negotiated per connection (v2 only).
+
+After HELLO a client sends ``COMPRESS deflate``; a server that agrees
+answers ``COMPRESS deflate``, one that does not answers ``COMPRESS`` with
+an empty payload. From then on either side may send DEFLATE frames:
+
+    DEFLATE <flags byte><deflate data>
+
+The data inflates to one or more complete v2 frames. Each side keeps one
+compressor per context and every DEFLATE frame ends with a sync flush, so
+a context remembers all earlier messages sent in it. That is what makes
+short, repetitive chat lines small. As in WebSocket permessage-deflate, the
+four bytes every sync flush ends with are left off and put back by the
+receiver. The flags byte says which context:
+
+* PRIVATE -- this connection's own stream (both directions)
+* SHARED -- the stream of the receiver's room (server -> client only). A
+  broadcast is compressed once into it and the same bytes go to every
+  member that is in step with it.
+* RESET -- start the context afresh before inflating this frame. Sent
+  when a receiver joins a room, and after a frame of the context was
+  dropped for a slow consumer.
+* ECHO -- the receiver's own chat line, sent only to keep its copy of the
+  shared stream in step: inflate it, do not show it.
+
+Windows are kept small (WBITS) because every connection may hold two
+contexts and a room one more.
+
+File uploads are compressed separately, one CHUNK at a time (see
+``pack_chunk``), and only for files that look compressible: not media or
+archive types, and a sample of the file that is not already close to random
+(``file_compressible``).
+"""
+import collections
+import math
+import zlib
+
+from chat_protocol import HEADER, ProtocolError
+
+DEFLATE_NAME = "deflate"
+
+PRIVATE = 0x00
+SHARED = 0x01
+CONTEXT_MASK = 0x0F
+ECHO = 0x40
+RESET = 0x80
+
+# 4 KiB window and a small hash table: about 40 KB per compressor instead
+# of zlib's default ~260 KB, at little cost for chat-sized messages.
+WBITS = -12
+MEM_LEVEL = 5
+LEVEL = 6
+# Most bytes one DEFLATE frame may inflate to.
+MAX_INFLATED = 1024 * 1024
+# How every Z_SYNC_FLUSH block ends; not sent.
+FLUSH_TAIL = b"\x00\x00\xff\xff"
+
+# Uploads: one raw deflate stream per chunk with the full window, at level 1
+# because on a LAN the link outruns level 6 on one core.
+FILE_WBITS = -15
+FILE_LEVEL = 1
+# Bytes read from each of the start, middle and end of a file to judge it.
+SAMPLE = 16 * 1024
+# Bits per byte above which a sample is taken as already compressed. Text
+# is around 4-5, base64 6, deflate, JPEG or MP4 data close to 8.
+MAX_ENTROPY = 7.5
+# Types that are compressed already: sent as they are without a look.
+PACKED_TYPES = frozenset((
+    "application/zip", "application/gzip", "application/x-gzip", "application/x-bzip2",
+    "application/x-xz", "application/x-7z-compressed", "application/x-rar-compressed",
+    "application/vnd.rar", "application/zstd", "application/java-archive",
+    "application/x-compress", "application/epub+zip",
+))
+MEDIA = frozenset(("image", "audio", "video"))
+# Media types stored without compression, which deflate shrinks well.
+PLAIN_MEDIA = frozenset(("image/bmp", "image/x-ms-bmp", "image/svg+xml", "image/tiff",
+                         "image/x-portable-pixmap", "audio/wav", "audio/x-wav"))
+
+
+class DeflateStream:
+    """One compressing context; ``pack()`` adds frames to it."""
+
+    __slots__ = ("context", "compressor", "reset_pending")
+
+    def __init__(self, context=PRIVATE):
+        self.context = context
+        self.compressor = None
+        # The receiver must start over before the next frame of this context.
+        self.reset_pending = True
+
+    def reset(self):
+        self.reset_pending = True
+
+    def pack(self, frames):
+        """Compress encoded v2 ``frames``; returns ``(flags, data)``."""
+        flags = self.context
+        if self.reset_pending:
+            self.compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, WBITS, MEM_LEVEL)
+            self.reset_pending = False
+            flags |= RESET
+        data = self.compressor.compress(frames) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return flags, data[:-len(FLUSH_TAIL)]
+
+
+class Inflater:
+    """Receiving side: one decompressor per context."""
+
+    __slots__ = ("contexts",)
+
+    def __init__(self):
+        self.contexts = {}
+
+    def unpack(self, payload):
+        """Inflate one DEFLATE payload; returns ``(flags, [(kind, payload), ...])``."""
+        if not payload:
+            raise ProtocolError("empty DEFLATE frame")
+        flags = payload[0]
+        context = flags & CONTEXT_MASK
+        decompressor = self.contexts.get(context)
+        if decompressor is None or flags & RESET:
+            decompressor = self.contexts[context] = zlib.decompressobj(WBITS)
+        try:
+            data = decompressor.decompress(bytes(payload[1:]) + FLUSH_TAIL, MAX_INFLATED)
+        except zlib.error as e:
+            raise ProtocolError(f"bad DEFLATE data: {e}") from None
+        if decompressor.unconsumed_tail:
+            raise ProtocolError("DEFLATE frame inflates past the limit")
+        return flags, split_frames(data)
+
+
+def split_frames(data):
+    """The (kind, payload) pairs of a buffer of complete v2 frames."""
+    frames = []
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        if len(view) - offset < HEADER.size:
+            raise ProtocolError("truncated frame inside DEFLATE data")
+        length, kind = HEADER.unpack_from(view, offset)
+        offset += HEADER.size
+        if length > len(view) - offset:
+            raise ProtocolError("truncated frame inside DEFLATE data")
+        frames.append((kind, view[offset:offset + length]))
+        offset += length
+    return frames
+
+
+def byte_entropy(data):
+    """Shannon entropy of ``data`` in bits per byte, 0 to 8."""
+    total = len(data)
+    if not total:
+        return 0.0
+    return -sum(n / total * math.log2(n / total) for n in collections.Counter(data).values())
+
+
+def file_sample(f, size):
+    """Up to SAMPLE bytes from each of the start, middle and end of open file ``f``."""
+    if size <= 3 * SAMPLE:
+        f.seek(0)
+        return f.read(size)
+    pieces = []
+    for start in (0, size // 2 - SAMPLE // 2, size - SAMPLE):
+        f.seek(start)
+        pieces.append(f.read(SAMPLE))
+    return b"".join(pieces)
+
+
+def file_compressible(mimetype, sample):
+    """Whether to compress an upload of this type whose bytes look like ``sample``."""
+    if mimetype in PACKED_TYPES:
+        return False
+    if mimetype.partition("/")[0] in MEDIA and mimetype not in PLAIN_MEDIA:
+        return False
+    # Everything else, including zip-based documents such as .docx, is
+    # judged by its data.
+    return byte_entropy(sample) < MAX_ENTROPY
+
+
+def pack_chunk(data):
+    """One CHUNK body as raw deflate data, or None where that is not smaller."""
+    compressor = zlib.compressobj(FILE_LEVEL, zlib.DEFLATED, FILE_WBITS)
+    packed = compressor.compress(data) + compressor.flush()
+    return packed if len(packed) < len(data) else None
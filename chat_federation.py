@@ -0,0 +1,282 @@
+"""Federation: separate chat servers relay broadcasts to one another.
+
+Every server (a node) may listen for peers on a federation port of its own
+and connects to each address in its peer list. A link that drops is dialled
+again every few seconds, so nodes can be started in any order. Chat lines
+and notices broadcast on one node (MSG, NOTIFY) are sent over every link and
+each node delivers them to its own clients in the same room. Clients can
+therefore be spread over several nodes, for example behind a load balancer.
+
+Links need not form a full mesh. A node passes on what it receives to its
+other peers, so a broadcast floods the whole graph. Every relayed broadcast
+carries the id of the node it started on (its origin, new with every run)
+and that node's sequence number for it. A node delivers and passes on each
+(origin, seq) once and drops every later copy, which ends loops and the
+duplicates that several paths between two nodes would bring.
+
+Only broadcasts are federated. User names, direct messages, room counts and
+files stay on the node that has them, and so does each node's history (it
+keeps the broadcasts it delivers, local and relayed alike).
+
+Peer frames use the v2 framing of chat_protocol with the kinds below;
+fields are separated by ``::`` and text always comes last. Peers are not
+authenticated: keep the federation port on a private network.
+"""
+import asyncio
+import itertools
+import secrets
+import time
+
+import chat_protocol as proto
+from chat_cluster import BusConnection
+
+PEER_HELLO = 1   # <origin>::<node name>
+RELAY = 2        # <origin>::<seq>::<kind>::<room>::<text>
+
+# What peers may relay.
+RELAY_KINDS = frozenset((proto.MSG, proto.NOTIFY))
+# Seconds between attempts to reach a peer that is down.
+RECONNECT_DELAY = 2.0
+# Sequence numbers per origin remembered one by one (see SeenWindow).
+SEEN_WINDOW = 4096
+# Seconds an origin may stay silent before its SeenWindow is forgotten.
+# Origins are new with every run of a node, so without this each restart
+# of a peer would leave a window behind for good.
+SEEN_TTL = 600.0
+# Unsent bytes a peer may fall behind by before its link is dropped.
+PEER_BUFFER_MAX = 8 * 1024 * 1024
+
+
+def parse_peer(text):
+    """``host:port`` (or ``[v6 address]:port``) as a (host, port) pair."""
+    host, sep, port = text.rpartition(":")
+    if not sep or not host or not port.isdigit():
+        raise ValueError(f"peer must be host:port, not {text!r}")
+    return host.strip("[]"), int(port)
+
+
+class SeenWindow:
+    """Sequence numbers of one origin that were delivered already.
+
+    Copies of one origin's broadcasts can overtake each other on different
+    paths, so a high-water mark alone would drop a late first copy. The
+    last SEEN_WINDOW numbers are remembered one by one; older ones count
+    as seen.
+    """
+
+    __slots__ = ("high", "recent", "last")
+
+    def __init__(self):
+        self.high = 0
+        self.recent = set()
+        # When this origin was last heard from (time.monotonic()).
+        self.last = 0.0
+
+    def add(self, seq):
+        """True the first time ``seq`` is added."""
+        if seq <= self.high - SEEN_WINDOW or seq in self.recent:
+            return False
+        self.recent.add(seq)
+        if seq > self.high:
+            self.high = seq
+            if len(self.recent) > 2 * SEEN_WINDOW:
+                floor = seq - SEEN_WINDOW
+                self.recent = {s for s in self.recent if s > floor}
+        return True
+
+
+class PeerConnection(BusConnection):
+    """A link to another node, dialled by us (outbound) or by it."""
+
+    def __init__(self, on_frame, on_lost, hello, outbound):
+        super().__init__(on_frame, on_lost)
+        self.hello = hello
+        self.outbound = outbound
+        # Set by the peer's PEER_HELLO.
+        self.origin = None
+        self.name = None
+        self.lost = asyncio.get_running_loop().create_future()
+
+    @property
+    def addr(self):
+        return self.transport.get_extra_info("peername")
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.send(PEER_HELLO, self.hello)
+
+    def buffer_updated(self, nbytes):
+        try:
+            super().buffer_updated(nbytes)
+        except ValueError:
+            # A malformed frame: nothing after it on this link can be trusted.
+            self.transport.abort()
+
+
+class Federation:
+    """This node's links to its peers; see ChatServer(federation=...).
+
+    ``owner`` (a ChatServer, or the cluster hub of ``--workers``) gets
+    relayed broadcasts through ``_deliver_federated(kind, room, text)``
+    and hands its own to ``relay()``.
+    """
+
+    def __init__(self, host="0.0.0.0", port=None, peers=(), name=""):
+        self.host = host
+        self.port = port
+        self.peers = list(peers)
+        self.name = name
+        # New with every run, so a restarted node's numbering starts afresh.
+        self.origin = secrets.token_hex(8)
+        self.owner = None
+        self.server = None
+        self.tasks = []
+        self.connections = set()
+        # origin -> PeerConnection, for peers that said PEER_HELLO
+        self.links = {}
+        # origin -> SeenWindow, for origins heard from within SEEN_TTL
+        self.seen = {}
+        self._next_expiry = 0.0
+        self._seq = itertools.count(1)
+        self.relayed = 0
+        self.received = 0
+        self.duplicates = 0
+
+    async def start(self, owner):
+        self.owner = owner
+        loop = asyncio.get_running_loop()
+        if self.port is not None:
+            self.server = await loop.create_server(lambda: self._connection(False),
+                                                   self.host, self.port, reuse_address=True)
+            owner.log(f"🔗 Federation peers accepted on {self.host}:{self.port}", "system")
+        for address in self.peers:
+            self.tasks.append(loop.create_task(self._keep_linked(address)))
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.server:
+            self.server.close()
+        for conn in list(self.connections):
+            conn.transport.close()
+
+    def peer_names(self):
+        return sorted(conn.name for conn in self.links.values())
+
+    def _connection(self, outbound):
+        conn = PeerConnection(self._frame, self._lost, f"{self.origin}::{self.name}".encode(), outbound)
+        self.connections.add(conn)
+        return conn
+
+    async def _keep_linked(self, address):
+        """Dial one configured peer, and again whenever the link drops."""
+        loop = asyncio.get_running_loop()
+        host, port = address
+        origin = None
+        reported = False
+        while True:
+            if origin in self.links:
+                # Linked already over the connection it made to us.
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                _, conn = await loop.create_connection(lambda: self._connection(True), host, port)
+            except OSError as e:
+                if not reported:
+                    self.owner.log(f"⚠️ Federation peer {host}:{port} unreachable ({e}); retrying", "warning")
+                    reported = True
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            reported = False
+            await conn.lost
+            origin = conn.origin or origin
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    # ---- outgoing
+
+    def relay(self, kind, text, room_name=""):
+        """Send a broadcast that started on this node to every peer."""
+        self.relayed += 1
+        self._forward(None, f"{self.origin}::{next(self._seq)}::{kind}::{room_name}::{text}".encode())
+
+    def _forward(self, source, payload):
+        for conn in list(self.links.values()):
+            if conn is source:
+                continue
+            if conn.transport.get_write_buffer_size() > PEER_BUFFER_MAX:
+                self.owner.log(f"🐢 Dropping federation peer {conn.name}: "
+                               f"{PEER_BUFFER_MAX // (1024 * 1024)} MB unsent", "warning")
+                conn.transport.abort()
+                continue
+            conn.send(RELAY, payload)
+
+    # ---- incoming
+
+    def _frame(self, conn, kind, payload):
+        try:
+            if kind == RELAY:
+                self._relayed(conn, payload)
+            elif kind == PEER_HELLO:
+                self._hello(conn, payload)
+        except ValueError as e:
+            self.owner.log(f"⚠️ Bad frame from federation peer {conn.addr}: {e}", "warning")
+            conn.transport.abort()
+
+    def _hello(self, conn, payload):
+        origin, _, name = str(payload, "utf-8").partition("::")
+        if not origin:
+            raise ValueError("PEER_HELLO without an origin")
+        conn.origin, conn.name = origin, name
+        if origin == self.origin:
+            self.owner.log(f"⚠️ Federation peer {conn.addr} is this node itself", "warning")
+            conn.transport.close()
+            return
+        current = self.links.get(origin)
+        if current is not None:
+            # Both ends dialled each other: keep the link the smaller origin
+            # opened, which is the one both ends pick.
+            if conn.outbound != (self.origin < origin):
+                conn.transport.close()
+                return
+            current.transport.close()
+        self.links[origin] = conn
+        self.owner.log(f"🔗 Linked with federation peer {name} at {conn.addr}", "success")
+
+    def _relayed(self, conn, payload):
+        if conn.origin is None:
+            raise ValueError("RELAY before PEER_HELLO")
+        origin, seq, kind, room, text = payload.split(b"::", 4)
+        origin, seq, kind = str(origin, "ascii"), int(seq), int(kind)
+        if kind not in RELAY_KINDS:
+            raise ValueError(f"kind {kind} cannot be relayed")
+        if origin == self.origin:
+            self.duplicates += 1
+            return
+        now = time.monotonic()
+        if now >= self._next_expiry:
+            self._expire_seen(now)
+        seen = self.seen.get(origin)
+        if seen is None:
+            seen = self.seen[origin] = SeenWindow()
+        seen.last = now
+        if not seen.add(seq):
+            self.duplicates += 1
+            return
+        self.received += 1
+        self._forward(conn, payload)
+        self.owner._deliver_federated(kind, str(text, "utf-8", "replace"), str(room, "utf-8"))
+
+    def _expire_seen(self, now):
+        """Forget the windows of origins silent for SEEN_TTL (e.g. restarted peers)."""
+        self._next_expiry = now + SEEN_TTL / 4
+        for origin, seen in list(self.seen.items()):
+            if now - seen.last > SEEN_TTL:
+                del self.seen[origin]
+
+    def _lost(self, conn):
+        self.connections.discard(conn)
+        if conn.origin is not None and self.links.get(conn.origin) is conn:
+            del self.links[conn.origin]
+            self.owner.log(f"⚠️ Lost federation peer {conn.name}", "warning")
+        if not conn.lost.done():
+            conn.lost.set_result(None)
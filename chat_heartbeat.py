@@ -0,0 +1,133 @@
+"""Finding dead connections: heartbeats, a timer wheel and TCP keepalive.
+
+A peer that vanishes without closing its socket (a laptop put to sleep, a
+pulled cable, a NAT that forgot the mapping) sends no FIN, so the server
+would only notice once a write to it failed. Three things find it sooner:
+
+* Heartbeats. A v2 connection the server has not heard from for
+  ``heartbeat`` seconds gets a PING, which the client answers with a PONG.
+  One that stays silent for ``idle_timeout`` seconds in all is closed
+  (reaped). v1 clients cannot answer and are left to TCP keepalive.
+* The timer wheel that schedules those checks. It holds one entry per
+  connection and is driven by a single loop timer, however many
+  connections there are. Traffic does not touch it: a check that finds the
+  connection was active since simply sets the next one.
+* TCP keepalive. The kernel probes a connection that has been quiet for a
+  while and resets it when the probes go unanswered, which also catches
+  clients that never answer PING.
+"""
+import asyncio
+import math
+import socket
+
+# Seconds per wheel step and steps per turn of the wheel: one turn covers
+# a little over eight minutes, longer delays wait extra turns.
+TICK = 1.0
+SLOTS = 512
+
+# Seconds of silence before a PING, and before a silent connection is reaped.
+HEARTBEAT = 30
+IDLE_TIMEOUT = 90
+# TCP keepalive: first probe after this many quiet seconds, then a probe
+# every KEEPALIVE_INTERVAL; KEEPALIVE_COUNT unanswered probes drop the
+# connection.
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+
+def set_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """Turn on TCP keepalive for ``sock`` with the given timing where the OS allows."""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        elif hasattr(socket, "TCP_KEEPALIVE"):  # macOS
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        if hasattr(socket, "TCP_KEEPCNT"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+        if hasattr(socket, "TCP_USER_TIMEOUT"):
+            # Keepalive waits while sent data is unacknowledged; this bounds
+            # that wait (Linux).
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT,
+                            (idle + interval * count) * 1000)
+    except OSError:
+        # Not TCP (a socketpair in a benchmark) or not supported here.
+        return False
+    return True
+
+
+class TimerWheel:
+    """Many coarse timeouts on one loop timer: O(1) to add, drop or expire.
+
+    Time is cut into steps of ``tick`` seconds and a ring of ``slots``
+    buckets holds what falls due in each step. A delay longer than one turn
+    of the ring waits in its bucket for the turns still to go. Delays are
+    rounded up to whole ticks, so a timeout fires up to one tick late.
+    """
+
+    def __init__(self, callback, tick=TICK, slots=SLOTS):
+        self.callback = callback
+        self.tick = tick
+        # Each bucket maps item -> whole turns still to wait.
+        self.slots = [{} for _ in range(slots)]
+        # item -> index of its bucket
+        self.where = {}
+        # Ticks since start().
+        self.position = 0
+        self.loop = None
+        self.started = None
+        self.handle = None
+
+    def __len__(self):
+        return len(self.where)
+
+    def add(self, item, delay):
+        """Call back with ``item`` in ``delay`` seconds, instead of any earlier time."""
+        self.discard(item)
+        ticks = max(1, math.ceil(delay / self.tick))
+        index = (self.position + ticks) % len(self.slots)
+        self.slots[index][item] = (ticks - 1) // len(self.slots)
+        self.where[item] = index
+
+    def discard(self, item):
+        index = self.where.pop(item, None)
+        if index is not None:
+            del self.slots[index][item]
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.started = self.loop.time()
+        self.position = 0
+        self._schedule()
+
+    def stop(self):
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+
+    def _schedule(self):
+        self.handle = self.loop.call_at(self.started + (self.position + 1) * self.tick, self._advance)
+
+    def _advance(self):
+        # A busy loop may run this late: catch up on every tick since.
+        due = int((self.loop.time() - self.started) / self.tick)
+        try:
+            while self.position < due:
+                self.position += 1
+                bucket = self.slots[self.position % len(self.slots)]
+                expired = []
+                for item, turns in bucket.items():
+                    if turns:
+                        bucket[item] = turns - 1
+                    else:
+                        expired.append(item)
+                for item in expired:
+                    del bucket[item]
+                    del self.where[item]
+                for item in expired:
+                    self.callback(item)
+        finally:
+            self._schedule()
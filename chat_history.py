@@ -0,0 +1,208 @@
+"""Append-only chat history in SQLite (WAL mode), written off the event loop.
+
+``append()`` assigns the next sequence number, stores the line in a small
+in-memory ring of recent messages and hands it to a writer thread. The
+writer commits whatever has piled up in one transaction (group commit), so
+the broadcast path never waits for the disk and a busy room costs one
+commit per batch rather than per message.
+
+Every message belongs to a room; server-wide notices are stored with the
+room ``""`` and show up in every room's history. A page of "the N messages
+of a room before seq S" is taken from the ring on the event loop (``recent_page()``). Only the part that is older than the ring
+is read from the database, on a worker thread (``older()``), which first
+waits until those rows are committed.
+
+With ``writer=False`` another process does the writing (the supervisor of
+a chat_cluster). ``record()`` then only keeps the lines it has stored in
+the ring. Pages older than the ring are read from the shared database
+without waiting, and the last few milliseconds of writes may be missing
+from them.
+"""
+import collections
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+HISTORY_FILE = "history.db"
+# The database and the files SQLite keeps next to it in WAL mode.
+SQLITE_SUFFIXES = ("", "-wal", "-shm")
+# Recent messages kept in memory for replay without touching the database.
+RECENT = 1000
+# Most rows written in one transaction.
+BATCH_MAX = 1000
+# Most messages one page request returns.
+PAGE_MAX = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    seq  INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    text TEXT NOT NULL,
+    room TEXT NOT NULL DEFAULT ''
+)
+"""
+# Pages of one room are read through this index: newest first from the
+# room and from the server-wide lines, each stopping after one page.
+INDEX = "CREATE INDEX IF NOT EXISTS messages_room ON messages (room, seq)"
+PAGE_QUERY = """
+SELECT * FROM (SELECT seq, time, text, room FROM messages
+               WHERE room = ? AND seq < ? ORDER BY seq DESC LIMIT ?)
+UNION
+SELECT * FROM (SELECT seq, time, text, room FROM messages
+               WHERE room = '' AND seq < ? ORDER BY seq DESC LIMIT ?)
+ORDER BY seq DESC LIMIT ?
+"""
+
+
+def default_history_path(upload_dir):
+    """Where the history of a server with this upload folder goes: beside it, not in it.
+
+    Everything in the upload folder may be downloaded, so the history (all
+    rooms' chat) must not be there. A history.db left inside by an older
+    version is moved out.
+    """
+    path = f"{os.path.normpath(upload_dir)}-{HISTORY_FILE}"
+    old = os.path.join(upload_dir, HISTORY_FILE)
+    if os.path.exists(old) and not os.path.exists(path):
+        for suffix in SQLITE_SUFFIXES:
+            if os.path.exists(old + suffix):
+                os.replace(old + suffix, path + suffix)
+    return path
+
+
+class ChatHistory:
+    def __init__(self, path, recent=RECENT, writer=True):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = self._connect()
+        try:
+            db.execute(SCHEMA)
+            columns = [row[1] for row in db.execute("PRAGMA table_info(messages)")]
+            if "room" not in columns:
+                # Written before rooms existed: old lines count as server-wide.
+                db.execute("ALTER TABLE messages ADD COLUMN room TEXT NOT NULL DEFAULT ''")
+            db.execute(INDEX)
+            db.commit()
+            last = db.execute("SELECT seq, time, text, room FROM messages ORDER BY seq DESC LIMIT ?",
+                              (recent,)).fetchall()
+        finally:
+            db.close()
+        self.recent = collections.deque(reversed(last), maxlen=recent)
+        self.next_seq = last[0][0] + 1 if last else 1
+        self.pending = queue.SimpleQueue()
+        self.batches = 0
+        self.written = 0
+        self.committed_seq = self.next_seq - 1
+        self._committed = threading.Condition()
+        # older() runs on worker threads, one query at a time.
+        self._reader = None
+        self._reader_lock = threading.Lock()
+        self._writer = None
+        if writer:
+            self._writer = threading.Thread(target=self._write_loop, name="chat-history", daemon=True)
+            self._writer.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode NORMAL only syncs at checkpoints: a crash of this
+        # process loses nothing, a power cut may lose the last commits.
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def append(self, text, room="", when=None):
+        """Record one message; returns its sequence number. Never blocks on the disk."""
+        entry = (self.next_seq, when or time.time(), text, room)
+        self.next_seq += 1
+        self.recent.append(entry)
+        self.pending.put(entry)
+        return entry[0]
+
+    def record(self, seq, when, text, room=""):
+        """Keep a message another process has stored (``writer=False``)."""
+        self.recent.append((seq, when, text, room))
+        self.next_seq = seq + 1
+
+    def _write_loop(self):
+        db = self._connect()
+        try:
+            while True:
+                entry = self.pending.get()
+                if entry is None:
+                    return
+                batch = [entry]
+                # Everything that arrived during the last commit goes in this one.
+                stop = False
+                while len(batch) < BATCH_MAX:
+                    try:
+                        entry = self.pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    if entry is None:
+                        stop = True
+                        break
+                    batch.append(entry)
+                db.executemany("INSERT INTO messages (seq, time, text, room) VALUES (?, ?, ?, ?)", batch)
+                db.commit()
+                self.batches += 1
+                self.written += len(batch)
+                with self._committed:
+                    self.committed_seq = batch[-1][0]
+                    self._committed.notify_all()
+                if stop:
+                    return
+        finally:
+            db.close()
+
+    def recent_page(self, count, before, room=""):
+        """Loop thread: ``(entries, below, missing)``.
+
+        ``entries`` are the newest ones of ``room`` below ``before`` that are
+        still in memory, oldest first; ``missing`` more are to be fetched
+        with ``older(below, missing, room)``.
+        """
+        count = min(count, PAGE_MAX)
+        entries = []
+        for entry in reversed(self.recent):
+            if entry[0] >= before or entry[3] not in (room, ""):
+                continue
+            if len(entries) == count:
+                break
+            entries.append(entry)
+        entries.reverse()
+        start = self.recent[0][0] if self.recent else self.next_seq
+        # Short of a full page: the rest can only be older than the ring.
+        below = entries[0][0] if len(entries) == count else min(before, start)
+        missing = count - len(entries) if below > 1 else 0
+        return entries, below, missing
+
+    def older(self, below, count, room=""):
+        """Worker thread: up to ``count`` stored entries of ``room`` with seq < ``below``, oldest first."""
+        if self._writer is not None:
+            with self._committed:
+                # Entries that left the ring may still be waiting for their commit.
+                self._committed.wait_for(lambda: self.committed_seq >= below - 1, timeout=5)
+        with self._reader_lock:
+            if self._reader is None:
+                self._reader = self._connect()
+            rows = self._reader.execute(PAGE_QUERY, (room, below, count, below, count, count)).fetchall()
+        return rows[::-1]
+
+    @property
+    def backlog(self):
+        """Messages appended but not committed yet."""
+        return self.pending.qsize()
+
+    def close(self):
+        """Write everything still pending and close the database."""
+        if self._writer is not None:
+            self.pending.put(None)
+            self._writer.join()
+        with self._reader_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
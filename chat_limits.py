@@ -0,0 +1,88 @@
+"""Admission control: connection caps and per-client rate limits.
+
+* Connection caps. A server takes at most ``max_connections`` connections
+  in all and ``max_per_ip`` from one address; data connections count too.
+  A connection over a cap gets one ERROR line saying why and is closed
+  before it is a chat member. In v1 framing, because the client has not
+  said which version it speaks yet.
+* Message rate. Each client has a token bucket of ``message_rate``
+  tokens a second that holds up to ``message_burst``; every MSG and DM
+  costs one. A chat line that finds the bucket empty is not delivered,
+  and the first one of a run of them is answered with an ERROR.
+* Upload rate. Upload bytes are paid from a second bucket. A client that
+  sends faster is not refused: the server stops reading from it until the
+  bucket has caught up, so TCP slows the sender down.
+
+0 turns a cap or a rate off.
+"""
+import collections
+
+MAX_CONNECTIONS = 20000
+MAX_PER_IP = 64
+# Chat lines a second, and how many may come at once after a quiet spell.
+MESSAGE_RATE = 10
+MESSAGE_BURST = 20
+# Upload bytes a second per client; off by default so LAN transfers run at
+# full speed. A second's worth may come at once.
+UPLOAD_RATE = 0
+
+
+class TokenBucket:
+    """``rate`` tokens a second, up to ``burst`` of them saved up."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, now, n=1):
+        """Spend ``n`` tokens if there are that many; False (and nothing spent) if not."""
+        self._refill(now)
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+    def debit(self, now, n):
+        """Spend ``n`` tokens, into debt if need be; seconds until the debt is paid."""
+        self._refill(now)
+        self.tokens -= n
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class ConnectionLimits:
+    """Open connections, in all and per client address, against their caps."""
+
+    def __init__(self, max_total=MAX_CONNECTIONS, max_per_ip=MAX_PER_IP):
+        self.max_total = max_total
+        self.max_per_ip = max_per_ip
+        self.total = 0
+        self.per_ip = collections.Counter()
+        self.refused = 0
+
+    def admit(self, ip):
+        """Count a new connection from ``ip`` (None: no address to cap); why it is refused, or None."""
+        if self.max_total and self.total >= self.max_total:
+            self.refused += 1
+            return f"server full ({self.max_total} connections)"
+        if self.max_per_ip and ip is not None and self.per_ip[ip] >= self.max_per_ip:
+            self.refused += 1
+            return f"too many connections from {ip} (limit {self.max_per_ip})"
+        self.total += 1
+        self.per_ip[ip] += 1
+        return None
+
+    def release(self, ip):
+        self.total -= 1
+        left = self.per_ip[ip] - 1
+        if left:
+            self.per_ip[ip] = left
+        else:
+            del self.per_ip[ip]
@@ -0,0 +1,156 @@
+"""Counters, gauges and histograms for the chat server, in Prometheus text format.
+
+Metrics are updated on the server's event loop thread with plain attribute
+arithmetic (no locks), and read by the HTTP thread when scraped:
+
+    python chat_server.py --metrics-port 9464
+    curl http://127.0.0.1:9464/metrics
+"""
+import bisect
+import http.server
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICS_HOST = "127.0.0.1"
+
+# Seconds, for anything that should take well under a millisecond.
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """A running total, counted here or read from ``function`` at scrape time."""
+
+    __slots__ = ("name", "help", "value", "function")
+    kind = "counter"
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.function() if self.function else self.value
+
+
+class Gauge:
+    """A value that is set, or read from ``function`` at scrape time."""
+
+    __slots__ = ("name", "help", "value", "function")
+    kind = "gauge"
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield self.name, self.function() if self.function else self.value
+
+
+class Histogram:
+    """Fixed buckets; ``observe()`` is one bisect and two additions."""
+
+    __slots__ = ("name", "help", "bounds", "counts", "sum")
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(sorted(buckets))
+        # One count per bucket plus the +Inf overflow, not yet cumulative.
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), list(self.counts)):
+            total += count
+            yield f'{self.name}_bucket{{le="{_format(bound)}"}}', total
+        yield f"{self.name}_sum", self.sum
+        yield f"{self.name}_count", total
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, function=None):
+        return self._add(Counter(name, help, function))
+
+    def gauge(self, name, help, function=None):
+        return self._add(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in metric.samples():
+                lines.append(f"{name} {_format(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves a Registry at /metrics from a daemon thread."""
+
+    def __init__(self, registry, host=METRICS_HOST, port=0):
+        self.registry = registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
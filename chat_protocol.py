@@ -0,0 +1,294 @@
+"""Wire formats shared by the chat server and client.
+
+Two framings carry the same commands:
+
+* v1 (legacy text): one ``KIND::payload\\n`` line per command.
+* v2: a 5-byte header -- 4-byte big-endian payload length, 1 type byte --
+  followed by the payload.
+
+A v2 client opens with the line ``HELLO::2``. The server answers with the
+same line and from then on both directions use v2 frames. A client that
+starts with anything else is served in v1.
+
+In both versions a FILE or CHUNK header (client -> server) and a FILEDATA
+header (server -> client) are followed by exactly that many raw body bytes that
+are not framed.
+
+Commands (payload fields are separated by ``::``):
+
+* MSG <text>, NOTIFY <text>, ERROR <text>
+* FILE <name>::<size>::<mimetype> + body
+* GET <name>[::<offset>[::<length>]] -- length 0 or missing means "to the end"
+* FILEDATA <name>::<offset>::<length>::<total>::<mimetype> + body
+
+Data connections keep file transfers off the chat connection:
+
+* DATA -- ask for a one-time token; the server answers DATA <token>
+* ATTACH <token> -- first command on a second connection (right after
+  HELLO), which from then on carries only UPLOAD/RESUME/CHUNK/GET/FILE
+  traffic for the chat connection that asked for the token
+
+Chat history (see chat_history):
+
+* HISTORY <count>[::<before seq>] -- ask for up to count earlier messages;
+  without a seq, the ones from before this connection joined
+* HISTORY <seq>::<unix time>::<text> -- one stored message, oldest first
+* HISTORY_END <count>::<oldest seq>::<more> -- end of the page; ask again
+  with the oldest seq while more is 1
+
+Rooms: every chat connection is in exactly one room, DEFAULT_ROOM until it
+joins another. MSG goes to the sender's room only; HISTORY replays that
+room (plus server-wide notices).
+
+* JOIN <room> -- move to a room, created on first join; the server answers
+  JOIN <room>::<members>
+* LEAVE -- go back to DEFAULT_ROOM; answered like JOIN
+* ROOMS -- list rooms; the server answers ROOMS <room>::<members>::...
+
+Users: a chat connection may register a handle, normally right after HELLO.
+
+* NAME <user> -- take a handle (or change it); answered with NAME <user>,
+  or ERROR if it is taken
+* DM <user>::<text> -- private message to one user, sender needs a handle;
+  the recipient gets DM <sender>::<text>
+
+Compression (v2 only, see chat_compress):
+
+* COMPRESS <method>[::<method>...] -- offer stream compression right after
+  HELLO; answered with COMPRESS <method>, or an empty payload for none
+* DEFLATE <flags><data> -- compressed frames; binary payload
+
+Heartbeats (v2 only, see chat_heartbeat):
+
+* PING <token> -- are you there? Sent by the server to a connection it has
+  not heard from for a while; a client may send it too
+* PONG <token> -- the answer, with the PING's token
+
+Resumable uploads (see chat_uploads):
+
+* UPLOAD <name>::<size>::<mimetype>::<sha256> -- start, or pick up the
+  unfinished upload of the same file. If the server already stores that
+  content it answers UPLOADED straight away and no data is sent.
+* RESUME <id> -- ask where an earlier upload stands
+* UPLOADING <id>::<offset>::<size>::<name> -- reply to both; send from offset
+* CHUNK <id>::<offset>::<length>::<sha256>[::deflate::<packed>] + body --
+  length bytes of the file and their hash; with ``deflate`` the body is
+  instead ``packed`` bytes of raw deflate data that inflate to them (see
+  chat_compress.pack_chunk). Clients compress chunks only for a server that
+  accepted COMPRESS.
+* UPLOADED <id>::<name>::<sha256>::<stored as> -- whole file verified and
+  saved; id is empty when the upload was skipped, and the stored name
+  differs from the sent one when another file already had that name
+"""
+import struct
+
+PROTOCOL_VERSION = 2
+HELLO_LINE = b"HELLO::2\n"
+
+HEADER = struct.Struct("!IB")
+# Largest v2 payload and longest v1 line we accept.
+MAX_FRAME = 1024 * 1024
+MAX_LINE = 64 * 1024
+RECV_BUFFER = 64 * 1024
+
+# Frame types. BODY is never on the wire: FrameReader uses it for the raw
+# bytes that follow a FILE, CHUNK or FILEDATA header.
+BODY = -1
+HELLO = 0
+MSG = 1
+NOTIFY = 2
+FILE = 3
+GET = 4
+FILEDATA = 5
+ERROR = 6
+UPLOAD = 7
+RESUME = 8
+UPLOADING = 9
+CHUNK = 10
+UPLOADED = 11
+DATA = 12
+ATTACH = 13
+HISTORY = 14
+HISTORY_END = 15
+JOIN = 16
+LEAVE = 17
+ROOMS = 18
+NAME = 19
+DM = 20
+COMPRESS = 21
+DEFLATE = 22
+PING = 23
+PONG = 24
+
+# Room every chat connection starts in. Room and user names are 1-32
+# characters out of NAME_CHARS and compared in lower case.
+DEFAULT_ROOM = "lobby"
+NAME_MAX = 32
+NAME_CHARS = frozenset("abcdefghijklmnopqrstuvwxyz0123456789-_.")
+
+KIND_NAMES = {
+    HELLO: "HELLO",
+    MSG: "MSG",
+    NOTIFY: "NOTIFY",
+    FILE: "FILE",
+    GET: "GET",
+    FILEDATA: "FILEDATA",
+    ERROR: "ERROR",
+    UPLOAD: "UPLOAD",
+    RESUME: "RESUME",
+    UPLOADING: "UPLOADING",
+    CHUNK: "CHUNK",
+    UPLOADED: "UPLOADED",
+    DATA: "DATA",
+    ATTACH: "ATTACH",
+    HISTORY: "HISTORY",
+    HISTORY_END: "HISTORY_END",
+    JOIN: "JOIN",
+    LEAVE: "LEAVE",
+    ROOMS: "ROOMS",
+    NAME: "NAME",
+    DM: "DM",
+    COMPRESS: "COMPRESS",
+    DEFLATE: "DEFLATE",
+    PING: "PING",
+    PONG: "PONG",
+}
+KIND_CODES = {name.encode(): code for code, name in KIND_NAMES.items()}
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def valid_name(text):
+    """The canonical form of a room or user name, or None if it is not a valid one."""
+    name = text.strip().lower()
+    if 0 < len(name) <= NAME_MAX and NAME_CHARS.issuperset(name):
+        return name
+    return None
+
+
+def encode_v2(kind, payload):
+    return HEADER.pack(len(payload), kind) + payload
+
+
+def encode_legacy(kind, payload):
+    return KIND_NAMES[kind].encode() + b"::" + payload + b"\n"
+
+
+def encode(version, kind, payload):
+    if version == 2:
+        return encode_v2(kind, payload)
+    return encode_legacy(kind, payload)
+
+
+class Frame:
+    """An outgoing frame encoded at most once per protocol version.
+
+    Broadcasting one Frame to a thousand clients produces one bytes object
+    per wire version, shared by every outbound queue.
+    """
+
+    __slots__ = ("kind", "payload", "_v1", "_v2")
+
+    def __init__(self, kind, payload):
+        self.kind = kind
+        self.payload = payload
+        self._v1 = None
+        self._v2 = None
+
+    def encoded(self, version):
+        if version == 2:
+            if self._v2 is None:
+                self._v2 = encode_v2(self.kind, self.payload)
+            return self._v2
+        if self._v1 is None:
+            self._v1 = encode_legacy(self.kind, self.payload)
+        return self._v1
+
+
+def parse_legacy(line):
+    """Split a v1 line into (kind, payload); unknown prefixes are plain chat text."""
+    line = bytes(line)
+    prefix, sep, rest = line.partition(b"::")
+    if sep and prefix in KIND_CODES:
+        return KIND_CODES[prefix], rest
+    return MSG, line
+
+
+class FrameReader:
+    """Incremental parser over one reusable receive buffer.
+
+    Fill it with ``n = sock.recv_into(reader.writable())`` followed by
+    ``reader.commit(n)``, then iterate ``reader.events()``. One recv may
+    hold many frames; each comes back as a memoryview into the buffer, so
+    nothing is copied until the caller decodes it. Views stay valid until
+    the next ``writable()`` call.
+    """
+
+    def __init__(self, size=RECV_BUFFER, version=None, max_frame=MAX_FRAME, max_line=MAX_LINE):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.need = 0
+        self.body_left = 0
+        # None until the first line tells us which protocol the peer speaks.
+        self.version = version
+        self.max_frame = max_frame
+        self.max_line = max_line
+
+    def writable(self, min_free=4096):
+        pending = self.end - self.start
+        if not pending:
+            self.start = self.end = 0
+        capacity = max(self.need, pending + min_free)
+        if capacity > len(self.buf):
+            buf = bytearray(max(capacity, 2 * len(self.buf)))
+            buf[:pending] = self.view[self.start:self.end]
+            self.buf, self.view = buf, memoryview(buf)
+            self.start, self.end = 0, pending
+        elif len(self.buf) - self.end < min_free or self.start + self.need > len(self.buf):
+            # Only the unparsed tail of one frame is ever moved.
+            self.buf[:pending] = bytes(self.view[self.start:self.end])
+            self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def commit(self, nbytes):
+        self.end += nbytes
+
+    def expect_body(self, nbytes):
+        self.body_left = nbytes
+
+    def events(self):
+        while self.start < self.end:
+            if self.body_left:
+                n = min(self.body_left, self.end - self.start)
+                chunk = self.view[self.start:self.start + n]
+                self.start += n
+                self.body_left -= n
+                yield BODY, chunk
+            elif self.version == 2:
+                avail = self.end - self.start
+                if avail < HEADER.size:
+                    return
+                length, kind = HEADER.unpack_from(self.buf, self.start)
+                if length > self.max_frame:
+                    raise ProtocolError(f"frame of {length} bytes exceeds {self.max_frame}")
+                total = HEADER.size + length
+                if avail < total:
+                    self.need = total
+                    return
+                self.need = 0
+                payload = self.view[self.start + HEADER.size:self.start + total]
+                self.start += total
+                yield kind, payload
+            else:
+                i = self.buf.find(b"\n", self.start, self.end)
+                if i < 0:
+                    if self.end - self.start > self.max_line:
+                        raise ProtocolError(f"line longer than {self.max_line} bytes")
+                    return
+                line = self.view[self.start:i]
+                self.start = i + 1
+                yield parse_legacy(line)
@@ -0,0 +1,1992 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import logging
+import mimetypes
+import os
+import pathlib
+import secrets
+import signal
+import socket
+import sys
+import threading
+import time
+
+import chat_protocol as proto
+from chat_metrics import METRICS_HOST, MetricsServer, Registry
+from chat_protocol import (BODY, HELLO, MSG, NOTIFY, FILE, GET, FILEDATA, ERROR,
+                           UPLOAD, RESUME, UPLOADING, CHUNK, UPLOADED, DATA, ATTACH,
+                           HISTORY, HISTORY_END, JOIN, LEAVE, ROOMS, NAME, DM, COMPRESS, DEFLATE,
+                           PING, PONG, DEFAULT_ROOM)
+from chat_cluster import ClusterLink, run_cluster
+from chat_federation import Federation, parse_peer
+from chat_heartbeat import HEARTBEAT, IDLE_TIMEOUT, KEEPALIVE_IDLE, TimerWheel, set_keepalive
+from chat_compress import DEFLATE_NAME, ECHO, SHARED, DeflateStream, Inflater
+from chat_history import HISTORY_FILE, PAGE_MAX, SQLITE_SUFFIXES, ChatHistory, default_history_path
+from chat_limits import (MAX_CONNECTIONS, MAX_PER_IP, MESSAGE_BURST, MESSAGE_RATE, UPLOAD_RATE,
+                         ConnectionLimits, TokenBucket)
+from chat_uploads import HASH, INDEX_FLUSH_DELAY, BlobStore, ChunkUpload, FileUpload, UploadStore
+
+HOST = '0.0.0.0'
+PORT = 5050
+UPLOAD_DIR = "uploads"
+
+# Pending connections the kernel may queue before accept() catches up.
+BACKLOG = 1024
+# Outbound frames a client may have waiting before it counts as a slow consumer.
+MAX_QUEUE = 1000
+# What to do with a slow consumer: "drop" disconnects it, "lag" keeps it
+# connected but discards frames until its queue drains below half.
+SLOW_POLICY = "drop"
+# Downloads one connection may have queued behind the one being sent.
+MAX_DOWNLOADS = 4
+
+# A data connection sends ATTACH right after HELLO, so a connection is
+# announced as a chat member with its first other command (NAME first, so
+# the announcement shows the handle), or after this many seconds if it
+# sends nothing else.
+ATTACH_GRACE = 0.5
+# Seconds a refused connection is kept open (reading nothing) after the
+# ERROR that says why, so the client gets to read it.
+REFUSE_LINGER = 2
+# Seconds a DATA token stays valid.
+DATA_TOKEN_TTL = 30
+# What a data connection may send.
+DATA_KINDS = frozenset((FILE, GET, UPLOAD, RESUME, CHUNK))
+# What is sent compressed to clients that negotiated COMPRESS.
+CHAT_KINDS = frozenset((MSG, NOTIFY, DM, HISTORY, HISTORY_END, ERROR))
+# What may come inside a DEFLATE frame from a client: no raw bodies follow it.
+INFLATE_KINDS = frozenset((MSG, DM, NAME, JOIN, LEAVE, ROOMS, HISTORY, GET, DATA))
+# Most raw bytes packed into one DEFLATE frame by a history replay.
+PACK_MAX = 64 * 1024
+
+# Uploads are received into a reusable buffer of this size and written to
+# disk one full block at a time.
+UPLOAD_BUFFER = 1024 * 1024
+# Worker threads that hash and write upload blocks off the event loop.
+DISK_THREADS = 4
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def sendmsg_socket(transport):
+    """The raw socket behind a transport if we should scatter-gather on it ourselves.
+
+    Python 3.12+ selector transports already turn writelines() into one
+    sendmsg() call; on older versions we do it for them while the
+    transport's own buffer is empty.
+
+    asyncio only hands out a TransportSocket wrapper without sendmsg();
+    the real socket is its private ``_sock``. Whenever that is not there
+    (another event loop, a TLS transport, a different asyncio) the answer
+    is None and flush() leaves all writing to transport.writelines().
+    """
+    if sys.version_info >= (3, 12) or not hasattr(socket.socket, "sendmsg"):
+        return None
+    if transport.get_extra_info("sslcontext") is not None:
+        return None  # bytes written past the transport would skip TLS
+    wrapper = transport.get_extra_info("socket")
+    sock = getattr(wrapper, "_sock", None)
+    if not isinstance(sock, socket.socket) or sock.fileno() != wrapper.fileno():
+        return None
+    return sock
+
+
+def raise_fd_limit():
+    """Lift the soft open-file limit to the hard limit so we can hold 10k+ sockets."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+class ServerObserver:
+    """Receives server events. Subclass and override what you need.
+
+    Methods are called on the server's event loop thread, so they must be
+    quick and must not touch a GUI toolkit directly from there unless the
+    toolkit allows it.
+    """
+
+    def log(self, text, level="info"):
+        pass
+
+    def message(self, addr, text):
+        self.log(f"{addr}: {text}", "info")
+
+    def clients_changed(self):
+        pass
+
+    def file_received(self, addr, name, path, mimetype):
+        pass
+
+
+class LoggingObserver(ServerObserver):
+    """Headless observer: forwards events to the logging module."""
+
+    LEVELS = {
+        "info": logging.INFO,
+        "success": logging.INFO,
+        "system": logging.INFO,
+        "broadcast": logging.INFO,
+        "warning": logging.WARNING,
+        "error": logging.ERROR,
+    }
+
+    def __init__(self, logger=None, log_messages=True):
+        self.logger = logger or logging.getLogger("chat_server")
+        self.log_messages = log_messages
+
+    def log(self, text, level="info"):
+        self.logger.log(self.LEVELS.get(level, logging.INFO), text)
+
+    def message(self, addr, text):
+        if self.log_messages:
+            self.logger.debug("%s: %s", addr, text)
+
+
+class FileRange:
+    """A byte range of a stored file queued behind its FILEDATA header."""
+
+    __slots__ = ("name", "path", "offset", "length")
+
+    def __init__(self, name, path, offset, length):
+        self.name = name
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+
+class SessionStats:
+    """Traffic counters for one chat client, shared with its data connections."""
+
+    __slots__ = ("connected_at", "last_active", "bytes_in", "bytes_out",
+                 "frames_in", "frames_out", "messages", "upload_bytes", "throttled")
+
+    def __init__(self):
+        self.connected_at = self.last_active = time.time()
+        self.bytes_in = self.bytes_out = 0
+        self.frames_in = self.frames_out = 0
+        self.messages = 0
+        self.upload_bytes = 0
+        # Chat lines refused and upload pauses for going over a rate limit.
+        self.throttled = 0
+
+
+# What ChatServer.traffic_snapshot() reports per chat client.
+ClientTraffic = collections.namedtuple(
+    "ClientTraffic", "id addr lagging queued connected_at last_active bytes_in bytes_out "
+                     "frames_in frames_out messages upload_bytes room name throttled")
+
+
+class Room:
+    """A chat room: the sessions in it, by connection id, and its shared deflate stream."""
+
+    __slots__ = ("name", "members", "messages", "stream")
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}
+        self.messages = 0
+        self.stream = DeflateStream(SHARED)
+
+
+# What ChatServer.rooms_snapshot() reports per room.
+RoomInfo = collections.namedtuple("RoomInfo", "name members messages")
+
+
+class ClientSession(asyncio.BufferedProtocol):
+    """One client connection.
+
+    Incoming bytes are received straight into the session's FrameReader
+    buffer (BufferedProtocol hands the kernel our memoryview), and every
+    complete frame in it is dispatched before the next recv.
+    """
+
+    # A server holds thousands of these; slots keep each one small.
+    __slots__ = ("server", "id", "transport", "sock", "addr", "reader", "upload",
+                 "_into_upload", "_disk_wait", "queue", "max_queue", "lagging",
+                 "dropped_frames", "closed", "joined", "join_timer", "control",
+                 "attached", "pending_files", "sending_file", "writer_task",
+                 "_wakeup", "_writable", "stats", "history_from", "room", "name",
+                 "deflate", "inflate", "shared_synced", "ping_sent", "admitted",
+                 "message_bucket", "upload_bucket", "rate_noticed", "_throttled",
+                 "pending_name", "held")
+
+    def __init__(self, server, cid, max_queue=MAX_QUEUE):
+        self.server = server
+        self.id = cid
+        self.transport = None
+        self.sock = None
+        self.addr = None
+        self.reader = proto.FrameReader()
+        self.upload = None
+        self._into_upload = False
+        # Reading is paused while an upload waits for the disk.
+        self._disk_wait = False
+        # Bounded outbound queue drained by this client's own writer task, so
+        # a full TCP window only ever stalls this client.
+        self.queue = collections.deque()
+        self.max_queue = max_queue
+        self.lagging = False
+        self.dropped_frames = 0
+        self.closed = False
+        # Announced as a chat member; data connections never are.
+        self.joined = False
+        self.join_timer = None
+        # For a data connection, the chat connection it works for; for a
+        # chat connection, its attached data connections.
+        self.control = None
+        self.attached = []
+        self.pending_files = 0
+        self.sending_file = False
+        self.writer_task = None
+        self._wakeup = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self.stats = SessionStats()
+        # First history seq this client saw live; replay stops below it.
+        self.history_from = None
+        # The Room this chat connection is in, and its user handle if it has one.
+        self.room = None
+        self.name = None
+        # Set once COMPRESS is agreed: our stream to the client, its stream
+        # to us, and whether it follows its room's shared stream right now.
+        self.deflate = None
+        self.inflate = None
+        self.shared_synced = False
+        # When the PING still waiting for an answer went out (time.time()).
+        self.ping_sent = None
+        # Counted against the connection caps; rate limits (None: no limit),
+        # whether the client was told it is over its message rate, and
+        # whether reading is paused until its upload rate allows more.
+        self.admitted = False
+        self.message_bucket = None
+        self.upload_bucket = None
+        self.rate_noticed = False
+        self._throttled = False
+        # In a cluster, the name asked for with NAME until the hub grants or
+        # refuses it. Reading stops meanwhile, and frames that came inflated
+        # out of the same DEFLATE frame wait in ``held``.
+        self.pending_name = None
+        self.held = collections.deque()
+
+    @property
+    def version(self):
+        return self.reader.version or 1
+
+    @property
+    def label(self):
+        """How other users see this client: its handle, or its address until it has one."""
+        return self.name or str(self.addr)
+
+    @property
+    def ip(self):
+        """The client's address without the port; None off TCP (a socketpair)."""
+        return self.addr[0] if isinstance(self.addr, tuple) else None
+
+    @property
+    def member(self):
+        """The chat connection this one belongs to (itself unless a data connection)."""
+        return self.control or self
+
+    # ---- asyncio protocol callbacks
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        self.sock = sendmsg_socket(transport)
+        self.writer_task = asyncio.ensure_future(self.write_loop())
+        self.server._client_connected(self)
+
+    def get_buffer(self, sizehint):
+        upload = self.upload
+        # Mid-upload with nothing left to parse: receive the body straight
+        # into the upload's block buffer, never past the end of the file.
+        if upload and self.reader.body_left and self.reader.start == self.reader.end and upload.can_receive:
+            self._into_upload = True
+            return upload.writable()
+        self._into_upload = False
+        return self.reader.writable()
+
+    def buffer_updated(self, nbytes):
+        stats = self.stats
+        stats.bytes_in += nbytes
+        stats.last_active = time.time()
+        if self._into_upload:
+            stats.upload_bytes += nbytes
+            self.server.upload_bytes += nbytes
+            self.server._pace_upload(self, nbytes)
+            self.reader.body_left -= nbytes
+            if self.upload.commit(nbytes):
+                self.pump_upload()
+            return
+        self.reader.commit(nbytes)
+        self._process_frames()
+
+    def _process_frames(self):
+        if self.pending_name is not None:
+            return
+        try:
+            while self.held:
+                kind, payload = self.held.popleft()
+                self.server._dispatch(self, kind, payload)
+                if self.closed or self.pending_name is not None:
+                    return
+            for kind, payload in self.reader.events():
+                self.server._dispatch(self, kind, payload)
+                if self.closed or self._disk_wait or self.pending_name is not None:
+                    break
+        except Exception as e:
+            self.server.log(f"⚠️ Connection error with {self.addr}: {e}", "error")
+            self.close(abort=True)
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self._wakeup.set()
+        self._writable.set()
+        if self.writer_task:
+            self.writer_task.cancel()
+        self.server._client_disconnected(self)
+
+    # ---- upload disk writes
+
+    def pump_upload(self):
+        """Keep the upload's blocks moving to disk; stop reading while the disk is behind."""
+        upload = self.upload
+        future = upload.submit(self.server.disk)
+        if future is not None:
+            loop = self.server.loop
+            future.add_done_callback(
+                lambda f: loop.call_soon_threadsafe(self._block_written, upload, f))
+        if not upload.can_receive or not upload.remaining:
+            # Out of buffers, or the body is complete and the next frame must
+            # wait until it is on disk.
+            if not self._disk_wait and not self.closed:
+                self._disk_wait = True
+                self.transport.pause_reading()
+
+    def _block_written(self, upload, future):
+        if upload is not self.upload or upload.inflight is not future:
+            return  # already waited for by close() or write()
+        try:
+            upload.block_done()
+        except OSError as e:
+            self.server.log(f"⚠️ Could not save upload from {self.member.addr}: {e}", "error")
+            self.close(abort=True)
+            return
+        if upload.written:
+            self.server._finish_upload(self)
+        else:
+            self.pump_upload()
+            if not upload.can_receive or not upload.remaining:
+                return
+        if self._disk_wait and not self.closed:
+            self._disk_wait = False
+            if not self._throttled and self.pending_name is None:
+                self.transport.resume_reading()
+            # Frames that arrived behind the upload body.
+            self._process_frames()
+
+    def wait_disk(self, future, then):
+        """Read nothing until ``future`` (disk work on a worker thread) is done, then call ``then()``."""
+        self._disk_wait = True
+        self.transport.pause_reading()
+        future.add_done_callback(lambda f: self._disk_done(f, then))
+
+    def _disk_done(self, future, then):
+        if self.closed:
+            return
+        try:
+            future.result()
+        except OSError as e:
+            self.server.log(f"⚠️ Disk error for {self.member.addr}: {e}", "error")
+            self.close(abort=True)
+            return
+        self._disk_wait = False
+        then()
+        if self.closed or self._disk_wait:
+            return
+        if not self._throttled and self.pending_name is None:
+            self.transport.resume_reading()
+        self._process_frames()
+
+    def throttle(self, delay):
+        """Stop reading for ``delay`` seconds: the client uploads faster than its rate."""
+        if self._throttled or self.closed:
+            return
+        self._throttled = True
+        self.transport.pause_reading()
+        self.server.loop.call_later(delay, self._unthrottle)
+
+    def _unthrottle(self):
+        self._throttled = False
+        if not self._disk_wait and not self.closed and self.pending_name is None:
+            self.transport.resume_reading()
+
+    def await_name(self, name):
+        """Stop reading until the cluster hub answers the claim on ``name``."""
+        self.pending_name = name
+        if not self.closed:
+            self.transport.pause_reading()
+
+    def name_settled(self):
+        """The hub answered: go on with the held frames, then with the socket."""
+        self.pending_name = None
+        if self.closed or self._disk_wait:
+            return
+        if not self._throttled:
+            self.transport.resume_reading()
+        self._process_frames()
+
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+    # ---- outbound
+
+    def enqueue(self, data):
+        """Queue a frame for the writer task; returns False past the high-water mark."""
+        if self.closed:
+            return True
+        if len(self.queue) >= self.max_queue:
+            # During a download the transport takes no writes until sendfile
+            # finishes, so a full queue cannot be flushed now either.
+            if self.sending_file or not self._writable.is_set():
+                return False
+            # A burst filled the queue before the writer task got a turn, but
+            # the socket is not backed up: send the batch now.
+            self.flush()
+        self.queue.append(data)
+        self._wakeup.set()
+        return True
+
+    def send(self, kind, payload):
+        """Queue one frame, compressed if this client asked for that; False if it was dropped."""
+        if self.deflate is not None and kind in CHAT_KINDS:
+            return self.send_packed(proto.encode_v2(kind, payload))
+        return self.enqueue(proto.encode(self.version, kind, payload))
+
+    def send_all(self, frames):
+        """Queue (kind, payload) frames in order; stops at the first one dropped."""
+        if self.deflate is None:
+            return all(self.send(kind, payload) for kind, payload in frames)
+        batch = []
+        size = 0
+        for kind, payload in frames:
+            batch.append(proto.encode_v2(kind, payload))
+            size += len(batch[-1])
+            if size >= PACK_MAX:
+                if not self.send_packed(b"".join(batch)):
+                    return False
+                batch = []
+                size = 0
+        return not batch or self.send_packed(b"".join(batch))
+
+    def send_packed(self, frames):
+        """Queue encoded v2 frames compressed in this client's own stream."""
+        flags, data = self.deflate.pack(frames)
+        packed = proto.encode_v2(DEFLATE, bytes((flags,)) + data)
+        self.server._count_deflate(len(frames), len(packed))
+        if self.enqueue(packed):
+            return True
+        # The client never sees this frame, so the next one has to start over.
+        self.deflate.reset()
+        return False
+
+    def enqueue_file(self, header, file_range):
+        """Queue a FILEDATA header and the file bytes that must follow it; False past the high-water mark."""
+        if self.closed:
+            return True
+        if len(self.queue) >= self.max_queue:
+            return False
+        self.queue.append(header)
+        self.queue.append(file_range)
+        self.pending_files += 1
+        self._wakeup.set()
+        return True
+
+    async def write_loop(self):
+        try:
+            while not self.closed:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self.queue and not self.closed:
+                    if isinstance(self.queue[0], FileRange):
+                        await self._send_file(self.queue.popleft())
+                        continue
+                    self.flush()
+                    await self._writable.wait()
+                    if self.lagging and len(self.queue) < self.max_queue // 2:
+                        self.server._lag_recovered(self)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.close(abort=True)
+
+    async def _send_file(self, item):
+        self.pending_files -= 1
+        self.sending_file = True
+        started = time.perf_counter()
+        try:
+            with open(item.path, "rb") as f:
+                # os.sendfile() under the hood: the kernel copies page cache
+                # to socket, nothing passes through Python.
+                sent = await asyncio.get_running_loop().sendfile(
+                    self.transport, f, item.offset, item.length)
+            if sent != item.length:
+                raise OSError(f"file changed during transfer ({sent}/{item.length} bytes)")
+        except (OSError, RuntimeError) as e:
+            # The peer is now mid-body with no way to resync.
+            self.server.log(f"⚠️ Download of {item.name} to {self.member.addr} failed: {e}", "error")
+            self.close(abort=True)
+            return
+        finally:
+            self.sending_file = False
+        self.stats.bytes_out += item.length
+        self.server._download_done(self, item, time.perf_counter() - started)
+
+    def flush(self):
+        """Write everything queued with as few syscalls as possible."""
+        if self.pending_files:
+            # Only the frames in front of the next queued file may go now.
+            batch = []
+            while self.queue and not isinstance(self.queue[0], FileRange):
+                batch.append(self.queue.popleft())
+        else:
+            batch = list(self.queue)
+            self.queue.clear()
+        self.stats.frames_out += len(batch)
+        self.stats.bytes_out += sum(map(len, batch))
+        if self.sock is not None and not self.transport.get_write_buffer_size():
+            # Scatter-gather straight from the shared frame buffers: one
+            # sendmsg() per IOV_MAX frames, no joining into a new bytes object.
+            while batch:
+                head = batch[:IOV_MAX]
+                try:
+                    sent = self.sock.sendmsg(head)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    self.close(abort=True)
+                    return
+                sent_frames = 0
+                for frame in head:
+                    if sent < len(frame):
+                        break
+                    sent -= len(frame)
+                    sent_frames += 1
+                del batch[:sent_frames]
+                if sent:
+                    batch[0] = memoryview(batch[0])[sent:]
+                if sent_frames < len(head):
+                    break  # kernel buffer full; the transport takes the rest
+        if batch:
+            self.transport.writelines(batch)
+
+    def close(self, abort=False):
+        # abort=True drops whatever is still buffered instead of waiting for a
+        # peer that may never read it.
+        if not abort and not self.closed and self.transport and not self.pending_files and not self.sending_file:
+            self.flush()  # e.g. the ERROR that explains why
+        self.closed = True
+        self._wakeup.set()
+        if self.transport:
+            if abort:
+                self.transport.abort()
+            else:
+                self.transport.close()
+
+
+class ChatServer:
+    """asyncio chat server speaking the MSG/FILE/NOTIFY protocol (v1 and v2).
+
+    Every connection is a protocol object on one event loop instead of a
+    thread, so idle clients only cost a socket and a few KB of buffers. The loop
+    runs in a background thread; the *_threadsafe methods may be called
+    from any other thread (e.g. the Tk control panel).
+    """
+
+    def __init__(self, host=HOST, port=PORT, upload_dir=UPLOAD_DIR, backlog=BACKLOG,
+                 observer=None, max_queue=MAX_QUEUE, slow_policy=SLOW_POLICY,
+                 upload_buffer=UPLOAD_BUFFER, metrics_host=METRICS_HOST, metrics_port=None,
+                 history_path=None, compression=True, cluster=None, federation=None,
+                 heartbeat=HEARTBEAT, idle_timeout=IDLE_TIMEOUT, keepalive=KEEPALIVE_IDLE,
+                 max_connections=MAX_CONNECTIONS, max_per_ip=MAX_PER_IP, message_rate=MESSAGE_RATE,
+                 message_burst=MESSAGE_BURST, upload_rate=UPLOAD_RATE):
+        if slow_policy not in ("drop", "lag"):
+            raise ValueError(f"slow_policy must be 'drop' or 'lag', not {slow_policy!r}")
+        if heartbeat and idle_timeout <= heartbeat:
+            raise ValueError(f"idle_timeout ({idle_timeout}s) must be longer than heartbeat ({heartbeat}s)")
+        self.host = host
+        self.port = port
+        self.upload_dir = upload_dir
+        self.backlog = backlog
+        self.observer = observer or ServerObserver()
+        self.max_queue = max_queue
+        self.slow_policy = slow_policy
+        # Rounded up to whole 4 KiB pages so every flush but the last is aligned.
+        self.upload_buffer = max(4096, -(-upload_buffer // 4096) * 4096)
+        # Whether clients may negotiate COMPRESS.
+        self.compression = compression
+        # This process is one worker of several (chat_cluster.ClusterLink).
+        self.cluster = cluster
+        # Links to other servers that broadcasts are relayed with
+        # (chat_federation.Federation); a cluster's hub holds them instead.
+        self.federation = federation
+        # Seconds of silence before a PING and before a connection is reaped
+        # (0: neither), and before TCP keepalive probes start (0: off).
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.heartbeats = TimerWheel(self._check_idle)
+        # Admission control (chat_limits); 0 turns a cap or rate off.
+        self.limits = ConnectionLimits(max_connections, max_per_ip)
+        self.message_rate = message_rate
+        self.message_burst = max(message_burst, 1)
+        self.upload_rate = upload_rate
+        self._upload_buffers = []
+        self.disk = concurrent.futures.ThreadPoolExecutor(DISK_THREADS, thread_name_prefix="chat-disk")
+
+        self.clients = {}
+        # Room name -> Room. The default room always exists; the others go
+        # away with their last member.
+        self.rooms = {DEFAULT_ROOM: Room(DEFAULT_ROOM)}
+        # User handle -> chat session, for direct messages.
+        self.users = {}
+        # Handles asked for but not yet granted by the cluster hub -> session.
+        self.claims = {}
+        self.data_sessions = {}
+        self.data_tokens = {}
+        self.message_count = 0
+        self.direct_count = 0
+        self.file_count = 0
+        self.dropped_clients = 0
+        self.reaped_count = 0
+        self.throttled_messages = 0
+        self.upload_throttles = 0
+        self.ping_count = 0
+        self.accepted_count = 0
+        self.dropped_frames = 0
+        self.upload_bytes = 0
+        self.download_bytes = 0
+        # Chat frame bytes that went out compressed, before and after.
+        self.deflate_raw_bytes = 0
+        self.deflate_bytes = 0
+        # Same for upload chunks that came in compressed.
+        self.upload_deflate_raw_bytes = 0
+        self.upload_deflate_bytes = 0
+        self.lock = threading.Lock()
+        self.running = False
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self._ids = itertools.count(1)
+        self._stopped = None
+
+        os.makedirs(upload_dir, exist_ok=True)
+        self.partials = UploadStore(upload_dir)
+        # Every broadcast MSG is kept; "" turns history off.
+        if history_path is None:
+            history_path = default_history_path(upload_dir)
+        # A history kept in the upload folder (by --history, or one an older
+        # version left behind) must never be offered for download.
+        reserved = [os.path.join(upload_dir, HISTORY_FILE) + suffix for suffix in SQLITE_SUFFIXES]
+        if history_path:
+            reserved += [history_path + suffix for suffix in SQLITE_SUFFIXES]
+        # A cluster's hub writes the blob index and names the files.
+        self.blobs = BlobStore(upload_dir, on_change=self._blobs_changed, reserved=reserved,
+                               writer=cluster is None)
+        # The pending index write: a timer handle, then its future.
+        self._index_flush = None
+        # A cluster's supervisor writes the history; its workers only read it.
+        self.history = ChatHistory(history_path, writer=cluster is None) if history_path else None
+
+        # Served over HTTP only when a metrics port is given.
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.metrics = Registry()
+        self._register_metrics()
+
+    def _register_metrics(self):
+        m = self.metrics
+        m.counter("chat_connections_accepted_total", "Connections accepted, chat and data",
+                  lambda: self.accepted_count)
+        m.counter("chat_messages_total", "Chat messages relayed", lambda: self.message_count)
+        m.counter("chat_direct_messages_total", "Direct messages delivered", lambda: self.direct_count)
+        m.counter("chat_files_total", "Files received", lambda: self.file_count)
+        m.counter("chat_upload_bytes_total", "File bytes received", lambda: self.upload_bytes)
+        m.counter("chat_download_bytes_total", "File bytes sent", lambda: self.download_bytes)
+        m.counter("chat_deflate_raw_bytes_total", "Chat frame bytes sent compressed, before compression",
+                  lambda: self.deflate_raw_bytes)
+        m.counter("chat_deflate_bytes_total", "Chat frame bytes sent compressed, as sent",
+                  lambda: self.deflate_bytes)
+        m.counter("chat_upload_deflate_raw_bytes_total", "File bytes received compressed, after inflating",
+                  lambda: self.upload_deflate_raw_bytes)
+        m.counter("chat_upload_deflate_bytes_total", "File bytes received compressed, as sent",
+                  lambda: self.upload_deflate_bytes)
+        m.counter("chat_dropped_clients_total", "Slow consumers disconnected", lambda: self.dropped_clients)
+        m.counter("chat_dropped_frames_total", "Frames not queued for a slow consumer",
+                  lambda: self.dropped_frames)
+        m.gauge("chat_clients", "Connected chat clients", self.client_count)
+        m.gauge("chat_data_connections", "Attached data connections", lambda: len(self.data_sessions))
+        m.gauge("chat_rooms", "Rooms with at least one member, plus the default room", lambda: len(self.rooms))
+        m.gauge("chat_named_users", "Chat clients with a user handle", lambda: len(self.users))
+        m.gauge("chat_lagging_clients", "Chat clients over their queue limit", self.lagging_count)
+        m.gauge("chat_send_queue_frames", "Frames queued for all chat clients",
+                lambda: self._queue_depths()[0])
+        m.gauge("chat_send_queue_max_frames", "Longest outbound queue of any chat client",
+                lambda: self._queue_depths()[1])
+        self.broadcast_seconds = m.histogram(
+            "chat_broadcast_seconds", "Time to queue one broadcast for every recipient")
+        if self.history:
+            m.counter("chat_history_commits_total", "History write transactions",
+                      lambda: self.history.batches)
+            m.gauge("chat_history_backlog", "History messages waiting for their commit",
+                    lambda: self.history.backlog)
+        if self.federation:
+            federation = self.federation
+            m.counter("chat_federation_relayed_total", "Broadcasts sent to federation peers",
+                      lambda: federation.relayed)
+            m.counter("chat_federation_received_total", "Broadcasts from federation peers delivered here",
+                      lambda: federation.received)
+            m.counter("chat_federation_duplicates_total", "Relayed broadcasts dropped as seen before",
+                      lambda: federation.duplicates)
+            m.gauge("chat_federation_peers", "Linked federation peers", lambda: len(federation.links))
+        m.counter("chat_heartbeat_pings_total", "PINGs sent to quiet connections", lambda: self.ping_count)
+        m.counter("chat_idle_reaped_total", "Connections closed for not answering PING",
+                  lambda: self.reaped_count)
+        m.counter("chat_connections_refused_total", "Connections refused by the connection caps",
+                  lambda: self.limits.refused)
+        m.counter("chat_messages_throttled_total", "Chat lines refused for going over the message rate",
+                  lambda: self.throttled_messages)
+        m.counter("chat_upload_throttles_total", "Times reading paused for going over the upload rate",
+                  lambda: self.upload_throttles)
+        self.heartbeat_rtt = m.histogram("chat_heartbeat_rtt_seconds", "Time from PING to its PONG")
+        self.broadcast_recipients = m.histogram(
+            "chat_broadcast_recipients", "Clients each broadcast was queued for", (1, 10, 100, 1000, 10000))
+
+    # ---------------------------------------------------------------- lifecycle
+
+    def log(self, text, level="info"):
+        self.observer.log(text, level)
+
+    async def serve(self, ready=None):
+        """Bind, accept until stop() is called, then close every client."""
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self.heartbeats.start()
+        if self.cluster:
+            await self.cluster.connect(self)
+        if self.federation:
+            await self.federation.start(self)
+        self.server = await self.loop.create_server(
+            lambda: ClientSession(self, next(self._ids), self.max_queue),
+            self.host, self.port, backlog=self.backlog, reuse_address=True,
+            reuse_port=True if self.cluster else None)
+        self.running = True
+        worker = f" (worker {self.cluster.worker})" if self.cluster else ""
+        self.log(f"Server started successfully on {self.host}:{self.port}{worker}", "success")
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, self.metrics_host, self.metrics_port)
+            self.metrics_server.start()
+            host, port = self.metrics_server.address[:2]
+            self.log(f"📈 Metrics at http://{host}:{port}/metrics", "system")
+        if ready:
+            ready()
+        try:
+            await self._stopped.wait()
+        finally:
+            self.running = False
+            self.heartbeats.stop()
+            self.server.close()
+            with self.lock:
+                sessions = list(self.clients.values()) + list(self.data_sessions.values())
+                self.clients.clear()
+                self.data_sessions.clear()
+                self.rooms = {DEFAULT_ROOM: Room(DEFAULT_ROOM)}
+                self.users.clear()
+                self.claims.clear()
+            for session in sessions:
+                session.close(abort=True)
+            # Let the writer tasks see their connections go before the loop does.
+            writers = [s.writer_task for s in sessions if s.writer_task]
+            if writers:
+                await asyncio.wait(writers, timeout=5)
+            await self.server.wait_closed()
+            if isinstance(self._index_flush, asyncio.TimerHandle):
+                self._index_flush.cancel()
+            self.disk.shutdown(wait=True)
+            try:
+                self.blobs.flush()
+            except OSError as e:
+                self.log(f"⚠️ Cannot save the blob index: {e}", "error")
+            if self.metrics_server:
+                self.metrics_server.stop()
+                self.metrics_server = None
+            if self.history:
+                self.history.close()
+            if self.cluster:
+                self.cluster.close()
+            if self.federation:
+                self.federation.close()
+            self.log("Server stopped successfully", "system")
+
+    def start(self):
+        """Run serve() on a daemon thread; raises if the port cannot be bound."""
+        raise_fd_limit()
+        started = threading.Event()
+        error = []
+
+        def runner():
+            try:
+                asyncio.run(self.serve(ready=started.set))
+            except Exception as e:
+                error.append(e)
+            finally:
+                started.set()
+
+        self.thread = threading.Thread(target=runner, daemon=True)
+        self.thread.start()
+        started.wait()
+        if error:
+            raise error[0]
+
+    def stop(self):
+        if self.loop and self._stopped:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+
+    # ---------------------------------------------------------------- registry
+
+    def clients_snapshot(self):
+        with self.lock:
+            return [(s.id, s.addr, s.lagging, s.name) for s in self.clients.values()]
+
+    def traffic_snapshot(self):
+        """A ClientTraffic record per chat client."""
+        with self.lock:
+            return [self._traffic(s) for s in self.clients.values()]
+
+    def rooms_snapshot(self):
+        """A RoomInfo record per room."""
+        with self.lock:
+            return [RoomInfo(r.name, len(r.members), r.messages) for r in self.rooms.values()]
+
+    def client_info(self, cid):
+        """ClientTraffic of a connected chat client, or None if it has gone."""
+        with self.lock:
+            session = self.clients.get(cid)
+            return self._traffic(session) if session else None
+
+    @staticmethod
+    def _traffic(session):
+        stats = session.stats
+        return ClientTraffic(session.id, session.addr, session.lagging, len(session.queue),
+                             stats.connected_at, stats.last_active, stats.bytes_in, stats.bytes_out,
+                             stats.frames_in, stats.frames_out, stats.messages, stats.upload_bytes,
+                             session.room.name if session.room else "", session.name, stats.throttled)
+
+    def client_count(self):
+        with self.lock:
+            return len(self.clients)
+
+    def lagging_count(self):
+        with self.lock:
+            return sum(1 for s in self.clients.values() if s.lagging)
+
+    def _queue_depths(self):
+        """(total, longest) outbound queue length over all chat clients."""
+        with self.lock:
+            depths = [len(s.queue) for s in self.clients.values()]
+        return sum(depths), max(depths, default=0)
+
+    def disconnect(self, cid):
+        with self.lock:
+            session = self.clients.get(cid)
+        if session:
+            self.loop.call_soon_threadsafe(session.close, True)
+        return session.addr if session else None
+
+    # ---------------------------------------------------------------- fan-out
+
+    def broadcast(self, kind, text, exclude=None, room=None):
+        # Must run on the loop thread. Only enqueues: each client's writer task
+        # does the actual socket writes, so a slow client delays nobody else.
+        # The frame is encoded once per wire version and shared by all queues,
+        # and compressed once per room for the clients that compress.
+        # With a room only its members are visited, not every client.
+        if self.cluster:
+            # Delivered here too, once the hub sends it back in cluster order.
+            self.cluster.publish(kind, text, exclude, room)
+            return
+        if kind == MSG and self.history:
+            self.history.append(text, room.name if room else "")
+        self._fan_out(kind, text, exclude, room)
+        if self.federation:
+            self.federation.relay(kind, text, room.name if room else "")
+
+    def _deliver_published(self, seq, when, own, exclude_id, kind, room_name, text):
+        """A broadcast from the cluster hub, in the order every worker gets it."""
+        if seq and self.history:
+            self.history.record(seq, when, text, room_name)
+        room = None
+        if room_name:
+            room = self.rooms.get(room_name)
+            if room is None:
+                return  # nobody here is in that room
+        exclude = self.clients.get(exclude_id) if own else None
+        self._fan_out(kind, text, exclude, room)
+
+    def _deliver_federated(self, kind, text, room_name):
+        """A broadcast relayed from another server (see chat_federation)."""
+        if kind == MSG and self.history:
+            self.history.append(text, room_name)
+        room = None
+        if room_name:
+            room = self.rooms.get(room_name)
+            if room is None:
+                return  # nobody here is in that room
+        self._fan_out(kind, text, None, room)
+
+    def _fan_out(self, kind, text, exclude, room):
+        started = time.perf_counter()
+        frame = proto.Frame(kind, text.encode())
+        recipients = 0
+        for r in [room] if room else list(self.rooms.values()):
+            with self.lock:
+                sessions = list(r.members.values())
+            recipients += len(sessions)
+            packed = None
+            for session in sessions:
+                if session.deflate is None or kind not in CHAT_KINDS:
+                    if session is not exclude:
+                        self._deliver(session, frame.encoded(session.version))
+                    continue
+                if packed is None:
+                    packed = self._pack_shared(r, frame, sessions)
+                if not session.shared_synced:
+                    # Out of step with the room's stream until its next reset.
+                    if session is not exclude and not session.send(kind, frame.payload):
+                        self._overflow(session)
+                elif not self._deliver(session, packed[session is exclude]):
+                    session.shared_synced = False
+        self.broadcast_seconds.observe(time.perf_counter() - started)
+        self.broadcast_recipients.observe(recipients)
+
+    def _pack_shared(self, room, frame, sessions):
+        """``(frame, echo frame)``: ``frame`` compressed once in the room's stream."""
+        stream = room.stream
+        if stream.reset_pending:
+            # Whoever compresses starts the new stream with this frame.
+            for session in sessions:
+                if session.deflate is not None:
+                    session.shared_synced = True
+        raw = frame.encoded(2)
+        flags, data = stream.pack(raw)
+        packed = proto.encode_v2(DEFLATE, bytes((flags,)) + data)
+        # The sender inflates its own line too, to stay in step, but does not show it.
+        echo = proto.encode_v2(DEFLATE, bytes((flags | ECHO,)) + data)
+        synced = sum(1 for s in sessions if s.shared_synced)
+        self._count_deflate(len(raw) * synced, len(packed) * synced)
+        return packed, echo
+
+    def _count_deflate(self, raw, sent):
+        self.deflate_raw_bytes += raw
+        self.deflate_bytes += sent
+
+    def _deliver(self, session, data):
+        if session.enqueue(data):
+            return True
+        self._overflow(session)
+        return False
+
+    def _overflow(self, session):
+        session.dropped_frames += 1
+        self.dropped_frames += 1
+        if self.slow_policy == "drop":
+            self.dropped_clients += 1
+            self.log(f"🐢 Dropping slow client {session.addr}: "
+                     f"{len(session.queue)} frames queued", "warning")
+            session.close(abort=True)
+        elif not session.lagging:
+            session.lagging = True
+            self.log(f"🐢 {session.addr} is lagging: outbound queue full", "warning")
+            self.observer.clients_changed()
+
+    def _lag_recovered(self, session):
+        session.lagging = False
+        if session.deflate is not None and session.room is not None:
+            # Back in step with the room's stream from its next frame on.
+            session.room.stream.reset()
+        self.log(f"{session.addr} caught up after dropping {session.dropped_frames} frame(s)", "system")
+        self.observer.clients_changed()
+
+    def broadcast_threadsafe(self, kind, text):
+        self.loop.call_soon_threadsafe(self.broadcast, kind, text)
+
+    # ---------------------------------------------------------------- per client
+
+    def _client_connected(self, session):
+        # Receives chat right away; announced once we know it isn't a data connection.
+        self.accepted_count += 1
+        reason = self.limits.admit(session.ip)
+        if reason:
+            self.log(f"⛔ Refused {session.addr}: {reason}", "warning")
+            # Before HELLO, so as a v1 line; a v2 client reads that too. What
+            # it sends meanwhile is read and dropped, so that closing does not
+            # reset the connection before the client has read why.
+            session.enqueue(proto.encode(1, ERROR, f"Connection refused: {reason}".encode()))
+            session.flush()
+            if session.transport.can_write_eof():
+                session.transport.write_eof()
+            self.loop.call_later(REFUSE_LINGER, session.close, True)
+            return
+        session.admitted = True
+        now = self.loop.time()
+        if self.message_rate:
+            session.message_bucket = TokenBucket(self.message_rate, self.message_burst, now)
+        if self.upload_rate:
+            session.upload_bucket = TokenBucket(self.upload_rate, self.upload_rate, now)
+        if self.keepalive:
+            set_keepalive(session.transport.get_extra_info("socket"), self.keepalive)
+        if self.heartbeat:
+            self.heartbeats.add(session, self.heartbeat)
+        with self.lock:
+            self.clients[session.id] = session
+        self._enter_room(session, self.rooms[DEFAULT_ROOM])
+        session.join_timer = self.loop.call_later(ATTACH_GRACE, self._join, session)
+
+    def _join(self, session):
+        if session.join_timer:
+            session.join_timer.cancel()
+            session.join_timer = None
+        if session.joined or session.closed or session.control is not None:
+            return
+        if session.pending_name is not None:
+            return  # joins once the hub has answered for its name
+        session.joined = True
+        self.log(f"✅ {session.addr} connected.", "success")
+        self.observer.clients_changed()
+        self.broadcast(NOTIFY, f"Server: {session.label} joined the chat.", room=session.room)
+
+    def _message_allowed(self, session, kind):
+        """Charge one chat line to the client's message rate; False if it is over."""
+        bucket = session.message_bucket
+        if bucket is None or bucket.take(self.loop.time()):
+            session.rate_noticed = False
+            return True
+        session.stats.throttled += 1
+        self.throttled_messages += 1
+        if not session.rate_noticed:
+            # Once per run of refused lines, so a flood gets no flood back.
+            session.rate_noticed = True
+            self.log(f"🚦 {session.addr} is over the message rate; refusing its messages", "warning")
+            self._send_error(session, f"{proto.KIND_NAMES[kind]}: not sent, too many messages "
+                                      f"(limit {self.message_rate:g} per second)")
+        return False
+
+    def _pace_upload(self, session, nbytes):
+        """Charge upload bytes to the client's upload rate; pause reading if it is over."""
+        bucket = session.member.upload_bucket
+        if bucket is None:
+            return
+        delay = bucket.debit(self.loop.time(), nbytes)
+        if delay > 0 and not session._throttled:
+            session.stats.throttled += 1
+            self.upload_throttles += 1
+            session.throttle(delay)
+
+    def _check_idle(self, session):
+        """Timer wheel callback: PING a quiet connection, reap one that stays silent."""
+        if session.closed:
+            return
+        now = time.time()
+        heard = session.stats.last_active
+        if session.ping_sent is not None and heard >= session.ping_sent:
+            session.ping_sent = None  # answered, by PONG or anything else
+        quiet = now - heard
+        if quiet < self.heartbeat:
+            self.heartbeats.add(session, self.heartbeat - quiet)
+        elif session.queue or session.sending_file or session.transport.get_write_buffer_size():
+            # Still sending to it: a PING would wait behind that, and TCP
+            # finds out soon enough if nobody acknowledges it.
+            session.ping_sent = None
+            self.heartbeats.add(session, self.heartbeat)
+        elif session.ping_sent is not None and quiet >= self.idle_timeout:
+            self.reaped_count += 1
+            what = "data connection" if session.control is not None else "client"
+            self.log(f"💤 Closing {what} {session.addr}: silent for {quiet:.0f}s, "
+                     f"no answer to PING", "warning")
+            session.close(abort=True)
+        elif session.reader.version != 2:
+            # v1 cannot answer PING; TCP keepalive has to find a dead one.
+            self.heartbeats.add(session, self.heartbeat)
+        elif session.ping_sent is None:
+            session.ping_sent = now
+            self.ping_count += 1
+            session.send(PING, b"%d" % self.ping_count)
+            self.heartbeats.add(session, self.idle_timeout - self.heartbeat)
+        else:
+            self.heartbeats.add(session, self.idle_timeout - quiet)
+
+    def _client_disconnected(self, session):
+        self.heartbeats.discard(session)
+        if session.admitted:
+            self.limits.release(session.ip)
+        if session.join_timer:
+            session.join_timer.cancel()
+            session.join_timer = None
+        with self.lock:
+            self.clients.pop(session.id, None)
+            attached = self.data_sessions.pop(session.id, None) is not None
+            if session.name and self.users.get(session.name) is session:
+                del self.users[session.name]
+                if self.cluster:
+                    self.cluster.release(session, session.name)
+            if session.pending_name is not None:
+                # The hub may grant it yet; this hands it back.
+                self.claims.pop(session.pending_name, None)
+                self.cluster.release(session, session.pending_name)
+        room = self._leave_room(session)
+        if isinstance(session.upload, ChunkUpload):
+            upload, session.upload = session.upload, None
+            self._close_upload(upload)
+            partial = upload.partial
+            partial.rollback()
+            self.log(f"⚠️ Upload of {partial.name} from {session.member.addr} interrupted "
+                     f"at {partial.offset}/{partial.size} bytes, resumable as {partial.id}", "warning")
+        elif session.upload:
+            upload, session.upload = session.upload, None
+            self._close_upload(upload)
+            try:
+                os.remove(upload.path)
+            except OSError:
+                pass
+            self.log(f"⚠️ Upload of {upload.name} from {session.member.addr} interrupted "
+                     f"at {upload.received}/{upload.size} bytes", "warning")
+        self.partials.release(session)
+        for data in session.attached:
+            data.close(abort=True)
+        if attached:
+            session.control.attached.remove(session)
+            self.log(f"📎 Data connection of {session.control.addr} closed.", "system")
+        if not session.joined:
+            return
+        self.log(f"❌ {session.addr} disconnected.", "warning")
+        self.observer.clients_changed()
+        if self.running:
+            self.broadcast(NOTIFY, f"Server: {session.label} left the chat.", room=room)
+
+    def _dispatch(self, session, kind, payload):
+        if not session.admitted:
+            return  # refused, closing soon
+        if kind == BODY:
+            # No upload means a body we decided to skip.
+            if session.upload:
+                session.stats.upload_bytes += len(payload)
+                self.upload_bytes += len(payload)
+                self._pace_upload(session, len(payload))
+                if session.upload.write(payload):
+                    session.pump_upload()
+            return
+        session.stats.frames_in += 1
+        if session.reader.version is None:
+            # The first line picks the protocol: HELLO::2 opts into v2 framing.
+            if kind == HELLO and bytes(payload) == str(proto.PROTOCOL_VERSION).encode():
+                session.enqueue(proto.HELLO_LINE)
+                session.reader.version = 2
+                return
+            session.reader.version = 1
+        if kind == HELLO:
+            return
+        if kind == PING:
+            session.send(PONG, bytes(payload))
+            return
+        if kind == PONG:
+            if session.ping_sent is not None:
+                self.heartbeat_rtt.observe(time.time() - session.ping_sent)
+                session.ping_sent = None
+            return
+        if session.control is not None:
+            if kind in DATA_KINDS:
+                self._dispatch_file(session, kind, payload)
+            else:
+                self._send_error(session, f"{proto.KIND_NAMES.get(kind, kind)}: not allowed on a data connection")
+            return
+        if kind == ATTACH:
+            if session.joined:
+                self._send_error(session, "ATTACH: must come right after HELLO on a new connection")
+            else:
+                self._attach_data(session, str(payload, "utf-8", "replace"))
+            return
+        if kind == COMPRESS:
+            self._negotiate_compression(session, str(payload, "ascii", "replace"))
+            return
+        if kind == NAME:
+            # Registered before the join notice so that it already shows the handle.
+            self._register_name(session, str(payload, "utf-8", "replace"))
+            if not session.joined:
+                self._join(session)
+            return
+        if not session.joined:
+            self._join(session)
+        if kind in (MSG, DM) and not self._message_allowed(session, kind):
+            return
+        if kind == MSG:
+            self._relay_message(session, str(payload, "utf-8", "replace"))
+        elif kind in DATA_KINDS:
+            # Still accepted here for clients without a data connection.
+            self._dispatch_file(session, kind, payload)
+        elif kind == DATA:
+            self._issue_data_token(session)
+        elif kind == HISTORY:
+            self._send_history(session, str(payload, "ascii", "replace"))
+        elif kind == JOIN:
+            self._switch_room(session, str(payload, "utf-8", "replace"))
+        elif kind == LEAVE:
+            self._switch_room(session, DEFAULT_ROOM)
+        elif kind == ROOMS:
+            self._send_rooms(session)
+        elif kind == DM:
+            self._send_direct(session, str(payload, "utf-8", "replace"))
+        elif kind == DEFLATE:
+            self._inflate(session, payload)
+        else:
+            self.log(f"⚠️ Unknown frame type {kind} from {session.addr}", "warning")
+
+    def _dispatch_file(self, session, kind, payload):
+        text = str(payload, "utf-8", "replace")
+        if kind == FILE:
+            self._start_upload(session, text)
+        elif kind == GET:
+            self._start_download(session, text)
+        elif kind == CHUNK:
+            self._start_chunk(session, text)
+        elif kind == UPLOAD:
+            self._begin_resumable(session, text)
+        elif kind == RESUME:
+            self._resume_upload(session, text)
+
+    # ---------------------------------------------------------------- blob index
+
+    def _blobs_changed(self):
+        # Written once per INDEX_FLUSH_DELAY at most, and never on the loop
+        # thread while serving; stop() writes what is left.
+        if self._index_flush is None and self.running:
+            self._index_flush = self.loop.call_later(INDEX_FLUSH_DELAY, self._flush_index)
+
+    def _flush_index(self):
+        future = self.loop.run_in_executor(self.disk, self.blobs.write_index, self.blobs.snapshot())
+        self._index_flush = future
+        future.add_done_callback(self._index_written)
+
+    def _index_written(self, future):
+        self._index_flush = None
+        try:
+            future.result()
+        except (OSError, asyncio.CancelledError) as e:
+            self.log(f"⚠️ Cannot save the blob index: {e}", "error")
+            self.blobs.dirty = True
+        if self.blobs.dirty:
+            self._blobs_changed()
+
+    # ---------------------------------------------------------------- history
+
+    def _send_history(self, session, request):
+        # <count>[::<before seq>]
+        if not self.history:
+            self._send_error(session, "HISTORY: history is disabled on this server")
+            return
+        count, _, before = request.partition("::")
+        try:
+            count = int(count)
+            before = int(before) if before else session.history_from
+            if count < 1 or before < 1:
+                raise ValueError
+        except ValueError:
+            self._send_error(session, f"HISTORY: bad request {request!r}")
+            return
+        room = session.room.name
+        entries, below, missing = self.history.recent_page(count, before, room)
+        if not missing:
+            self._replay(session, entries, count)
+            return
+        # Older than what is in memory: read it on a worker so fan-out carries on.
+        future = self.loop.run_in_executor(self.disk, self.history.older, below, missing, room)
+        future.add_done_callback(lambda f: self._older_loaded(session, entries, count, f))
+
+    def _older_loaded(self, session, entries, count, future):
+        try:
+            older = future.result()
+        except Exception as e:
+            self.log(f"⚠️ Cannot read chat history for {session.addr}: {e}", "error")
+            self._send_error(session, "HISTORY: history is not available")
+            return
+        self._replay(session, older + entries, count)
+
+    def _replay(self, session, entries, count):
+        if session.closed:
+            return
+        frames = [(HISTORY, f"{seq}::{when:.3f}::{text}".encode()) for seq, when, text, _ in entries]
+        oldest = entries[0][0] if entries else 0
+        more = int(oldest > 1 and len(entries) == min(count, PAGE_MAX))
+        frames.append((HISTORY_END, f"{len(entries)}::{oldest}::{more}".encode()))
+        # Straight into the queue: replay may fill it but never counts as lag.
+        session.send_all(frames)
+
+    # ---------------------------------------------------------------- rooms
+
+    def _enter_room(self, session, room):
+        with self.lock:
+            self.rooms.setdefault(room.name, room)
+            room.members[session.id] = session
+        session.room = room
+        if self.cluster:
+            self.cluster.room_changed(room)
+        if session.deflate is not None:
+            # Joins the room's stream at its next reset.
+            session.shared_synced = False
+            room.stream.reset()
+        if self.history:
+            # HISTORY without a seq replays what this room said before now.
+            session.history_from = self.history.next_seq
+
+    def _leave_room(self, session):
+        room, session.room = session.room, None
+        if room is None:
+            return None
+        with self.lock:
+            room.members.pop(session.id, None)
+            if not room.members and room.name != DEFAULT_ROOM:
+                self.rooms.pop(room.name, None)
+        if self.cluster:
+            self.cluster.room_changed(room)
+        return room
+
+    def _room_size(self, name):
+        """Members of a room, on every worker of a cluster."""
+        room = self.rooms.get(name)
+        size = len(room.members) if room else 0
+        return size + self.cluster.members(name) if self.cluster else size
+
+    def _switch_room(self, session, name):
+        name = proto.valid_name(name)
+        if name is None:
+            self._send_error(session, f"JOIN: room names are 1-{proto.NAME_MAX} "
+                                      f"letters, digits, '-', '_' or '.'")
+            return
+        if name != session.room.name:
+            old = self._leave_room(session)
+            self.broadcast(NOTIFY, f"Server: {session.label} left #{old.name}.", room=old)
+            self._enter_room(session, self.rooms.get(name) or Room(name))
+            self.broadcast(NOTIFY, f"Server: {session.label} joined #{name}.",
+                           exclude=session, room=session.room)
+            self.log(f"🏠 {session.addr} moved from #{old.name} to #{name}", "system")
+        session.enqueue(proto.Frame(JOIN, f"{name}::{self._room_size(name)}".encode())
+                        .encoded(session.version))
+
+    def _send_rooms(self, session):
+        with self.lock:
+            names = list(self.rooms)
+        if self.cluster:
+            names += [name for name in self.cluster.room_names() if name not in self.rooms]
+        fields = [f"{name}::{self._room_size(name)}" for name in names]
+        session.enqueue(proto.Frame(ROOMS, "::".join(fields).encode()).encoded(session.version))
+
+    # ---------------------------------------------------------------- users
+
+    def _register_name(self, session, text):
+        name = proto.valid_name(text)
+        if name is None:
+            self._send_error(session, f"NAME: names are 1-{proto.NAME_MAX} "
+                                      f"letters, digits, '-', '_' or '.'")
+            return
+        owner = self.users.get(name) or self.claims.get(name)
+        if owner is not None and owner is not session:
+            self._send_error(session, f"NAME: {name} is taken")
+            return
+        if self.cluster and name != session.name:
+            # Only the hub knows the other workers' users. Nothing is read
+            # from this client until it answers, so no line goes out under
+            # a name that may turn out to be someone else's.
+            self.claims[name] = session
+            session.await_name(name)
+            self.cluster.claim(session, name)
+            return
+        self._take_name(session, name)
+
+    def _take_name(self, session, name):
+        old = session.label
+        with self.lock:
+            if session.name:
+                self.users.pop(session.name, None)
+            self.users[name] = session
+        if self.cluster and session.name and session.name != name:
+            self.cluster.release(session, session.name)
+        session.name = name
+        session.enqueue(proto.Frame(NAME, name.encode()).encoded(session.version))
+        self.log(f"🪪 {session.addr} is {name}", "system")
+        self.observer.clients_changed()
+        if session.joined and old != name:
+            self.broadcast(NOTIFY, f"Server: {old} is now {name}.", room=session.room)
+
+    def _send_direct(self, session, request):
+        # <user>::<text>; one dict lookup and one queue, nobody else is visited.
+        target, _, text = request.partition("::")
+        if not session.name:
+            self._send_error(session, "DM: take a name with NAME first")
+            return
+        name = proto.valid_name(target)
+        recipient = self.users.get(name)
+        if recipient is None or recipient.closed:
+            if self.cluster and name:
+                # Maybe on another worker; the hub knows, or answers NOUSER.
+                session.stats.messages += 1
+                self.cluster.direct(session, name, text)
+            else:
+                self._send_error(session, f"DM: {target} is not online")
+            return
+        session.stats.messages += 1
+        self._deliver_direct(recipient, session.name, text)
+
+    def _deliver_direct(self, recipient, sender, text):
+        self.direct_count += 1
+        if not recipient.send(DM, f"{sender}::{text}".encode()):
+            self._overflow(recipient)
+
+    def _direct_from_peer(self, sender, name, text):
+        recipient = self.users.get(name)
+        if recipient is not None and not recipient.closed:
+            self._deliver_direct(recipient, sender, text)
+
+    def _direct_missed(self, sid, name):
+        session = self.clients.get(sid)
+        if session is not None:
+            self._send_error(session, f"DM: {name} is not online")
+
+    def _name_answered(self, sid, name, granted):
+        """The hub's answer to a CLAIM (see chat_cluster)."""
+        session = self.clients.get(sid)
+        if session is None or session.pending_name != name:
+            return
+        del self.claims[name]
+        if granted:
+            self._take_name(session, name)
+        else:
+            # Another worker's client has it.
+            self._send_error(session, f"NAME: {name} is taken")
+        if not session.joined:
+            self._join(session)
+        session.name_settled()
+
+    # ---------------------------------------------------------------- compression
+
+    def _negotiate_compression(self, session, offer):
+        if session.version != 2:
+            self._send_error(session, "COMPRESS: needs protocol v2")
+            return
+        if not self.compression or DEFLATE_NAME not in offer.split("::"):
+            session.send(COMPRESS, b"")
+            return
+        # Answered uncompressed; everything after it may be compressed.
+        session.send(COMPRESS, DEFLATE_NAME.encode())
+        if session.deflate is None:
+            session.deflate = DeflateStream()
+            session.inflate = Inflater()
+            session.room.stream.reset()
+
+    def _inflate(self, session, payload):
+        if session.inflate is None:
+            raise proto.ProtocolError("DEFLATE before COMPRESS")
+        _, frames = session.inflate.unpack(payload)
+        for kind, _ in frames:
+            if kind not in INFLATE_KINDS:
+                raise proto.ProtocolError(f"{proto.KIND_NAMES.get(kind, kind)} inside DEFLATE")
+        for i, (kind, inner) in enumerate(frames):
+            self._dispatch(session, kind, inner)
+            if session.closed:
+                return
+            if session.pending_name is not None:
+                # The rest waits for the hub's answer, as the socket does.
+                session.held.extend(frames[i + 1:])
+                return
+
+    # ---------------------------------------------------------------- data connections
+
+    def _issue_data_token(self, session):
+        now = self.loop.time()
+        for token, (_, expires) in list(self.data_tokens.items()):
+            if expires < now:
+                del self.data_tokens[token]
+        token = secrets.token_urlsafe(16)
+        if self.cluster:
+            token = self.cluster.token(token)
+        self.data_tokens[token] = (session, now + DATA_TOKEN_TTL)
+        session.enqueue(proto.Frame(DATA, token.encode()).encoded(session.version))
+
+    def _attach_data(self, session, token):
+        if self.cluster:
+            worker = self.cluster.token_worker(token)
+            if worker is not None and worker != self.cluster.worker:
+                # The kernel put it on this worker, its chat connection is on that one.
+                if not self.cluster.hand_off(session, token, worker):
+                    self._send_error(session, "ATTACH: could not reach the client's worker")
+                    session.close()
+                return
+        owner, expires = self.data_tokens.pop(token, (None, 0))
+        if owner is None or owner.closed or expires < self.loop.time():
+            self._send_error(session, "ATTACH: invalid or expired token")
+            session.close()
+            return
+        if session.join_timer:
+            session.join_timer.cancel()
+            session.join_timer = None
+        session.control = owner
+        session.stats = owner.stats
+        owner.attached.append(session)
+        with self.lock:
+            self.clients.pop(session.id, None)
+            self.data_sessions[session.id] = session
+        self._leave_room(session)
+        self.log(f"📎 {owner.addr} opened a data connection from {session.addr}.", "system")
+
+    async def _adopt_connection(self, sock, data):
+        """Serve a data connection that another worker accepted (see chat_cluster)."""
+        def handed_over():
+            session = ClientSession(self, next(self._ids), self.max_queue)
+            # It said HELLO::2 to the other worker; ``data`` starts with its ATTACH.
+            session.reader.version = 2
+            session.reader.writable(len(data))[:len(data)] = data
+            session.reader.commit(len(data))
+            return session
+
+        try:
+            _, session = await self.loop.connect_accepted_socket(handed_over, sock)
+        except OSError:
+            sock.close()
+            return
+        if not session.closed:
+            session._process_frames()
+
+    def _relay_message(self, session, text):
+        self.message_count += 1
+        session.stats.messages += 1
+        session.room.messages += 1
+        self.observer.message(session.label, text)
+        self.broadcast(MSG, f"{session.label}: {text}", exclude=session, room=session.room)
+
+    def _start_upload(self, session, header):
+        addr = session.member.addr
+        # <filename>::<filesize>::<mimetype>
+        parts = header.split("::", 2)
+        if len(parts) < 3:
+            self.log(f"⚠️ Bad file header from {addr}: {header}", "error")
+            return
+        filename, filesize_str, mimetype = parts
+        try:
+            filesize = int(filesize_str)
+            if filesize < 0:
+                raise ValueError(filesize_str)
+        except ValueError:
+            self.log(f"⚠️ Invalid filesize from {addr}: {filesize_str}", "error")
+            return
+        safe_name = pathlib.Path(filename).name
+        # Streamed to a scratch file and hashed on the way; the hash decides
+        # where it ends up in the blob store.
+        buffers = self._take_buffers()
+        try:
+            session.upload = FileUpload(safe_name, self.blobs.temp_path(), filesize, mimetype, buffers,
+                                        hashers=(hashlib.new(HASH),))
+        except OSError as e:
+            self._upload_buffers.extend(buffers)
+            self.log(f"⚠️ Cannot save {safe_name} from {addr}: {e}", "error")
+            session.close(abort=True)
+            return
+        if filesize > 0:
+            session.reader.expect_body(filesize)
+        else:
+            self._finish_upload(session)
+
+    def _take_buffers(self):
+        # Two per upload: one receiving while the other is written out.
+        pool = self._upload_buffers
+        return [pool.pop() if pool else bytearray(self.upload_buffer) for _ in range(2)]
+
+    def _close_upload(self, upload):
+        try:
+            upload.close()
+        finally:
+            self._upload_buffers.extend(upload.buffers)
+
+    def _finish_upload(self, session):
+        upload, session.upload = session.upload, None
+        self._close_upload(upload)
+        if isinstance(upload, ChunkUpload):
+            self._finish_chunk(session, upload)
+            return
+        addr = session.member.addr
+        digest = upload.hashers[0].hexdigest()
+        try:
+            created = self.blobs.put(digest, upload.size, upload.mimetype, src=upload.path)
+        except OSError as e:
+            self.log(f"⚠️ Cannot save {upload.name} from {addr}: {e}", "error")
+            return
+
+        def stored(name):
+            self.log(f"📁 Received file from {addr}: {name} ({upload.size} bytes"
+                     f"{'' if created else ', already stored'}) "
+                     f"in {upload.elapsed:.2f}s, {upload.mb_per_sec:.1f} MB/s", "success")
+            self._file_stored(session, name, digest, upload.mimetype)
+        self._name_file(upload.name, digest, upload.size, upload.mimetype, stored)
+
+    def _name_file(self, name, digest, size, mimetype, then):
+        """Give blob ``digest`` the file name ``name``, or a free one like it, then call ``then(name)``.
+
+        In a cluster the hub picks the name, so two workers storing
+        "photo.jpg" at once cannot both take it.
+        """
+        if self.cluster:
+            self.cluster.store(name, digest, size, mimetype, then)
+        else:
+            then(self.blobs.assign(name, digest))
+
+    def _file_stored(self, session, name, digest, mimetype):
+        addr = session.member.addr
+        self.file_count += 1
+        self.observer.file_received(addr, name, self.blobs.blob_path(digest), mimetype)
+        # announce to other clients (they can download via separate mechanism; here we just notify)
+        room = session.member.room
+        if room is not None:
+            self.broadcast(NOTIFY, f"Server: {session.member.label} sent file {name}", room=room)
+
+    # ---------------------------------------------------------------- resumable uploads
+
+    def _send_resume_point(self, session, partial):
+        partial.announced = partial.offset
+        session.enqueue(proto.Frame(
+            UPLOADING, f"{partial.id}::{partial.offset}::{partial.size}::{partial.name}".encode()
+        ).encoded(session.version))
+
+    def _begin_resumable(self, session, header):
+        # <filename>::<filesize>::<mimetype>::<sha256>
+        parts = header.split("::")
+        if len(parts) != 4:
+            self._send_error(session, f"UPLOAD: bad header {header!r}")
+            return
+        filename, filesize_str, mimetype, digest = parts
+        try:
+            filesize = int(filesize_str)
+            if filesize < 0:
+                raise ValueError(filesize_str)
+        except ValueError:
+            self._send_error(session, f"UPLOAD {filename}: invalid size {filesize_str!r}")
+            return
+        safe_name = pathlib.Path(filename).name
+        digest = digest.lower()
+        if self.blobs.has(digest, filesize):
+            # Hash first: we already have these bytes, so nothing is sent.
+            def stored(name):
+                self.log(f"📁 {session.member.addr} sent {name} ({filesize} bytes): already stored, "
+                         f"upload skipped", "success")
+                self._send_uploaded(session, "", safe_name, digest, name)
+                self._file_stored(session, name, digest, mimetype)
+            self._name_file(safe_name, digest, filesize, mimetype, stored)
+            return
+        try:
+            partial = self.partials.begin(safe_name, filesize, mimetype, digest)
+        except OSError as e:
+            self.log(f"⚠️ Cannot save {safe_name} from {session.member.addr}: {e}", "error")
+            self._send_error(session, f"UPLOAD {safe_name}: {e.strerror or e}")
+            return
+        partial.owner = session
+        if partial.offset:
+            self.log(f"🔁 {session.member.addr} resumes {safe_name} at {partial.offset}/{filesize} bytes", "system")
+        self._send_resume_point(session, partial)
+        if partial.offset == partial.size:
+            self._complete_resumable(session, partial)
+
+    def _resume_upload(self, session, uid):
+        partial = self.partials.get(uid)
+        if partial is None:
+            self._send_error(session, f"RESUME {uid}: unknown upload")
+            return
+        if partial.owner is not None and partial.owner is not session and not partial.owner.closed:
+            self._send_error(session, f"RESUME {uid}: upload in progress on another connection")
+            return
+        partial.owner = session
+        self.log(f"🔁 {session.member.addr} resumes {partial.name} at {partial.offset}/{partial.size} bytes", "system")
+        self._send_resume_point(session, partial)
+
+    def _start_chunk(self, session, header):
+        # <id>::<offset>::<length>::<sha256>[::deflate::<packed length>]
+        parts = header.split("::")
+        try:
+            uid, offset, length, digest = parts[0], int(parts[1]), int(parts[2]), parts[3].lower()
+            packed = None
+            if len(parts) > 4:
+                if parts[4] != DEFLATE_NAME:
+                    raise ValueError(parts[4])
+                packed = int(parts[5])
+                if packed <= 0:
+                    raise ValueError(packed)
+            if length < 0:
+                raise ValueError(length)
+        except (IndexError, ValueError):
+            # Without a length there is no telling where the body ends.
+            self.log(f"⚠️ Bad chunk header from {session.addr}: {header}", "error")
+            session.close(abort=True)
+            return
+        body = length if packed is None else packed
+        partial = self.partials.get(uid)
+        if partial is None or partial.owner is not session:
+            self._send_error(session, f"CHUNK {uid}: unknown upload, send UPLOAD or RESUME first")
+        elif offset != partial.offset or offset + length > partial.size:
+            # Chunks still in flight behind a rejected one: the client has
+            # already been told where to continue.
+            if partial.announced != partial.offset:
+                self._send_resume_point(session, partial)
+        elif length and partial.hasher is None:
+            # Resumed after a restart: the whole-file hash so far has to be
+            # rebuilt from the part file. That reads the whole file, so it
+            # runs on a disk thread, and the body waits in the socket.
+            session.wait_disk(self.loop.run_in_executor(self.disk, partial.file_hasher),
+                              lambda: self._start_chunk(session, header))
+            return
+        elif length:
+            buffers = self._take_buffers()
+            try:
+                session.upload = ChunkUpload(partial, length, digest, buffers, packed)
+            except OSError as e:
+                self._upload_buffers.extend(buffers)
+                self.log(f"⚠️ Cannot save {partial.name} from {session.member.addr}: {e}", "error")
+                session.close(abort=True)
+                return
+            session.reader.expect_body(body)
+            return
+        # Skip the body of a chunk we are not taking.
+        session.reader.expect_body(body)
+
+    def _finish_chunk(self, session, chunk):
+        partial = chunk.partial
+        if not chunk.verified:
+            partial.rollback()
+            self.log(f"⚠️ Chunk of {partial.name} from {session.member.addr} at {chunk.offset} "
+                     f"failed its checksum, asking for a resend", "warning")
+            self._send_error(session, f"CHUNK {partial.id}::{chunk.offset}: checksum mismatch")
+            self._send_resume_point(session, partial)
+            return
+        self.partials.commit(chunk)
+        if chunk.inflater is not None:
+            self.upload_deflate_raw_bytes += chunk.length
+            self.upload_deflate_bytes += chunk.size
+        partial.announced = None
+        if partial.offset == partial.size:
+            self._complete_resumable(session, partial)
+
+    def _complete_resumable(self, session, partial):
+        if partial.hasher is None:
+            # Fully sent before a restart; hash the part file off the loop first.
+            session.wait_disk(self.loop.run_in_executor(self.disk, partial.file_hasher),
+                              lambda: self._complete_resumable(session, partial))
+            return
+        try:
+            created = self.partials.complete(partial, self.blobs)
+        except OSError as e:
+            self.log(f"⚠️ Cannot save {partial.name} from {session.member.addr}: {e}", "error")
+            self._send_error(session, f"UPLOAD {partial.id}: {e.strerror or e}")
+            return
+        addr = session.member.addr
+        if created is None:
+            self.log(f"⚠️ {partial.name} from {addr} does not match its SHA-256; discarded", "error")
+            self._send_error(session, f"UPLOAD {partial.id}: file checksum mismatch, upload discarded")
+            return
+
+        def stored(name):
+            self.log(f"📁 Received file from {addr}: {name} ({partial.size} bytes, "
+                     f"sha256 {partial.digest[:12]}…{'' if created else ', already stored'})", "success")
+            self._send_uploaded(session, partial.id, partial.name, partial.digest, name)
+            self._file_stored(session, name, partial.digest, partial.mimetype)
+        self._name_file(partial.name, partial.digest, partial.size, partial.mimetype, stored)
+
+    def _send_uploaded(self, session, uid, name, digest, stored_as):
+        session.enqueue(proto.Frame(
+            UPLOADED, f"{uid}::{name}::{digest}::{stored_as}".encode()
+        ).encoded(session.version))
+
+    def _send_error(self, session, text):
+        session.send(ERROR, text.encode())
+
+    def _start_download(self, session, request):
+        # <name>[::<offset>[::<length>]]
+        parts = request.split("::")
+        safe_name = pathlib.Path(parts[0]).name
+        try:
+            offset = int(parts[1]) if len(parts) > 1 and parts[1] else 0
+            length = int(parts[2]) if len(parts) > 2 and parts[2] else 0
+        except ValueError:
+            self._send_error(session, f"GET {safe_name}: bad range {request!r}")
+            return
+        # Only stored uploads are served, never whatever else is in the folder.
+        found = self.blobs.lookup(safe_name)
+        if not found:
+            self._send_error(session, f"GET {safe_name}: no such file")
+            return
+        path, total = found
+        if offset < 0 or length < 0 or offset > total:
+            self._send_error(session, f"GET {safe_name}: range not satisfiable (size {total})")
+            return
+        if not length or offset + length > total:
+            length = total - offset
+        if length and session.pending_files >= MAX_DOWNLOADS:
+            self._send_error(session, f"GET {safe_name}: too many downloads queued (max {MAX_DOWNLOADS})")
+            return
+        mimetype = mimetypes.guess_type(safe_name)[0] or "application/octet-stream"
+        header = proto.Frame(FILEDATA, f"{safe_name}::{offset}::{length}::{total}::{mimetype}".encode())
+        if length:
+            queued = session.enqueue_file(header.encoded(session.version), FileRange(safe_name, path, offset, length))
+        else:
+            queued = session.enqueue(header.encoded(session.version))
+        if not queued:
+            self._overflow(session)
+            return
+        self.log(f"📥 {session.member.addr} requested {safe_name} [{offset}-{offset + length}) of {total} bytes", "system")
+
+    def _download_done(self, session, item, elapsed):
+        self.download_bytes += item.length
+        rate = item.length / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+        self.log(f"📤 Sent {item.name} [{item.offset}-{item.offset + item.length}) to {session.member.addr} "
+                 f"in {elapsed:.2f}s, {rate:.1f} MB/s", "success")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless chat server (no Tk required).")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--upload-dir", default=UPLOAD_DIR)
+    parser.add_argument("--backlog", type=int, default=BACKLOG)
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUE,
+                        help="outbound frames per client before it is a slow consumer")
+    parser.add_argument("--slow-policy", choices=("drop", "lag"), default=SLOW_POLICY)
+    parser.add_argument("--upload-buffer", type=int, default=UPLOAD_BUFFER,
+                        help="bytes per upload receive buffer / disk write")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics at http://<metrics-host>:<port>/metrics")
+    parser.add_argument("--metrics-host", default=METRICS_HOST)
+    parser.add_argument("--history", default=None,
+                        help="chat history database (default: <upload-dir>-history.db, beside the upload folder)")
+    parser.add_argument("--no-history", action="store_true", help="do not keep chat history")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="refuse COMPRESS: send chat uncompressed to every client")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes sharing the port with SO_REUSEPORT (Linux); "
+                             "metrics ports count up from --metrics-port")
+    parser.add_argument("--peer", action="append", default=[], type=parse_peer, metavar="HOST:PORT",
+                        help="federation port of another server to relay broadcasts with (repeatable)")
+    parser.add_argument("--federation-port", type=int, default=None,
+                        help="accept federation peers on this port")
+    parser.add_argument("--federation-host", default=None,
+                        help="address for --federation-port (default: --host)")
+    parser.add_argument("--heartbeat", type=int, default=HEARTBEAT,
+                        help="seconds of silence before the server PINGs a client (0: no PINGs, no reaping)")
+    parser.add_argument("--idle-timeout", type=int, default=IDLE_TIMEOUT,
+                        help="seconds of silence, PING unanswered, before a client is closed")
+    parser.add_argument("--keepalive", type=int, default=KEEPALIVE_IDLE,
+                        help="seconds of silence before TCP keepalive probes start (0: off)")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="connections accepted at once, chat and data (0: no cap)")
+    parser.add_argument("--max-per-ip", type=int, default=MAX_PER_IP,
+                        help="connections from one address (0: no cap)")
+    parser.add_argument("--message-rate", type=float, default=MESSAGE_RATE,
+                        help="chat lines per second per client (0: no limit)")
+    parser.add_argument("--message-burst", type=int, default=MESSAGE_BURST,
+                        help="chat lines a client may send at once after a pause")
+    parser.add_argument("--upload-rate", type=int, default=UPLOAD_RATE,
+                        help="upload bytes per second per client (0: no limit)")
+    parser.add_argument("--log-level", default="INFO",
+                        help="DEBUG also logs every chat line")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(),
+                        format="[%(asctime)s] %(levelname)s %(message)s",
+                        datefmt="%H:%M:%S")
+    history_path = args.history
+    if args.no_history:
+        history_path = ""
+    elif history_path is None:
+        history_path = default_history_path(args.upload_dir)
+    options = dict(host=args.host, port=args.port, upload_dir=args.upload_dir, backlog=args.backlog,
+                   max_queue=args.max_queue, slow_policy=args.slow_policy,
+                   upload_buffer=args.upload_buffer, metrics_host=args.metrics_host,
+                   metrics_port=args.metrics_port, history_path=history_path,
+                   compression=not args.no_compression, heartbeat=args.heartbeat,
+                   idle_timeout=args.idle_timeout, keepalive=args.keepalive,
+                   max_connections=args.max_connections, max_per_ip=args.max_per_ip,
+                   message_rate=args.message_rate, message_burst=args.message_burst,
+                   upload_rate=args.upload_rate)
+    federation = None
+    if args.peer or args.federation_port is not None:
+        federation = Federation(args.federation_host or args.host, args.federation_port, args.peer,
+                                name=f"{socket.gethostname()}:{args.port}")
+    if args.workers > 1:
+        os.makedirs(args.upload_dir, exist_ok=True)
+        history = ChatHistory(history_path) if history_path else None
+        run_cluster(args.workers, run_worker, dict(options, log_level=args.log_level.upper()), history,
+                    federation, args.upload_dir)
+        return
+    raise_fd_limit()
+    serve_headless(ChatServer(observer=LoggingObserver(), federation=federation, **options))
+
+
+def run_worker(worker, runtime_dir, options):
+    """One process of ``--workers``: a ChatServer on the shared port."""
+    # Ctrl+C reaches the whole process group; the supervisor stops us with SIGTERM.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    options = dict(options)
+    logging.basicConfig(level=options.pop("log_level"),
+                        format=f"[%(asctime)s] w{worker} %(levelname)s %(message)s",
+                        datefmt="%H:%M:%S")
+    if options["metrics_port"] is not None:
+        options["metrics_port"] += worker
+    raise_fd_limit()
+    serve_headless(ChatServer(observer=LoggingObserver(), cluster=ClusterLink(worker, runtime_dir), **options))
+
+
+def serve_headless(server):
+    """Run ``server`` on this thread until SIGTERM or Ctrl+C."""
+    async def run():
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.stop)
+        except (NotImplementedError, AttributeError):  # Windows
+            pass
+        await server.serve()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
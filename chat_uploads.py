@@ -0,0 +1,572 @@
+"""Receiving uploads: the block-buffered file writer and resumable partials.
+
+A resumable upload is announced with its final size and SHA-256 and gets
+a server-assigned id. The data then arrives as CHUNK bodies that each carry
+their own SHA-256. A chunk moves the committed offset only if it verifies.
+Anything past that offset is truncated away: a chunk cut off by a
+disconnect, or one that failed its check. A client can therefore always
+continue from ``offset``, even after a server restart.
+
+A chunk body may come deflated. It is inflated on its way to disk, so
+the part file, the offsets and every hash are about the file's own bytes.
+
+The data goes to ``<upload_dir>/.partial/<id>.part``, next to a small JSON
+record of the upload. The file moves into the blob store only when the
+whole-file hash matches.
+
+Finished uploads of either kind are stored by content (see BlobStore).
+"""
+import collections
+import hashlib
+import json
+import os
+import re
+import secrets
+import time
+import zlib
+
+from chat_compress import FILE_WBITS
+
+PARTIAL_DIR = ".partial"
+# What UploadStore.begin() names uploads; anything else is not looked up on disk.
+UPLOAD_ID = re.compile(r"[0-9a-f]{16}")
+BLOB_DIR = "blobs"
+HASH = "sha256"
+# Seconds the blob index may stay dirty: the changes of that time go to
+# disk in one write, on a disk thread.
+INDEX_FLUSH_DELAY = 1.0
+
+
+def preallocate(fd, size):
+    """Reserve disk space up front so a large upload is not fragmented."""
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        pass  # filesystem without fallocate support: just write
+
+
+class FileUpload:
+    """Raw upload body being streamed to disk.
+
+    The socket receives straight into one of two block buffers (see
+    ClientSession.get_buffer). A full buffer becomes a block. Hashing and
+    the disk write run on a worker thread (``submit``) while the other
+    buffer keeps receiving, so the event loop itself only does recv_into
+    and the file gets large block-aligned writes.
+
+    With ``offset`` set, the body is written into an existing file at that
+    position instead of replacing it. Every received byte is also fed to
+    ``hashers``, in order, on the worker thread.
+    """
+
+    def __init__(self, name, path, size, mimetype, buffers, offset=None, hashers=()):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mimetype = mimetype
+        self.received = 0
+        self.buffers = buffers
+        self.free = [memoryview(buf) for buf in buffers]
+        self.view = self.free.pop()
+        self.fill = 0
+        # Full blocks waiting for the worker, and the one it is writing.
+        self.ready = collections.deque()
+        self.inflight = None
+        self._inflight_view = None
+        self.hashers = hashers
+        self.offset = offset or 0
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        if offset is None:
+            flags |= os.O_TRUNC
+        self.fd = os.open(path, flags, 0o644)
+        if offset is None:
+            preallocate(self.fd, size)
+        else:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+
+    @property
+    def remaining(self):
+        return self.size - self.received
+
+    @property
+    def can_receive(self):
+        """False while both buffers are waiting on the disk."""
+        return self.view is not None
+
+    @property
+    def file_bytes(self):
+        """Bytes this upload has put in the file (once written)."""
+        return self.received
+
+    @property
+    def written(self):
+        """Everything received has reached the file."""
+        return not self.remaining and self.inflight is None and not self.ready
+
+    def writable(self):
+        return self.view[self.fill:self.fill + self.remaining]
+
+    def commit(self, nbytes):
+        """Account for bytes received into writable(); True once a block is ready to submit."""
+        self.fill += nbytes
+        self.received += nbytes
+        if self.fill == len(self.view) or not self.remaining:
+            self.ready.append((self.view, self.fill))
+            self.fill = 0
+            self.view = self.free.pop() if self.free else None
+            return True
+        return False
+
+    def write(self, chunk):
+        """Copy bytes that arrived in the frame buffer alongside the header.
+
+        Returns True if a block is ready to submit.
+        """
+        ready = False
+        while chunk:
+            if self.view is None:
+                # Both buffers busy: rare (only with a large frame buffer), so
+                # just wait for the disk here.
+                self.wait()
+                self._write_ready()
+            n = min(len(chunk), len(self.view) - self.fill)
+            self.view[self.fill:self.fill + n] = chunk[:n]
+            chunk = chunk[n:]
+            ready = self.commit(n) or ready
+        return ready
+
+    def submit(self, executor):
+        """Hand the next ready block to the worker; returns its future, or None."""
+        if self.inflight is not None or not self.ready:
+            return None
+        view, length = self.ready.popleft()
+        self._inflight_view = view
+        self.inflight = executor.submit(self._write_block, view[:length])
+        return self.inflight
+
+    def block_done(self):
+        """Call on the loop thread when the inflight future has finished."""
+        future, self.inflight = self.inflight, None
+        view, self._inflight_view = self._inflight_view, None
+        if self.view is None:
+            self.view = view
+        else:
+            self.free.append(view)
+        future.result()  # re-raise a failed write
+
+    def wait(self):
+        if self.inflight is not None:
+            self.inflight.result()
+            self.block_done()
+
+    def _write_block(self, block):
+        for hasher in self.hashers:
+            hasher.update(block)
+        while block:
+            written = os.write(self.fd, block)
+            block = block[written:]
+
+    def _write_ready(self):
+        while self.ready:
+            view, length = self.ready.popleft()
+            self._write_block(view[:length])
+            if self.view is None:
+                self.view = view
+            else:
+                self.free.append(view)
+
+    def close(self):
+        """Write out what arrived and close; an interrupted upload is cut to that."""
+        if self.fd is None:
+            return
+        try:
+            try:
+                self.wait()
+            finally:
+                if self.fill:
+                    self.ready.append((self.view, self.fill))
+                    self.fill = 0
+                self._write_ready()
+                if self.received < self.size:
+                    os.ftruncate(self.fd, self.offset + self.file_bytes)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+            self.elapsed = time.perf_counter() - self.started
+
+    @property
+    def mb_per_sec(self):
+        return self.received / (1024 * 1024) / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class PartialUpload:
+    """An unfinished resumable upload and its committed offset."""
+
+    def __init__(self, directory, uid, name, size, mimetype, digest, offset=0):
+        self.id = uid
+        self.name = name
+        self.size = size
+        self.mimetype = mimetype
+        self.digest = digest
+        self.offset = offset
+        self.part_path = os.path.join(directory, uid + ".part")
+        self.meta_path = os.path.join(directory, uid + ".json")
+        # Running whole-file hash of the first ``offset`` bytes. After a
+        # restart it is rebuilt from the part file the first time it's
+        # needed; that reads the whole file, so the server does it on a
+        # disk thread.
+        self.hasher = hashlib.new(HASH) if not offset else None
+        # Session currently sending chunks, so two connections can't interleave.
+        self.owner = None
+        # Offset we last told the owner to resume from. Chunks already in
+        # flight behind a rejected one are skipped quietly, not answered one by one.
+        self.announced = None
+
+    def file_hasher(self):
+        if self.hasher is None:
+            hasher = hashlib.new(HASH)
+            with open(self.part_path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(block)
+            self.hasher = hasher
+        return self.hasher
+
+    def save(self):
+        record = {"name": self.name, "size": self.size, "mimetype": self.mimetype,
+                  "digest": self.digest, "offset": self.offset}
+        tmp = self.meta_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(record, f)
+        os.replace(tmp, self.meta_path)
+
+    def rollback(self):
+        """Drop anything written past the committed offset."""
+        os.truncate(self.part_path, self.offset)
+
+
+class ChunkUpload(FileUpload):
+    """One CHUNK body of a resumable upload, hashed as it is written.
+
+    ``length`` bytes of the file. With ``packed`` set the body is that many
+    bytes of raw deflate data instead (see chat_compress.pack_chunk), which
+    the worker thread inflates before hashing and writing.
+    """
+
+    def __init__(self, partial, length, digest, buffers, packed=None):
+        self.partial = partial
+        self.length = length
+        self.digest = digest
+        self.chunk_hasher = hashlib.new(HASH)
+        # Work on a copy so a chunk that fails its check leaves the running
+        # whole-file hash untouched.
+        self.file_hasher = partial.file_hasher().copy()
+        self.inflater = None if packed is None else zlib.decompressobj(FILE_WBITS)
+        self.inflated = 0
+        # Set when the body is not deflate data or inflates past ``length``.
+        self.damaged = False
+        super().__init__(partial.name, partial.part_path, length if packed is None else packed,
+                         partial.mimetype, buffers, offset=partial.offset,
+                         hashers=(self.chunk_hasher, self.file_hasher))
+
+    @property
+    def file_bytes(self):
+        return self.received if self.inflater is None else self.inflated
+
+    @property
+    def verified(self):
+        if self.remaining:
+            return False
+        inflater = self.inflater
+        if inflater is not None and (self.damaged or not inflater.eof or inflater.unused_data
+                                     or self.inflated != self.length):
+            return False
+        return self.chunk_hasher.hexdigest() == self.digest
+
+    def _write_block(self, block):
+        if self.inflater is not None:
+            block = self._inflate(block)
+        super()._write_block(block)
+
+    def _inflate(self, block):
+        if self.damaged:
+            return b""
+        left = self.length - self.inflated
+        try:
+            # One byte over is enough to tell the body is too long.
+            data = self.inflater.decompress(block, left + 1)
+        except zlib.error:
+            data = None
+        if data is None or len(data) > left:
+            # Fails its check like a corrupted chunk, and is sent again.
+            self.damaged = True
+            return b""
+        self.inflated += len(data)
+        return data
+
+
+class UploadStore:
+    """The partial uploads under ``<upload_dir>/.partial``, by id."""
+
+    def __init__(self, upload_dir):
+        self.dir = os.path.join(upload_dir, PARTIAL_DIR)
+        os.makedirs(self.dir, exist_ok=True)
+        self.uploads = {}
+        self._load()
+
+    def _load(self):
+        for entry in os.listdir(self.dir):
+            uid, ext = os.path.splitext(entry)
+            if ext != ".json":
+                continue
+            partial = self._read(uid)
+            if partial is not None:
+                self.uploads[uid] = partial
+
+    def _read(self, uid):
+        """The upload recorded on disk as ``uid``, cut back to its committed offset."""
+        try:
+            with open(os.path.join(self.dir, uid + ".json"), encoding="utf-8") as f:
+                record = json.load(f)
+            partial = PartialUpload(self.dir, uid, record["name"], record["size"],
+                                    record["mimetype"], record["digest"], record["offset"])
+            if not os.path.exists(partial.part_path):
+                open(partial.part_path, "wb").close()
+                partial.offset = 0
+                partial.hasher = hashlib.new(HASH)
+            partial.rollback()
+        except (OSError, ValueError, KeyError):
+            return None
+        return partial
+
+    def get(self, uid):
+        partial = self.uploads.get(uid)
+        if partial is None and UPLOAD_ID.fullmatch(uid):
+            # Begun since we started, by another worker sharing the directory.
+            partial = self._read(uid)
+            if partial is not None:
+                self.uploads[uid] = partial
+        return partial
+
+    def begin(self, name, size, mimetype, digest):
+        """The unfinished upload of this exact file, or a new one."""
+        for partial in self.uploads.values():
+            if (partial.owner is None and partial.name == name
+                    and partial.size == size and partial.digest == digest):
+                return partial
+        partial = PartialUpload(self.dir, secrets.token_hex(8), name, size, mimetype, digest)
+        open(partial.part_path, "wb").close()
+        partial.save()
+        self.uploads[partial.id] = partial
+        return partial
+
+    def commit(self, chunk):
+        partial = chunk.partial
+        partial.offset += chunk.length
+        partial.hasher = chunk.file_hasher
+        partial.save()
+
+    def release(self, owner):
+        """Forget which session was sending; the data stays for a later resume."""
+        for partial in self.uploads.values():
+            if partial.owner is owner:
+                partial.owner = None
+                partial.announced = None
+
+    def complete(self, partial, blobs):
+        """Move a fully received upload's content into ``blobs`` if its hash matches.
+
+        Returns what BlobStore.put() returns, or None (and throws the data
+        away) if the hash does not match. The caller names the file.
+        """
+        created = None
+        if partial.file_hasher().hexdigest() == partial.digest:
+            created = blobs.put(partial.digest, partial.size, partial.mimetype, src=partial.part_path)
+        self.discard(partial)
+        return created
+
+    def discard(self, partial):
+        self.uploads.pop(partial.id, None)
+        for path in (partial.part_path, partial.meta_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def legacy_uploads(upload_dir, reserved=()):
+    """Names of the plain files directly in ``upload_dir``, but not ``reserved`` paths or dotfiles."""
+    skip = {os.path.realpath(path) for path in reserved}
+    names = set()
+    with os.scandir(upload_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                continue
+            if os.path.realpath(entry.path) not in skip:
+                names.add(entry.name)
+    return names
+
+
+class BlobStore:
+    """Content-addressed storage for finished uploads.
+
+    Each distinct file is kept once, as ``<upload_dir>/blobs/<ab>/<sha256>``.
+    ``index.json`` maps every stored file name to its blob. The same file
+    sent forty times takes the space of one, and two different files with
+    the same name get different names instead of overwriting each other.
+    Stored files are never deleted, so no blob needs to know how many names
+    point at it.
+
+    Without ``on_change`` every change rewrites the index at once. With it,
+    a change only marks the index dirty and calls ``on_change()``; the owner
+    writes it later, batched, with write_index(snapshot()) or flush().
+
+    With ``writer=False`` another process (the hub of a chat_cluster) owns
+    the index and picks every stored name. Such a store only moves content
+    in with put() and learns the names from adopt(); it never writes
+    index.json or clears ``blobs/tmp``.
+
+    Files saved in the upload folder before the blob store existed are
+    listed once, when the store is opened, and served under their own names
+    (``legacy``). Anything else that shows up in the folder later, and the
+    ``reserved`` paths the server keeps there itself, is never served.
+    """
+
+    def __init__(self, upload_dir, on_change=None, reserved=(), writer=True):
+        self.upload_dir = upload_dir
+        self.on_change = on_change
+        self.writer = writer
+        self.dirty = False
+        self.dir = os.path.join(upload_dir, BLOB_DIR)
+        self.tmp_dir = os.path.join(self.dir, "tmp")
+        self.index_path = os.path.join(self.dir, "index.json")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        # name -> digest, and digest -> {"size", "mimetype"}
+        self.names = {}
+        self.blobs = {}
+        self.legacy = legacy_uploads(upload_dir, reserved)
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                index = json.load(f)
+            self.names, self.blobs = index["names"], index["blobs"]
+        except (OSError, ValueError, KeyError):
+            pass
+        if not self.writer:
+            return  # the other workers' uploads may be streaming in there
+        # Leftovers of uploads cut off before a restart.
+        for entry in os.listdir(self.tmp_dir):
+            try:
+                os.remove(os.path.join(self.tmp_dir, entry))
+            except OSError:
+                pass
+
+    def _save(self):
+        if not self.writer:
+            return
+        self.dirty = True
+        if self.on_change is None:
+            self.flush()
+        else:
+            self.on_change()
+
+    def snapshot(self):
+        """A copy of the index for write_index(), e.g. on another thread; clears ``dirty``."""
+        self.dirty = False
+        return {"names": dict(self.names), "blobs": {d: dict(b) for d, b in self.blobs.items()}}
+
+    def write_index(self, index):
+        # Replaced in one step: the workers of a cluster read it meanwhile.
+        tmp = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp, self.index_path)
+
+    def flush(self):
+        """Write the index now if it has changed since the last write."""
+        if self.dirty:
+            self.write_index(self.snapshot())
+
+    def blob_path(self, digest):
+        return os.path.join(self.dir, digest[:2], digest)
+
+    def temp_path(self):
+        """A scratch file to stream an upload into before its hash is known."""
+        return os.path.join(self.tmp_dir, secrets.token_hex(8))
+
+    def has(self, digest, size):
+        blob = self.blobs.get(digest)
+        return blob is not None and blob["size"] == size
+
+    def lookup(self, name):
+        """Path and size of the blob stored under ``name``, or None."""
+        digest = self.names.get(name)
+        if digest is not None:
+            return self.blob_path(digest), self.blobs[digest]["size"]
+        if name in self.legacy:
+            path = os.path.join(self.upload_dir, name)
+            try:
+                return path, os.path.getsize(path)
+            except OSError:
+                return None
+        return None
+
+    def add(self, name, digest, size, mimetype, src=None):
+        """put() the content, then assign() it ``name``.
+
+        Returns (name it was stored under, whether the blob is new).
+        """
+        created = self.put(digest, size, mimetype, src)
+        return self.assign(name, digest), created
+
+    def put(self, digest, size, mimetype, src=None):
+        """Store the content of blob ``digest``; returns whether it is new.
+
+        ``src`` is a finished file holding the content. It is moved into the
+        store if the blob is new and deleted if not. Without ``src`` the blob
+        must already be on disk (the client sent its hash first, or another
+        worker of a cluster stored it).
+        """
+        created = digest not in self.blobs
+        if created:
+            path = self.blob_path(digest)
+            if src is not None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(src, path)
+            elif not os.path.exists(path):
+                raise KeyError(digest)
+            self.blobs[digest] = {"size": size, "mimetype": mimetype}
+            self._save()
+        elif src is not None:
+            os.remove(src)
+        return created
+
+    def assign(self, name, digest):
+        """Store ``name`` for blob ``digest``; another file's name gets a free one. Returns the name used."""
+        if self.names.get(name) == digest:
+            return name
+        name = self._free_name(name)
+        self.names[name] = digest
+        self._save()
+        return name
+
+    def adopt(self, name, digest, size, mimetype):
+        """Take over a name the index owner stored; its blob is already on disk."""
+        self.blobs.setdefault(digest, {"size": size, "mimetype": mimetype})
+        self.names[name] = digest
+        self._save()
+
+    def _free_name(self, name):
+        # "photo.jpg", "photo (1).jpg", ... skipping names taken in the index
+        # or by files saved in the upload folder before the blob store.
+        stem, ext = os.path.splitext(name)
+        candidate, n = name, 0
+        while candidate in self.names or os.path.exists(os.path.join(self.upload_dir, candidate)):
+            n += 1
+            candidate = f"{stem} ({n}){ext}"
+        return candidate
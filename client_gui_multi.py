@@ -1,14 +1,90 @@
 
+import collections
 import socket
 import threading
 import tkinter as tk
-from tkinter import ttk, scrolledtext, filedialog, messagebox
+from tkinter import ttk, scrolledtext, filedialog, messagebox, simpledialog
 import os
 import mimetypes
+import hashlib
+import time
 from PIL import Image, ImageTk
 
+import chat_protocol as proto
+from chat_protocol import (BODY, HELLO, MSG, NOTIFY, GET, FILEDATA, ERROR,
+                           UPLOAD, RESUME, UPLOADING, CHUNK, UPLOADED, DATA, ATTACH,
+                           HISTORY, HISTORY_END, JOIN, LEAVE, ROOMS, NAME, DM, COMPRESS, DEFLATE,
+                           PING, PONG, DEFAULT_ROOM)
+from chat_compress import (DEFLATE_NAME, ECHO, DeflateStream, Inflater, file_compressible, file_sample,
+                           pack_chunk)
+from chat_heartbeat import set_keepalive
+
 HOST = '127.0.0.1'
 PORT = 5050
+# Uploads go out in checksummed chunks; a dropped connection costs at most one.
+CHUNK_SIZE = 4 * 1024 * 1024
+# Earlier messages fetched on connect and per "Earlier messages" click
+HISTORY_PAGE = 50
+# Log lines and status text from the network and upload threads are queued
+# and applied on the Tk thread every UI_TICK_MS
+UI_TICK_MS = 50
+
+class DataChannel:
+    """Second connection that carries file transfers, so chat never waits behind a file.
+
+    It is opened with a one-time token from the chat connection and has its
+    own receive thread; frames it receives go to the same handle_frame().
+    """
+
+    def __init__(self, app, token):
+        self.app = app
+        self.sock = socket.create_connection((HOST, PORT))
+        set_keepalive(self.sock)
+        self.reader = proto.FrameReader()
+        self.lock = threading.Lock()
+        self.closed = False
+        # No need to wait for the HELLO reply: the server reads ATTACH as v2
+        self.sock.sendall(proto.HELLO_LINE + proto.encode_v2(ATTACH, token.encode()))
+        self.thread = threading.Thread(target=self.receive, daemon=True)
+        self.thread.start()
+
+    def send_frame(self, kind, payload, body=b""):
+        # One frame and its body at a time, whichever thread is sending
+        with self.lock:
+            self.sock.sendall(proto.encode_v2(kind, payload))
+            if body:
+                self.sock.sendall(body)
+
+    def receive(self):
+        reader = self.reader
+        try:
+            while True:
+                n = self.sock.recv_into(reader.writable())
+                if not n:
+                    break
+                reader.commit(n)
+                for kind, payload in reader.events():
+                    if kind == HELLO:
+                        reader.version = 2
+                    elif kind not in (MSG, NOTIFY):
+                        # Chat can slip in before the server sees ATTACH; it
+                        # already arrives on the chat connection.
+                        self.app.handle_frame(kind, payload, self)
+        except Exception as e:
+            if not self.closed:
+                self.app.log(f"⚠️ File connection error: {e}", "error")
+        finally:
+            self.close()
+            self.app.data_closed(self)
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
 
 class PremiumClientGUI:
     def __init__(self, root):
@@ -55,7 +131,37 @@ class PremiumClientGUI:
         # Initialize connection variables
         self.client_socket = None
         self.receive_thread = None
+        self.send_lock = threading.Lock()
+        # File transfers go over this connection once it is open
+        self.data = None
+        # Downloads asked for but not yet answered: name -> local save path
+        self.pending_downloads = {}
+        self.download = None
+        self.last_shared_file = ""
+        # Uploads announced but not yet given an id: name -> local path
+        self.pending_uploads = {}
+        # Unfinished uploads by server id, kept across reconnects: id -> local path
+        self.uploads = {}
+        # Latest sender thread per upload id; an older one stops when replaced
+        self.upload_senders = {}
         self.connected = False
+        self.reader = None
+        # Chat compression once the server agrees to it: our stream to it, and its streams to us
+        self.deflate = None
+        self.inflater = None
+        # Chat history: entries of the page being received, and where the next older page starts
+        self.history_page = []
+        self.history_before = None
+        # Room this client is in; rejoined after a reconnect
+        self.room = DEFAULT_ROOM
+        # Our user handle, the handles we have exchanged direct messages
+        # with, and direct messages not seen yet
+        self.username = None
+        self.dm_peers = set()
+        self.dm_unread = 0
+        # (function, args) to run on the Tk thread; see pump_ui()
+        self.ui_events = collections.deque()
+        root.after(UI_TICK_MS, self.pump_ui)
 
     def setup_styles(self):
         style = ttk.Style()
@@ -96,6 +202,14 @@ class PremiumClientGUI:
                        background=self.sidebar_color,
                        foreground=self.text_color,
                        font=("Segoe UI", 9))
+        
+        # Room / direct message tabs
+        style.configure("TNotebook", background=self.bg_color, borderwidth=0)
+        style.configure("TNotebook.Tab",
+                       background=self.sidebar_color,
+                       foreground=self.text_color,
+                       padding=(12, 4))
+        style.map("TNotebook.Tab", background=[('selected', self.accent_color)])
 
     def create_gradient_header(self):
         # Create a simple gradient-like header
@@ -141,12 +255,38 @@ class PremiumClientGUI:
         # Chat header
         chat_header = ttk.Frame(chat_frame, style="Sidebar.TFrame")
         chat_header.pack(fill=tk.X, pady=(0, 5))
-        ttk.Label(chat_header, text="💭 Live Chat", style="Subtitle.TLabel", 
+        self.room_title = tk.StringVar(value=f"💭 #{DEFAULT_ROOM}")
+        ttk.Label(chat_header, textvariable=self.room_title, style="Subtitle.TLabel", 
                  background=self.sidebar_color).pack(side=tk.LEFT, padx=10, pady=5)
         
+        # Room switcher: pick a listed room or type a new name
+        self.room_var = tk.StringVar(value=DEFAULT_ROOM)
+        self.room_box = ttk.Combobox(chat_header, textvariable=self.room_var, width=14,
+                                     values=[DEFAULT_ROOM], postcommand=self.request_rooms)
+        self.room_box.pack(side=tk.LEFT, pady=5)
+        self.room_box.bind("<<ComboboxSelected>>", lambda e: self.join_room())
+        # "break" keeps Enter here from also sending the message entry
+        self.room_box.bind("<Return>", lambda e: self.join_room() or "break")
+        ttk.Button(chat_header, text="🚪 Leave", style="Accent.TButton",
+                   command=self.leave_room).pack(side=tk.LEFT, padx=(5, 0), pady=5)
+        
+        self.history_btn = ttk.Button(chat_header, text="⏫ Earlier messages", 
+                                      style="Accent.TButton", command=self.load_older_history,
+                                      state=tk.DISABLED)
+        self.history_btn.pack(side=tk.RIGHT, padx=10, pady=5)
+        
+        # Room chat and direct messages in separate tabs
+        self.chat_tabs = ttk.Notebook(chat_frame)
+        self.chat_tabs.pack(fill=tk.BOTH, expand=True)
+        room_tab = ttk.Frame(self.chat_tabs, style="Card.TFrame")
+        self.dm_tab = ttk.Frame(self.chat_tabs, style="Card.TFrame")
+        self.chat_tabs.add(room_tab, text="💭 Room")
+        self.chat_tabs.add(self.dm_tab, text="✉️ Direct")
+        self.chat_tabs.bind("<<NotebookTabChanged>>", self.tab_changed)
+        
         # Chat display with modern styling
         self.chat_box = scrolledtext.ScrolledText(
-            chat_frame,
+            room_tab,
             wrap=tk.WORD,
             state=tk.DISABLED,
             width=70,
@@ -161,6 +301,32 @@ class PremiumClientGUI:
             pady=15
         )
         self.chat_box.pack(fill=tk.BOTH, expand=True)
+        
+        # Direct messages: who to send to, then the conversation
+        dm_header = ttk.Frame(self.dm_tab, style="Sidebar.TFrame")
+        dm_header.pack(fill=tk.X)
+        ttk.Label(dm_header, text="To:", style="Subtitle.TLabel", 
+                 background=self.sidebar_color).pack(side=tk.LEFT, padx=10, pady=5)
+        self.dm_to = ttk.Combobox(dm_header, width=20, values=[])
+        self.dm_to.pack(side=tk.LEFT, pady=5)
+        self.dm_to.bind("<Return>", lambda e: self.msg_entry.focus_set() or "break")
+        
+        self.dm_box = scrolledtext.ScrolledText(
+            self.dm_tab,
+            wrap=tk.WORD,
+            state=tk.DISABLED,
+            width=70,
+            height=20,
+            bg=self.sidebar_color,
+            fg=self.text_color,
+            insertbackground=self.highlight_color,
+            selectbackground=self.accent_color,
+            font=("Segoe UI", 10),
+            relief='flat',
+            padx=15,
+            pady=15
+        )
+        self.dm_box.pack(fill=tk.BOTH, expand=True)
 
     def create_input_area(self, parent):
         input_frame = ttk.Frame(parent, style="Card.TFrame")
@@ -206,6 +372,14 @@ class PremiumClientGUI:
             command=self.attach_file
         )
         attach_btn.pack(side=tk.LEFT)
+
+        download_btn = ttk.Button(
+            file_controls,
+            text="⬇️ Download File",
+            style="Accent.TButton",
+            command=self.download_file
+        )
+        download_btn.pack(side=tk.LEFT, padx=(10, 0))
         
         ttk.Label(file_controls, text="Supports: Images, Videos, Documents", 
                  style="Subtitle.TLabel", foreground="#888").pack(side=tk.LEFT, padx=(15, 0))
@@ -231,7 +405,23 @@ class PremiumClientGUI:
             self.msg_entry.insert(0, "Type your message here...")
             self.msg_entry.configure(foreground="#888")
 
-    def log(self, text, message_type="info"):
+    def log(self, text, message_type="info", box=None):
+        # Safe from any thread: only queued here, drawn by pump_ui()
+        self.ui_events.append((self.draw_log, (text, message_type, box)))
+
+    def set_status(self, text):
+        # Safe from any thread, like log()
+        self.ui_events.append((self.status_var.set, (text,)))
+
+    def pump_ui(self):
+        """Apply everything the other threads queued since the last tick."""
+        events = self.ui_events
+        for _ in range(len(events)):
+            func, args = events.popleft()
+            func(*args)
+        self.root.after(UI_TICK_MS, self.pump_ui)
+
+    def draw_log(self, text, message_type="info", box=None):
         colors = {
             "info": self.text_color,
             "success": "#4caf50",
@@ -241,12 +431,13 @@ class PremiumClientGUI:
         }
         
         color = colors.get(message_type, self.text_color)
+        box = box or self.chat_box
         
-        self.chat_box.config(state=tk.NORMAL)
-        self.chat_box.insert(tk.END, text + "\n", message_type)
-        self.chat_box.tag_configure(message_type, foreground=color)
-        self.chat_box.config(state=tk.DISABLED)
-        self.chat_box.yview(tk.END)
+        box.config(state=tk.NORMAL)
+        box.insert(tk.END, text + "\n", message_type)
+        box.tag_configure(message_type, foreground=color)
+        box.config(state=tk.DISABLED)
+        box.yview(tk.END)
 
     def connect_to_server(self):
         if self.connected:
@@ -256,16 +447,32 @@ class PremiumClientGUI:
                 self.client_socket.close()
             except:
                 pass
+            if self.data:
+                self.data.close()
             self.connected = False
             self.conn_status.set("🔴 Disconnected")
             self.connect_btn.config(text="Connect to Server")
             self.log("🔴 Disconnected from server.", "system")
-            self.status_var.set("Disconnected from server")
+            self.set_status("Disconnected from server")
+            return
+
+        name = simpledialog.askstring("User Name", 
+                                      "Your user name (others send you direct messages with it).\n"
+                                      "Leave empty to chat without one:", 
+                                      initialvalue=self.username or "", parent=self.root)
+        if name is None:
+            return
+        if name.strip() and proto.valid_name(name) is None:
+            messagebox.showwarning("User Name", f"User names are 1-{proto.NAME_MAX} letters, "
+                                                f"digits, '-', '_' or '.'.")
             return
 
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((HOST, PORT))
+            # So a server that vanished is noticed even while we only listen
+            set_keepalive(self.client_socket)
+            self.negotiate_protocol()
         except Exception as e:
             messagebox.showerror("Connection Error", 
                                f"Could not connect to server:\n{e}\n\nPlease check if the server is running.")
@@ -274,12 +481,95 @@ class PremiumClientGUI:
         self.connected = True
         self.conn_status.set("🟢 Connected")
         self.connect_btn.config(text="Disconnect")
+        # Earlier messages are inserted here, above everything from this connection
+        self.chat_box.mark_set("history", "end-1c")
+        self.chat_box.mark_gravity("history", tk.LEFT)
+        self.history_before = None
         self.log("🟢 Successfully connected to server!", "success")
-        self.status_var.set(f"Connected to {HOST}:{PORT}")
+        self.set_status(f"Connected to {HOST}:{PORT} (protocol v{self.reader.version})")
+        
+        self.username = None
+        self.deflate = None
+        self.inflater = Inflater()
+        if self.reader.version == 2:
+            # Chat is compressed from the server's answer on, if it agrees
+            self.send_frame(COMPRESS, DEFLATE_NAME.encode())
+        if name.strip():
+            # First, so that the join notice already shows it
+            self.send_frame(NAME, name.strip().encode())
+        if self.room == DEFAULT_ROOM:
+            self.send_frame(HISTORY, str(HISTORY_PAGE).encode())
+        else:
+            # Back into the room we were in; its history follows the JOIN answer
+            self.send_frame(JOIN, self.room.encode())
+        if self.reader.version == 2:
+            # Ask for a file connection; unfinished uploads resume on it
+            self.send_frame(DATA, b"")
+        else:
+            self.resume_uploads(self)
         
         self.receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
         self.receive_thread.start()
 
+    def negotiate_protocol(self, timeout=3.0):
+        """Ask for v2 framing; fall back to the text protocol if the server doesn't answer."""
+        self.reader = proto.FrameReader()
+        self.client_socket.sendall(proto.HELLO_LINE)
+        self.client_socket.settimeout(timeout)
+        try:
+            while self.reader.version is None:
+                n = self.client_socket.recv_into(self.reader.writable())
+                if not n:
+                    raise ConnectionError("server closed the connection")
+                self.reader.commit(n)
+                for kind, payload in self.reader.events():
+                    if kind == HELLO:
+                        self.reader.version = 2
+                        break
+                    if kind == ERROR:
+                        # Refused (server full, too many connections from here)
+                        raise ConnectionError(str(payload, "utf-8", "replace"))
+                    self.handle_frame(kind, payload)
+        except socket.timeout:
+            self.reader.version = 1
+        finally:
+            self.client_socket.settimeout(None)
+
+    def send_frame(self, kind, payload, body=b""):
+        with self.send_lock:
+            # Compressed in send order, so under the lock
+            if self.deflate is not None and kind in (MSG, DM):
+                flags, data = self.deflate.pack(proto.encode_v2(kind, payload))
+                kind, payload = DEFLATE, bytes((flags,)) + data
+            self.client_socket.sendall(proto.encode(self.reader.version, kind, payload))
+            if body:
+                self.client_socket.sendall(body)
+
+    def transfer_channel(self):
+        """Where file transfers go: the data connection, or chat if there is none."""
+        return self.data or self
+
+    def open_data_channel(self, token):
+        try:
+            self.data = DataChannel(self, token)
+        except OSError as e:
+            self.log(f"⚠️ No separate file connection ({e}); files will share the chat connection.", "warning")
+        self.resume_uploads(self.transfer_channel())
+
+    def data_closed(self, channel):
+        if self.data is channel:
+            self.data = None
+            if self.download and self.download["channel"] is channel:
+                if self.download["file"]:
+                    self.download["file"].close()
+                self.download = None
+
+    def resume_uploads(self, channel):
+        # Pick up uploads the last connection dropped
+        for uid, path in list(self.uploads.items()):
+            self.log(f"🔁 Resuming upload of {os.path.basename(path)}...", "system")
+            channel.send_frame(RESUME, uid.encode())
+
     def send_message(self):
         if not self.connected:
             messagebox.showwarning("Not Connected", 
@@ -291,15 +581,53 @@ class PremiumClientGUI:
             return
         
         try:
-            payload = f"MSG::{text}\n"
-            self.client_socket.sendall(payload.encode())
+            if self.chat_tabs.select() == str(self.dm_tab):
+                self.send_direct(text)
+                return
+            self.send_frame(MSG, text.encode())
             self.log(f"You: {text}", "info")
             self.msg_entry.delete(0, tk.END)
-            self.status_var.set("Message sent successfully")
+            self.set_status("Message sent successfully")
         except Exception as e:
             messagebox.showerror("Send Error", 
                                f"Could not send message:\n{e}\n\nConnection may be lost.")
-            self.status_var.set("Failed to send message")
+            self.set_status("Failed to send message")
+
+    def send_direct(self, text):
+        to = proto.valid_name(self.dm_to.get())
+        if to is None:
+            messagebox.showwarning("Direct Message", "Enter the user name to send to in the 'To:' box.")
+            return
+        if not self.username:
+            messagebox.showwarning("Direct Message", 
+                                "Direct messages need a user name.\n\nReconnect and pick one.")
+            return
+        self.send_frame(DM, f"{to}::{text}".encode())
+        self.add_dm_peer(to)
+        self.log(f"You → {to}: {text}", "info", box=self.dm_box)
+        self.msg_entry.delete(0, tk.END)
+        self.set_status(f"Direct message sent to {to}")
+
+    def show_direct(self, text):
+        # Tk thread only (via pump_ui), like add_dm_peer()
+        sender, _, body = text.partition("::")
+        self.add_dm_peer(sender)
+        if not self.dm_to.get():
+            self.dm_to.set(sender)
+        self.log(f"{sender} → you: {body}", "system", box=self.dm_box)
+        if self.chat_tabs.select() != str(self.dm_tab):
+            self.dm_unread += 1
+            self.chat_tabs.tab(self.dm_tab, text=f"✉️ Direct ({self.dm_unread})")
+
+    def add_dm_peer(self, name):
+        if name not in self.dm_peers:
+            self.dm_peers.add(name)
+            self.dm_to.config(values=sorted(self.dm_peers))
+
+    def tab_changed(self, event):
+        if self.chat_tabs.select() == str(self.dm_tab) and self.dm_unread:
+            self.dm_unread = 0
+            self.chat_tabs.tab(self.dm_tab, text="✉️ Direct")
 
     def attach_file(self):
         if not self.connected:
@@ -320,41 +648,207 @@ class PremiumClientGUI:
         if not file_path:
             return
         
+        # Hashing and sending happen off the Tk thread so the window stays responsive
+        threading.Thread(target=self.start_upload, args=(file_path,), daemon=True).start()
+
+    def start_upload(self, file_path):
         filename = os.path.basename(file_path)
-        filesize = os.path.getsize(file_path)
-        mimetype, _ = mimetypes.guess_type(file_path)
-        if mimetype is None:
-            mimetype = "application/octet-stream"
-        
-        header = f"FILE::{filename}::{filesize}::{mimetype}\n"
-        
         try:
-            # Show progress
-            self.status_var.set(f"Sending {filename}...")
+            filesize = os.path.getsize(file_path)
+            mimetype, _ = mimetypes.guess_type(file_path)
+            if mimetype is None:
+                mimetype = "application/octet-stream"
+            
+            self.set_status(f"Checking {filename}...")
+            digest = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
             
-            # Send header
-            self.client_socket.sendall(header.encode())
+            # The server answers with an upload id and the offset to send from
+            self.pending_uploads[filename] = file_path
+            header = f"{filename}::{filesize}::{mimetype}::{digest.hexdigest()}"
+            self.transfer_channel().send_frame(UPLOAD, header.encode())
+            self.set_status(f"Sending {filename}...")
             
-            # Send file bytes with progress simulation
+        except Exception as e:
+            self.pending_uploads.pop(filename, None)
+            self.log(f"⚠️ Could not send {filename}: {e}", "error")
+            self.set_status("Failed to send file")
+
+    def send_chunks(self, channel, uid, offset, size, sender):
+        """Send an upload from ``offset`` on, one checksummed CHUNK at a time."""
+        file_path = self.uploads.get(uid)
+        if not file_path or not self.connected:
+            return
+        filename = os.path.basename(file_path)
+        try:
             with open(file_path, "rb") as f:
-                sent = 0
-                while True:
-                    chunk = f.read(4096)
+                # Only a server that took COMPRESS inflates chunks
+                mimetype = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+                packs = self.deflate is not None and file_compressible(mimetype, file_sample(f, size))
+                note = " (compressed)" if packs else ""
+                f.seek(offset)
+                while offset < size and self.upload_senders.get(uid) == sender:
+                    chunk = f.read(min(CHUNK_SIZE, size - offset))
                     if not chunk:
-                        break
-                    self.client_socket.sendall(chunk)
-                    sent += len(chunk)
+                        raise OSError(f"{filename} is shorter than when it was attached")
+                    header = f"{uid}::{offset}::{len(chunk)}::{hashlib.sha256(chunk).hexdigest()}"
+                    body = pack_chunk(chunk) if packs else None
+                    if body is None:
+                        body = chunk
+                    else:
+                        header += f"::{DEFLATE_NAME}::{len(body)}"
+                    channel.send_frame(CHUNK, header.encode(), body)
+                    offset += len(chunk)
                     # Update progress in status bar
-                    progress = (sent / filesize) * 100
-                    self.status_var.set(f"Sending {filename}: {progress:.1f}%")
-            
-            self.log(f"📤 File sent: {filename} ({self.format_size(filesize)})", "success")
-            self.status_var.set(f"File {filename} sent successfully")
-            
+                    progress = (offset / size) * 100
+                    self.set_status(f"Sending {filename}{note}: {progress:.1f}%")
         except Exception as e:
-            messagebox.showerror("File Send Error", 
-                               f"Could not send file:\n{e}\n\nConnection may be lost.")
-            self.status_var.set("Failed to send file")
+            self.log(f"⚠️ Could not send {filename}: {e}. Reconnect to resume the upload.", "error")
+            self.set_status("Failed to send file")
+
+    def upload_done(self, text):
+        uid, filename, digest, stored_as = text.split("::", 3)
+        # No id: the server already had the file and nothing was sent
+        file_path = self.uploads.pop(uid, None) if uid else self.pending_uploads.pop(filename, None)
+        self.upload_senders.pop(uid, None)
+        size = os.path.getsize(file_path) if file_path and os.path.exists(file_path) else 0
+        note = "" if uid else ", already on server"
+        if stored_as != filename:
+            note += f", saved as {stored_as}"
+        self.log(f"📤 File sent: {filename} ({self.format_size(size)}{note})", "success")
+        self.set_status(f"File {filename} sent successfully")
+
+    def download_file(self):
+        if not self.connected:
+            messagebox.showwarning("Not Connected", 
+                                "Please connect to the server first.\n\nClick 'Connect to Server' to establish connection.")
+            return
+
+        name = simpledialog.askstring("Download File", "File name on the server:",
+                                      initialvalue=self.last_shared_file, parent=self.root)
+        if not name:
+            return
+        save_path = filedialog.asksaveasfilename(title="Save file as", initialfile=name)
+        if not save_path:
+            return
+
+        # A shorter local copy is picked up where it stopped
+        offset = 0
+        if os.path.exists(save_path):
+            have = os.path.getsize(save_path)
+            if have and messagebox.askyesno("Resume Download",
+                                            f"{os.path.basename(save_path)} already has "
+                                            f"{self.format_size(have)}.\n\nResume from there?"):
+                offset = have
+            elif os.path.isfile(save_path):
+                open(save_path, "wb").close()
+
+        try:
+            self.pending_downloads[name] = save_path
+            self.transfer_channel().send_frame(GET, f"{name}::{offset}".encode())
+            self.set_status(f"Requested {name}...")
+        except Exception as e:
+            self.pending_downloads.pop(name, None)
+            messagebox.showerror("Download Error", 
+                               f"Could not request file:\n{e}\n\nConnection may be lost.")
+
+    def start_download(self, header, channel):
+        name, offset, length, total, _mimetype = header.split("::", 4)
+        offset, length, total = int(offset), int(length), int(total)
+        save_path = self.pending_downloads.pop(name, None)
+        f = None
+        if save_path:
+            f = open(save_path, "r+b" if os.path.exists(save_path) else "wb")
+            f.seek(offset)
+        # Unrequested bodies are read and thrown away to stay in sync
+        self.download = {"name": name, "file": f, "path": save_path, "offset": offset,
+                         "length": length, "total": total, "got": 0, "started": time.perf_counter(),
+                         "channel": channel}
+        if length:
+            channel.reader.expect_body(length)
+        else:
+            self.finish_download()
+
+    def write_download(self, chunk):
+        d = self.download
+        if d["file"]:
+            d["file"].write(chunk)
+        d["got"] += len(chunk)
+        if d["got"] == d["length"]:
+            self.finish_download()
+        else:
+            progress = (d["offset"] + d["got"]) / d["total"] * 100
+            self.set_status(f"Downloading {d['name']}: {progress:.1f}%")
+
+    def finish_download(self):
+        d, self.download = self.download, None
+        if not d["file"]:
+            return
+        if d["offset"] + d["length"] == d["total"]:
+            d["file"].truncate(d["total"])
+        d["file"].close()
+        elapsed = time.perf_counter() - d["started"]
+        self.log(f"📥 File saved: {d['path']} ({self.format_size(d['total'])}, "
+                 f"{self.format_size(d['got'])} in {elapsed:.1f}s)", "success")
+        self.set_status(f"File {d['name']} downloaded successfully")
+
+    def request_rooms(self):
+        if self.connected:
+            self.send_frame(ROOMS, b"")
+
+    def join_room(self):
+        room = proto.valid_name(self.room_var.get())
+        if room is None:
+            messagebox.showwarning("Room", f"Room names are 1-{proto.NAME_MAX} letters, "
+                                           f"digits, '-', '_' or '.'.")
+            return
+        if self.connected and room != self.room:
+            self.send_frame(JOIN, room.encode())
+
+    def leave_room(self):
+        if self.connected and self.room != DEFAULT_ROOM:
+            self.send_frame(LEAVE, b"")
+
+    def enter_room(self, answer):
+        """The server moved us into a room: show that room's conversation."""
+        room, _, members = answer.partition("::")
+        if room != self.room:
+            self.room = room
+            self.chat_box.config(state=tk.NORMAL)
+            self.chat_box.delete("1.0", tk.END)
+            self.chat_box.config(state=tk.DISABLED)
+        self.room_var.set(room)
+        self.room_title.set(f"💭 #{room}")
+        self.log(f"🏠 You are in #{room} ({members} here)", "system")
+        self.chat_box.mark_set("history", "end-1c")
+        self.chat_box.mark_gravity("history", tk.LEFT)
+        self.history_before = None
+        self.send_frame(HISTORY, str(HISTORY_PAGE).encode())
+
+    def show_rooms(self, answer):
+        fields = answer.split("::") if answer else []
+        rooms = sorted(zip(fields[::2], map(int, fields[1::2])), key=lambda r: -r[1])
+        self.room_box.config(values=[name for name, _ in rooms])
+
+    def load_older_history(self):
+        if self.connected and self.history_before:
+            self.history_btn.config(state=tk.DISABLED)
+            self.send_frame(HISTORY, f"{HISTORY_PAGE}::{self.history_before}".encode())
+
+    def show_history(self, end, page):
+        """Insert the page just received above the earlier pages."""
+        _, oldest, more = end.split("::")
+        lines = [f"[{time.strftime('%d %b %H:%M', time.localtime(float(when)))}] {text}\n"
+                 for when, text in page]
+        if lines:
+            self.chat_box.config(state=tk.NORMAL)
+            self.chat_box.insert("history", "".join(lines), "history")
+            self.chat_box.tag_configure("history", foreground="#9e9eb3")
+            self.chat_box.config(state=tk.DISABLED)
+        self.history_before = int(oldest) if more == "1" else None
+        self.history_btn.config(state=tk.NORMAL if self.history_before else tk.DISABLED)
 
     def format_size(self, size_bytes):
         """Format file size in human readable format"""
@@ -364,42 +858,111 @@ class PremiumClientGUI:
             size_bytes /= 1024.0
         return f"{size_bytes:.1f} TB"
 
+    def handle_frame(self, kind, payload, channel=None):
+        """Handle one frame from the chat connection or (``channel``) the file connection."""
+        channel = channel or self
+        if kind == BODY:
+            self.write_download(payload)
+            return
+        if kind == DEFLATE:
+            flags, frames = self.inflater.unpack(payload)
+            # An echo of our own line only keeps the stream in step
+            if not flags & ECHO:
+                for inner_kind, inner in frames:
+                    self.handle_frame(inner_kind, inner, channel)
+            return
+        if kind == PING:
+            # Answered on the connection it came in on
+            channel.send_frame(PONG, bytes(payload))
+            return
+        text = str(payload, "utf-8", "replace")
+        if kind == MSG:
+            self.log(text, "info")
+        elif kind == NOTIFY:
+            self.log(text, "system")
+            if " sent file " in text:
+                self.last_shared_file = text.rsplit(" sent file ", 1)[1]
+        elif kind == HISTORY:
+            _, when, line = text.split("::", 2)
+            self.history_page.append((when, line))
+        elif kind == HISTORY_END:
+            # The page is collected here; the chat box is only touched on the Tk thread
+            page, self.history_page = self.history_page, []
+            self.ui_events.append((self.show_history, (text, page)))
+        elif kind == COMPRESS:
+            if text == DEFLATE_NAME:
+                self.deflate = DeflateStream()
+                self.set_status(f"Connected to {HOST}:{PORT} (protocol v2, compressed)")
+        elif kind == NAME:
+            self.username = text
+            self.log(f"🪪 You are {text}", "system")
+        elif kind == DM:
+            self.ui_events.append((self.show_direct, (text,)))
+        elif kind == JOIN:
+            # A page of the room we just left is of no use any more
+            self.history_page = []
+            self.ui_events.append((self.enter_room, (text,)))
+        elif kind == ROOMS:
+            self.ui_events.append((self.show_rooms, (text,)))
+        elif kind == FILEDATA:
+            self.start_download(text, channel)
+        elif kind == UPLOADING:
+            uid, offset, size, filename = text.split("::", 3)
+            file_path = self.uploads.get(uid) or self.pending_uploads.pop(filename, None)
+            if file_path:
+                self.uploads[uid] = file_path
+                sender = self.upload_senders.get(uid, 0) + 1
+                self.upload_senders[uid] = sender
+                threading.Thread(target=self.send_chunks, args=(channel, uid, int(offset), int(size), sender),
+                                 daemon=True).start()
+        elif kind == DATA:
+            threading.Thread(target=self.open_data_channel, args=(text,), daemon=True).start()
+        elif kind == UPLOADED:
+            self.upload_done(text)
+        elif kind == ERROR:
+            self.log(f"⚠️ {text}", "error", box=self.dm_box if text.startswith("DM:") else None)
+            self.set_status(text)
+            command, _, detail = text.partition(" ")
+            if command in ("UPLOAD", "RESUME"):
+                # That upload is gone on the server; don't try to resume it again
+                self.uploads.pop(detail.split(":", 1)[0], None)
+        else:
+            self.log(f"[Unsupported frame type {kind}]", "warning")
+
     def receive_messages(self):
-        buffer = ""
+        reader = self.reader
         try:
+            # Frames already buffered during the handshake come first
+            for kind, payload in reader.events():
+                self.handle_frame(kind, payload)
             while True:
-                data = self.client_socket.recv(1024)
-                if not data:
+                n = self.client_socket.recv_into(reader.writable())
+                if not n:
                     break
-                
-                try:
-                    text = data.decode()
-                    buffer += text
-                    
-                    while '\n' in buffer:
-                        line, buffer = buffer.split('\n', 1)
-                        
-                        if line.startswith("MSG::"):
-                            body = line[5:]
-                            self.log(body, "info")
-                        elif line.startswith("NOTIFY::"):
-                            self.log(line[8:], "system")
-                        else:
-                            self.log(line, "info")
-                            
-                except UnicodeDecodeError:
-                    self.log("[Binary data received]", "warning")
+                reader.commit(n)
+                for kind, payload in reader.events():
+                    self.handle_frame(kind, payload)
                     
         except Exception as e:
             self.log(f"⚠️ Connection error: {e}", "error")
         finally:
+            if self.data:
+                self.data.close()
+            if self.download and self.download["file"]:
+                self.download["file"].close()
+            self.download = None
+            self.pending_downloads.clear()
             if self.client_socket:
                 self.client_socket.close()
             self.connected = False
-            self.conn_status.set("🔴 Disconnected")
-            self.connect_btn.config(text="Connect to Server")
+            self.ui_events.append((self.show_disconnected, ()))
             self.log("🔴 Server connection closed.", "system")
-            self.status_var.set("Disconnected from server")
+            self.set_status("Disconnected from server")
+
+    def show_disconnected(self):
+        self.conn_status.set("🔴 Disconnected")
+        self.connect_btn.config(text="Connect to Server")
+        self.history_btn.config(state=tk.DISABLED)
 
 def main():
     root = tk.Tk()
@@ -415,6 +978,8 @@ def main():
     def on_closing():
         if app.connected:
             try:
+                if app.data:
+                    app.data.close()
                 app.client_socket.close()
             except:
                 pass
@@ -0,0 +1,383 @@
+"""Load generator for the chat server: throughput and end-to-end broadcast latency.
+
+Opens N client connections on one event loop that speak the same protocol
+as client_gui_multi (HELLO::2 framing by default, ``--protocol 1`` for the
+legacy text lines). Senders timestamp every MSG they send. Every other
+client receives it as a broadcast, so each delivery gives one latency
+sample.
+
+    python loadgen.py --spawn --scenario chat --clients 200 --rate 500
+    python loadgen.py --host 127.0.0.1 --port 5050 --scenario all --json run.json
+
+Scenarios:
+
+* chat     steady chat between --clients connections
+* storm    chat while --storm-size extra clients join and leave every --storm-every seconds
+* slow     chat while --slow clients never read (the server's slow-consumer policy kicks in)
+* upload   chat while --uploads clients each send a --upload-size FILE at the same time
+
+``--spawn`` starts ``chat_server.py`` headless on loopback for the run. The
+load generator and the server share the machine, so run them on separate
+cores (or hosts) when the numbers matter.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import chat_protocol as proto
+from chat_protocol import HELLO, MSG, NOTIFY, FILE, PING, PONG
+
+SCENARIOS = ("chat", "storm", "slow", "upload")
+MARKER = b"LG "
+UPLOAD_BLOCK = 256 * 1024
+SLOW_RCVBUF = 4096
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(len(ordered) * p + 0.5) - 1))]
+
+
+class LoadClient(asyncio.BufferedProtocol):
+    """One simulated chat user, receiving with the same FrameReader as the GUI."""
+
+    def __init__(self, run, cid, version, read=True, measure=False):
+        self.run = run
+        self.id = cid
+        self.version = version
+        self.read = read
+        # Only the scenario's main clients count toward latency and loss.
+        self.measure = measure
+        self.reader = proto.FrameReader(version=None if version == 2 else 1)
+        self.transport = None
+        self.received = 0
+        self.notices = 0
+        self.lost = asyncio.get_running_loop().create_future()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.version == 2:
+            # Frames sent right behind HELLO are already read as v2.
+            transport.write(proto.HELLO_LINE)
+        if not self.read:
+            transport.pause_reading()
+
+    def get_buffer(self, sizehint):
+        return self.reader.writable()
+
+    def buffer_updated(self, nbytes):
+        self.reader.commit(nbytes)
+        now = time.perf_counter_ns()
+        for kind, payload in self.reader.events():
+            if kind == HELLO:
+                self.reader.version = 2
+            elif kind == MSG:
+                i = bytes(payload[:96]).find(MARKER) if self.measure else -1
+                if i >= 0:
+                    sent = int(bytes(payload[i:i + 64]).split(b" ", 4)[3])
+                    self.run.latencies.append(now - sent)
+                    self.received += 1
+            elif kind == NOTIFY:
+                self.notices += 1
+            elif kind == PING:
+                # Clients that only listen would be reaped in long runs otherwise.
+                self.send(PONG, str(payload, "ascii"))
+
+    def connection_lost(self, exc):
+        if not self.lost.done():
+            self.lost.set_result(exc)
+
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+    def send(self, kind, text):
+        self.transport.write(proto.encode(self.version, kind, text.encode()))
+
+    async def send_file(self, name, size, mimetype="application/octet-stream"):
+        self.send(FILE, f"{name}::{size}::{mimetype}")
+        block = os.urandom(min(size, UPLOAD_BLOCK))
+        left = size
+        while left and not self.lost.done():
+            n = min(left, len(block))
+            self.transport.write(block[:n])
+            left -= n
+            await self._writable.wait()
+        return size - left
+
+
+class Run:
+    """Clients, counters and latency samples of one scenario."""
+
+    def __init__(self, args):
+        self.args = args
+        self.loop = asyncio.get_running_loop()
+        self.clients = []
+        self.latencies = []
+        self.sent = 0
+        self.expected = 0
+        self._ids = 0
+
+    async def connect(self, read=True, measure=False):
+        self._ids += 1
+        cid = self._ids
+        factory = lambda: LoadClient(self, cid, self.args.protocol, read, measure)
+        if read:
+            _, client = await self.loop.create_connection(factory, self.args.host, self.args.port)
+            return client
+        # A client that never reads gets a tiny receive window, so the
+        # server's queue for it fills in seconds rather than megabytes.
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SLOW_RCVBUF)
+        sock.setblocking(False)
+        await self.loop.sock_connect(sock, (self.args.host, self.args.port))
+        _, client = await self.loop.create_connection(factory, sock=sock)
+        return client
+
+    async def connect_many(self, count, read=True, measure=False):
+        # In batches, so the listen backlog is not the thing being measured.
+        clients = []
+        for start in range(0, count, 100):
+            clients += await asyncio.gather(
+                *(self.connect(read, measure) for _ in range(min(100, count - start))))
+        return clients
+
+    async def sender(self, client, rate, until):
+        interval = 1.0 / rate
+        padding = "x" * max(0, self.args.size - 40)
+        seq = 0
+        next_at = self.loop.time()
+        while not client.lost.done():
+            now = self.loop.time()
+            if now >= until:
+                return
+            if next_at > now:
+                await asyncio.sleep(next_at - now)
+            # Open loop: keep the schedule even if we fell behind.
+            next_at += interval
+            seq += 1
+            client.send(MSG, f"LG {client.id} {seq} {time.perf_counter_ns()} {padding}")
+            self.sent += 1
+            self.expected += sum(1 for c in self.clients if c is not client and not c.lost.done())
+
+    async def chat(self, duration):
+        """Steady chat from --senders of the main clients; returns the sending time."""
+        senders = self.clients[:self.args.senders or len(self.clients)]
+        rate = self.args.rate / len(senders)
+        started = self.loop.time()
+        until = started + duration
+        await asyncio.gather(*(self.sender(c, rate, until) for c in senders))
+        elapsed = self.loop.time() - started
+        # Let the last broadcasts arrive.
+        await asyncio.sleep(self.args.settle)
+        return elapsed
+
+    def report(self, elapsed):
+        ordered = sorted(self.latencies)
+        ms = lambda ns: None if ns is None else round(ns / 1e6, 3)
+        return {
+            "clients": len(self.clients),
+            "sent": self.sent,
+            "delivered": len(ordered),
+            "expected": self.expected,
+            "lost": max(0, self.expected - len(ordered)),
+            "elapsed_s": round(elapsed, 3),
+            "send_rate": round(self.sent / elapsed, 1),
+            "delivery_rate": round(len(ordered) / elapsed, 1),
+            "latency_ms": {
+                "p50": ms(percentile(ordered, 0.50)),
+                "p99": ms(percentile(ordered, 0.99)),
+                "p999": ms(percentile(ordered, 0.999)),
+                "max": ms(ordered[-1] if ordered else None),
+            },
+        }
+
+    def close(self, clients=None):
+        for client in clients if clients is not None else self.clients:
+            client.transport.abort()
+
+
+async def scenario_chat(run):
+    run.clients = await run.connect_many(run.args.clients, measure=True)
+    await asyncio.sleep(run.args.settle)
+    return run.report(await run.chat(run.args.duration))
+
+
+async def scenario_storm(run):
+    args = run.args
+    run.clients = await run.connect_many(args.clients, measure=True)
+    await asyncio.sleep(args.settle)
+    storms = []
+
+    async def storm(until):
+        while run.loop.time() < until:
+            started = time.perf_counter()
+            extra = await run.connect_many(args.storm_size)
+            joined = time.perf_counter() - started
+            await asyncio.sleep(args.storm_every / 2)
+            run.close(extra)
+            storms.append(round(joined * 1000, 3))
+            await asyncio.sleep(args.storm_every / 2)
+
+    until = run.loop.time() + args.duration
+    elapsed, _ = await asyncio.gather(run.chat(args.duration), storm(until))
+    result = run.report(elapsed)
+    result["storms"] = {"count": len(storms), "size": args.storm_size, "connect_ms": storms}
+    return result
+
+
+async def scenario_slow(run):
+    args = run.args
+    run.clients = await run.connect_many(args.clients, measure=True)
+    slow = await run.connect_many(args.slow, read=False)
+    await asyncio.sleep(args.settle)
+    result = run.report(await run.chat(args.duration))
+    # A paused transport never sees the server's reset; read to find out.
+    for client in slow:
+        client.transport.resume_reading()
+    await asyncio.sleep(args.settle)
+    result["slow"] = {"count": len(slow), "dropped": sum(1 for c in slow if c.lost.done())}
+    run.close(slow)
+    return result
+
+
+async def scenario_upload(run):
+    args = run.args
+    run.clients = await run.connect_many(args.clients, measure=True)
+    uploaders = await run.connect_many(args.uploads)
+    await asyncio.sleep(args.settle)
+
+    started = time.perf_counter()
+
+    async def upload(client):
+        sent = await client.send_file(f"loadgen-{client.id}.bin", args.upload_size)
+        return sent, time.perf_counter() - started
+
+    elapsed, uploads = await asyncio.gather(
+        run.chat(args.duration), asyncio.gather(*(upload(c) for c in uploaders)))
+    result = run.report(elapsed)
+    # Written into the socket; the server may still be flushing the tail to disk.
+    total = sum(sent for sent, _ in uploads)
+    longest = max((t for _, t in uploads), default=0)
+    result["uploads"] = {
+        "count": len(uploads),
+        "bytes_each": args.upload_size,
+        "mb_per_s_each": [round(sent / 2 ** 20 / t, 1) for sent, t in uploads if t > 0],
+        "aggregate_mb_per_s": round(total / 2 ** 20 / longest, 1) if longest else None,
+    }
+    run.close(uploaders)
+    return result
+
+
+async def run_scenario(name, args):
+    run = Run(args)
+    try:
+        return await globals()[f"scenario_{name}"](run)
+    finally:
+        run.close()
+        await asyncio.sleep(0.1)
+
+
+def spawn_server(args, upload_dir):
+    """Start chat_server.py headless on loopback and wait until it accepts."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    cmd = [sys.executable, os.path.join(here, "chat_server.py"), "--host", args.host,
+           "--port", str(args.port), "--upload-dir", upload_dir, "--log-level", "ERROR",
+           # Every simulated client comes from loopback and each may send
+           # faster than a person types; --server-arg can set them back.
+           "--max-per-ip", "0", "--message-rate", "0"]
+    cmd += args.server_args
+    proc = subprocess.Popen(cmd)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection((args.host, args.port), timeout=0.5).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                proc.kill()
+                raise SystemExit(f"server did not start: {' '.join(cmd)}")
+            time.sleep(0.1)
+
+
+def print_result(name, result):
+    lat = result["latency_ms"]
+    print(f"{name:>7}: {result['clients']} clients, sent {result['send_rate']}/s, "
+          f"delivered {result['delivery_rate']}/s, lost {result['lost']}, "
+          f"latency p50 {lat['p50']} ms  p99 {lat['p99']} ms  p999 {lat['p999']} ms")
+    for extra in ("storms", "slow", "uploads"):
+        if extra in result:
+            print(f"{'':>9}{extra}: {result[extra]}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--spawn", action="store_true",
+                        help="start a headless chat_server.py for the run")
+    parser.add_argument("--server-arg", dest="server_args", action="append", default=[],
+                        help="extra argument for the spawned server (repeatable)")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=2)
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="chat")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--senders", type=int, default=10,
+                        help="clients that send (0: all of them)")
+    parser.add_argument("--rate", type=float, default=200.0, help="messages/s over all senders")
+    parser.add_argument("--size", type=int, default=100, help="message text length")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of chat per scenario")
+    parser.add_argument("--settle", type=float, default=1.0,
+                        help="seconds to wait after connecting and after the last message")
+    parser.add_argument("--storm-size", type=int, default=200)
+    parser.add_argument("--storm-every", type=float, default=2.0)
+    parser.add_argument("--slow", type=int, default=10)
+    parser.add_argument("--uploads", type=int, default=4)
+    parser.add_argument("--upload-size", type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    proc = upload_dir = None
+    results = {}
+    try:
+        if args.spawn:
+            # Removed again below, with everything the scenarios uploaded
+            upload_dir = tempfile.mkdtemp(prefix="loadgen-uploads-")
+            proc = spawn_server(args, upload_dir)
+        for name in SCENARIOS if args.scenario == "all" else (args.scenario,):
+            results[name] = asyncio.run(run_scenario(name, args))
+            print_result(name, results[name])
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=10)
+        if upload_dir:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+    if args.json:
+        report = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {k: v for k, v in vars(args).items() if k != "json"},
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
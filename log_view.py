@@ -0,0 +1,240 @@
+"""Bounded, virtualized log view for the server control panel.
+
+LogBuffer keeps the newest ``capacity`` entries in preallocated parallel
+arrays, so the panel's memory stays flat however long the server has been
+up. LogView draws only the rows that fit in the window from that buffer. It
+can filter by level and search text without ever putting the whole
+history into the Tk text widget.
+"""
+import bisect
+import time
+import tkinter as tk
+import tkinter.font as tkfont
+from array import array
+from tkinter import ttk
+
+DEFAULT_CAPACITY = 20000
+ALL_LEVELS = "All levels"
+SEARCH_DELAY_MS = 200
+
+
+class LogBuffer:
+    """Fixed-capacity ring of (timestamp, level, text) entries.
+
+    Every entry gets a sequence number. When the ring is full the oldest
+    entry is overwritten, and ``first_seq`` moves forward.
+    """
+
+    def __init__(self, levels, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.levels = list(levels)
+        self.level_index = {name: i for i, name in enumerate(self.levels)}
+        self.times = array("d", bytes(8 * capacity))
+        self.kinds = bytearray(capacity)
+        self.texts = [None] * capacity
+        self.next_seq = 0
+        self.cleared_seq = 0
+
+    @property
+    def first_seq(self):
+        return max(self.cleared_seq, self.next_seq - self.capacity)
+
+    def __len__(self):
+        return self.next_seq - self.first_seq
+
+    def append(self, when, level, text):
+        seq = self.next_seq
+        i = seq % self.capacity
+        self.times[i] = when
+        self.kinds[i] = self.level_index.get(level, 0)
+        self.texts[i] = text
+        self.next_seq = seq + 1
+        return seq
+
+    def get(self, seq):
+        i = seq % self.capacity
+        return self.times[i], self.levels[self.kinds[i]], self.texts[i]
+
+    def clear(self):
+        self.texts = [None] * self.capacity
+        self.cleared_seq = self.next_seq
+
+    def matches(self, seq, level=None, needle=""):
+        """Whether entry ``seq`` has ``level`` (None: any) and contains ``needle`` (lower case)."""
+        i = seq % self.capacity
+        if level is not None and self.kinds[i] != self.level_index[level]:
+            return False
+        return not needle or needle in self.texts[i].lower()
+
+    def search(self, level=None, needle=""):
+        """Sequence numbers of all entries that match, oldest first."""
+        needle = needle.lower()
+        return [seq for seq in range(self.first_seq, self.next_seq)
+                if self.matches(seq, level, needle)]
+
+
+class LogView(ttk.Frame):
+    """Level filter, search box and a text widget that shows one window of a LogBuffer.
+
+    ``levels`` maps a level name to ``(emoji, color)``. Call ``append()`` for
+    every entry and then ``refresh()`` once per batch. While the view is
+    scrolled to the bottom it follows new entries.
+    """
+
+    def __init__(self, parent, levels, capacity=DEFAULT_CAPACITY, style=None, **text_options):
+        super().__init__(parent, style=style)
+        self.levels = levels
+        self.buffer = LogBuffer(levels, capacity)
+        # Matching sequence numbers while a filter or search is active
+        self.filtered = None
+        self.level = None
+        self.needle = ""
+        self.top_seq = 0
+        self.follow = True
+        self._search_job = None
+
+        toolbar = ttk.Frame(self, style=style)
+        toolbar.pack(fill=tk.X, pady=(0, 5))
+        self.level_var = tk.StringVar(value=ALL_LEVELS)
+        level_box = ttk.Combobox(toolbar, textvariable=self.level_var, state="readonly", width=12,
+                                 values=[ALL_LEVELS] + list(levels))
+        level_box.pack(side=tk.LEFT)
+        level_box.bind("<<ComboboxSelected>>", lambda e: self.apply_filter())
+        self.search_var = tk.StringVar()
+        search = ttk.Entry(toolbar, textvariable=self.search_var, width=30)
+        search.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(10, 10))
+        search.bind("<KeyRelease>", self._search_later)
+        self.count_var = tk.StringVar(value="0 entries")
+        ttk.Label(toolbar, textvariable=self.count_var, style="Subtitle.TLabel").pack(side=tk.RIGHT)
+
+        body = ttk.Frame(self, style=style)
+        body.pack(fill=tk.BOTH, expand=True)
+        self.text = tk.Text(body, wrap=tk.NONE, state=tk.DISABLED, **text_options)
+        self.scrollbar = ttk.Scrollbar(body, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        for level, (_, color) in levels.items():
+            self.text.tag_configure(level, foreground=color)
+        self.linespace = tkfont.Font(font=self.text.cget("font")).metrics("linespace")
+
+        self.text.bind("<Configure>", lambda e: self.refresh())
+        self.text.bind("<MouseWheel>", lambda e: self._scroll(-1 if e.delta > 0 else 1, 3))
+        self.text.bind("<Button-4>", lambda e: self._scroll(-1, 3))
+        self.text.bind("<Button-5>", lambda e: self._scroll(1, 3))
+
+    # ---- entries
+
+    def append(self, when, level, text):
+        seq = self.buffer.append(when, level, text)
+        if self.filtered is not None and self.buffer.matches(seq, self.level, self.needle):
+            self.filtered.append(seq)
+
+    def clear(self):
+        self.buffer.clear()
+        if self.filtered is not None:
+            self.filtered = []
+        self.follow = True
+        self.refresh()
+
+    def apply_filter(self):
+        level = self.level_var.get()
+        self.level = None if level == ALL_LEVELS else level
+        self.needle = self.search_var.get().strip().lower()
+        if self.level is None and not self.needle:
+            self.filtered = None
+        else:
+            self.filtered = self.buffer.search(self.level, self.needle)
+        self.follow = True
+        self.refresh()
+
+    def _search_later(self, event):
+        if self._search_job is not None:
+            self.after_cancel(self._search_job)
+        self._search_job = self.after(SEARCH_DELAY_MS, self._search_now)
+
+    def _search_now(self):
+        self._search_job = None
+        self.apply_filter()
+
+    # ---- positions: row n of the view is the n-th matching entry still in the ring
+
+    def _trim(self):
+        first = self.buffer.first_seq
+        if self.filtered and self.filtered[0] < first:
+            del self.filtered[:bisect.bisect_left(self.filtered, first)]
+
+    def _size(self):
+        return len(self.buffer) if self.filtered is None else len(self.filtered)
+
+    def _position(self, seq):
+        if self.filtered is None:
+            return max(0, seq - self.buffer.first_seq)
+        return bisect.bisect_left(self.filtered, seq)
+
+    def _seq_at(self, pos):
+        if self.filtered is None:
+            return self.buffer.first_seq + pos
+        return self.filtered[pos]
+
+    def rows(self):
+        height = self.text.winfo_height()
+        if height <= 1:
+            return int(self.text.cget("height"))
+        pady = int(self.text.cget("pady"))
+        return max(1, (height - 2 * pady) // self.linespace)
+
+    # ---- scrolling
+
+    def yview(self, *args):
+        """Scrollbar command: ("moveto", fraction) or ("scroll", n, "units"|"pages")."""
+        if args[0] == "moveto":
+            self._scroll_to(int(float(args[1]) * self._size()))
+        elif args[0] == "scroll":
+            self._scroll(int(args[1]), self.rows() if args[2] == "pages" else 1)
+
+    def _scroll(self, direction, step):
+        self._trim()
+        self._scroll_to(self._position(self.top_seq) + direction * step)
+
+    def _scroll_to(self, pos):
+        size, rows = self._size(), self.rows()
+        pos = max(0, min(pos, size - rows))
+        self.follow = pos + rows >= size
+        if size:
+            self.top_seq = self._seq_at(pos)
+        self.refresh()
+
+    # ---- drawing
+
+    def refresh(self):
+        """Redraw the visible rows only."""
+        self._trim()
+        size, rows = self._size(), self.rows()
+        if self.follow:
+            top = max(0, size - rows)
+        else:
+            top = max(0, min(self._position(self.top_seq), size - rows))
+        end = min(size, top + rows)
+        if top < size:
+            self.top_seq = self._seq_at(top)
+
+        chunks = []
+        for pos in range(top, end):
+            when, level, text = self.buffer.get(self._seq_at(pos))
+            emoji = self.levels[level][0]
+            stamp = time.strftime("%H:%M:%S", time.localtime(when))
+            chunks += (f"[{stamp}] {emoji} {text.replace(chr(10), ' ')}\n", level)
+
+        self.text.config(state=tk.NORMAL)
+        self.text.delete("1.0", tk.END)
+        if chunks:
+            self.text.insert(tk.END, *chunks)
+        self.text.config(state=tk.DISABLED)
+        if size:
+            self.scrollbar.set(top / size, end / size)
+        else:
+            self.scrollbar.set(0.0, 1.0)
+        if self.filtered is None:
+            self.count_var.set(f"{size} entries")
+        else:
+            self.count_var.set(f"{size} of {len(self.buffer)} entries")
@@ -1,24 +1,77 @@
 
+import collections
 import socket
-import threading
-import os
+import time
 import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox
+from tkinter import ttk, messagebox
 from PIL import Image, ImageTk
-import pathlib
-from datetime import datetime
 
-HOST = '0.0.0.0'
-PORT = 5050
-UPLOAD_DIR = "uploads"
+from chat_server import ChatServer, ServerObserver, HOST, PORT, UPLOAD_DIR
+from chat_protocol import MSG
+from chat_federation import Federation
+from log_view import LogView
 
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+# Queued UI updates are applied every UI_TICK_MS; counters are redrawn every
+# STATS_TICK_MS however busy the server is.
+UI_TICK_MS = 50
+STATS_TICK_MS = 500
+# Per-client traffic table refresh; rates are averaged over one tick.
+TRAFFIC_TICK_MS = 1000
 
-class PremiumMultiServerGUI:
+# Federation: other servers to relay broadcasts with, as (host, port) of
+# their federation ports, and the port this one accepts them on (None: none).
+PEERS = []
+FEDERATION_PORT = None
+
+# Traffic table: (column id, heading, width)
+TRAFFIC_COLUMNS = (
+    ("client", "Client", 150),
+    ("room", "Room", 90),
+    ("connected", "Connected", 80),
+    ("idle", "Idle", 60),
+    ("bytes_in", "In", 80),
+    ("bytes_out", "Out", 80),
+    ("frames", "Frames in/out", 110),
+    ("msg_rate", "Msg/s", 60),
+    ("queued", "Queue", 60),
+    ("upload_rate", "Upload/s", 80),
+    ("throttled", "Throttled", 70),
+)
+# Rooms table: (column id, heading, width)
+ROOM_COLUMNS = (
+    ("room", "Room", 110),
+    ("members", "Members", 70),
+    ("msg_rate", "Msg/s", 60),
+)
+
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 3600:
+        return f"{seconds // 60}:{seconds % 60:02d}"
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+
+
+def limits_text(server):
+    """The admission limits of ``server`` on one short line ("∞" where off)."""
+    limits = server.limits
+    rate = f"{server.message_rate:g}" if server.message_rate else "∞"
+    upload = f"{format_bytes(server.upload_rate)}/s" if server.upload_rate else "∞"
+    return f"{limits.max_total or '∞'} conns · {limits.max_per_ip or '∞'}/IP · {rate} msg/s · upload {upload}"
+
+
+class PremiumMultiServerGUI(ServerObserver):
     def __init__(self, root):
         self.root = root
         root.title("🚀Chat Server - Control Panel")
-        root.geometry("900x800")
+        root.geometry("1200x950")
         root.resizable(True, True)
         
         # Modern color scheme
@@ -34,6 +87,28 @@ class PremiumMultiServerGUI:
         root.configure(bg=self.bg_color)
         self.setup_styles()
         
+        self.log_levels = {
+            "info": ("ℹ️", self.text_color),
+            "success": ("✅", self.success_color),
+            "warning": ("⚠️", self.warning_color),
+            "error": ("❌", self.error_color),
+            "system": ("🔧", self.accent_color),
+            "broadcast": ("📢", "#f59e0b")  # Special color for broadcast messages
+        }
+        # Filled from any thread (deque appends are atomic), drained on the Tk thread
+        self.ui_events = collections.deque()
+        self.clients_dirty = False
+        # Connection ids in listbox order, and the text each row shows
+        self.client_rows = []
+        self.client_labels = {}
+        # Traffic table: sort keys per row, last counters per connection id
+        # (for rates), and the column it is sorted by
+        self.traffic_rows = {}
+        self.traffic_prev = {}
+        self.traffic_sort = ("bytes_out", True)
+        # Rooms table: last message count per room name (for rates)
+        self.rooms_prev = {}
+        
         # Create header
         self.create_header()
         
@@ -53,17 +128,22 @@ class PremiumMultiServerGUI:
         # Chat and clients area
         self.create_chat_clients_area(main_container)
         
+        # Per-client traffic and per-room activity, side by side
+        activity = ttk.Frame(main_container, style="Card.TFrame")
+        activity.pack(fill=tk.X)
+        self.create_traffic_panel(activity)
+        self.create_rooms_panel(activity)
+        
         # Status bar
         self.create_status_bar()
         
         # Initialize server variables
-        self.server_socket = None
-        self.accept_thread = None
+        self.server = None
         self.running = False
-        self.clients = []
-        self.lock = threading.Lock()
-        self.message_count = 0
-        self.file_count = 0
+        
+        self.root.after(UI_TICK_MS, self.pump_ui)
+        self.root.after(STATS_TICK_MS, self.refresh_stats)
+        self.root.after(TRAFFIC_TICK_MS, self.refresh_traffic)
 
     def setup_styles(self):
         style = ttk.Style()
@@ -115,6 +195,18 @@ class PremiumMultiServerGUI:
                        foreground="#94a3b8",
                        font=("Segoe UI", 10))
         
+        # Traffic table
+        style.configure("Traffic.Treeview",
+                       background=self.sidebar_color,
+                       fieldbackground=self.sidebar_color,
+                       foreground=self.text_color,
+                       font=("Consolas", 9))
+        style.configure("Traffic.Treeview.Heading",
+                       background=self.card_color,
+                       foreground=self.text_color,
+                       font=("Segoe UI", 9, "bold"))
+        style.map("Traffic.Treeview", background=[('selected', self.accent_color)])
+        
         # Entry style
         style.configure("Modern.TEntry",
                        fieldbackground=self.sidebar_color,
@@ -261,12 +353,32 @@ class PremiumMultiServerGUI:
         
         # Files
         file_card = ttk.Frame(stats_container, style="Sidebar.TFrame", relief='raised', borderwidth=1)
-        file_card.pack(side=tk.LEFT)
+        file_card.pack(side=tk.LEFT, padx=(0, 15))
         
         ttk.Label(file_card, text="Files Shared", style="StatTitle.TLabel").pack(pady=(10, 0))
         self.file_count_var = tk.StringVar(value="0")
         ttk.Label(file_card, textvariable=self.file_count_var, style="Stat.TLabel").pack(pady=(0, 10))
         file_card.configure(padding=20)
+        
+        # Slow consumers (lagging now / dropped so far)
+        slow_card = ttk.Frame(stats_container, style="Sidebar.TFrame", relief='raised', borderwidth=1)
+        slow_card.pack(side=tk.LEFT, padx=(0, 15))
+        
+        ttk.Label(slow_card, text="Lagging / Dropped", style="StatTitle.TLabel").pack(pady=(10, 0))
+        self.slow_count_var = tk.StringVar(value="0 / 0")
+        ttk.Label(slow_card, textvariable=self.slow_count_var, style="Stat.TLabel").pack(pady=(0, 10))
+        slow_card.configure(padding=20)
+        
+        # Admission control (connections refused / messages and uploads throttled) and its limits
+        limit_card = ttk.Frame(stats_container, style="Sidebar.TFrame", relief='raised', borderwidth=1)
+        limit_card.pack(side=tk.LEFT)
+        
+        ttk.Label(limit_card, text="Refused / Throttled", style="StatTitle.TLabel").pack(pady=(10, 0))
+        self.limit_count_var = tk.StringVar(value="0 / 0")
+        ttk.Label(limit_card, textvariable=self.limit_count_var, style="Stat.TLabel").pack()
+        self.limits_var = tk.StringVar(value="")
+        ttk.Label(limit_card, textvariable=self.limits_var, style="StatTitle.TLabel").pack(pady=(0, 10))
+        limit_card.configure(padding=20)
 
     def create_chat_clients_area(self, parent):
         chat_clients_frame = ttk.Frame(parent, style="Card.TFrame")
@@ -284,9 +396,11 @@ class PremiumMultiServerGUI:
         ttk.Label(chat_frame, text="💬 Server Log & Chat Monitor", 
                  style="Subtitle.TLabel").pack(anchor="w", pady=(0, 5))
         
-        self.chat_box = scrolledtext.ScrolledText(
+        # Keeps the newest entries only and draws just the visible rows
+        self.log_view = LogView(
             chat_frame,
-            wrap=tk.WORD,
+            self.log_levels,
+            style="Card.TFrame",
             width=60,
             height=20,
             bg=self.sidebar_color,
@@ -298,7 +412,7 @@ class PremiumMultiServerGUI:
             padx=15,
             pady=15
         )
-        self.chat_box.pack(fill=tk.BOTH, expand=True)
+        self.log_view.pack(fill=tk.BOTH, expand=True)
         
         # Clients panel
         clients_frame = ttk.Frame(chat_clients_frame, style="Card.TFrame")
@@ -336,6 +450,54 @@ class PremiumMultiServerGUI:
         ttk.Button(client_controls, text="📊 Client Info", 
                   style="Accent.TButton", command=self.show_client_info).pack(fill=tk.X, pady=(5, 0))
 
+    def create_traffic_panel(self, parent):
+        traffic_frame = ttk.Frame(parent, style="Card.TFrame")
+        traffic_frame.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        
+        ttk.Label(traffic_frame, text="📈 Client Traffic (click a heading to sort)", 
+                 style="Subtitle.TLabel").pack(anchor="w", pady=(0, 5))
+        
+        self.traffic_tree = ttk.Treeview(
+            traffic_frame,
+            columns=[c for c, _, _ in TRAFFIC_COLUMNS],
+            show="headings",
+            height=6,
+            style="Traffic.Treeview"
+        )
+        for column, heading, width in TRAFFIC_COLUMNS:
+            self.traffic_tree.heading(column, text=heading,
+                                      command=lambda c=column: self.sort_traffic(c))
+            self.traffic_tree.column(column, width=width,
+                                     anchor=tk.W if column in ("client", "room") else tk.E)
+        
+        scrollbar = ttk.Scrollbar(traffic_frame, orient=tk.VERTICAL, command=self.traffic_tree.yview)
+        self.traffic_tree.configure(yscrollcommand=scrollbar.set)
+        self.traffic_tree.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+    def create_rooms_panel(self, parent):
+        rooms_frame = ttk.Frame(parent, style="Card.TFrame")
+        rooms_frame.pack(side=tk.RIGHT, fill=tk.Y, padx=(15, 0))
+        
+        ttk.Label(rooms_frame, text="🏠 Rooms", 
+                 style="Subtitle.TLabel").pack(anchor="w", pady=(0, 5))
+        
+        self.rooms_tree = ttk.Treeview(
+            rooms_frame,
+            columns=[c for c, _, _ in ROOM_COLUMNS],
+            show="headings",
+            height=6,
+            style="Traffic.Treeview"
+        )
+        for column, heading, width in ROOM_COLUMNS:
+            self.rooms_tree.heading(column, text=heading)
+            self.rooms_tree.column(column, width=width, anchor=tk.W if column == "room" else tk.E)
+        
+        scrollbar = ttk.Scrollbar(rooms_frame, orient=tk.VERTICAL, command=self.rooms_tree.yview)
+        self.rooms_tree.configure(yscrollcommand=scrollbar.set)
+        self.rooms_tree.pack(side=tk.LEFT, fill=tk.Y)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
     def create_status_bar(self):
         status_frame = ttk.Frame(self.root, style="Sidebar.TFrame")
         status_frame.pack(fill=tk.X, side=tk.BOTTOM)
@@ -350,38 +512,162 @@ class PremiumMultiServerGUI:
                  foreground="#94a3b8").pack(side=tk.RIGHT, padx=10, pady=5)
 
     def log(self, text, level="info"):
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        levels = {
-            "info": ("ℹ️", self.text_color),
-            "success": ("✅", self.success_color),
-            "warning": ("⚠️", self.warning_color),
-            "error": ("❌", self.error_color),
-            "system": ("🔧", self.accent_color),
-            "broadcast": ("📢", "#f59e0b")  # Special color for broadcast messages
-        }
-        
-        emoji, color = levels.get(level, ("ℹ️", self.text_color))
-        formatted_text = f"[{timestamp}] {emoji} {text}"
-        
-        self.chat_box.config(state=tk.NORMAL)
-        self.chat_box.insert(tk.END, formatted_text + "\n", level)
-        self.chat_box.tag_configure(level, foreground=color)
-        self.chat_box.config(state=tk.DISABLED)
-        self.chat_box.yview(tk.END)
-        
-        if level == "info":
-            self.message_count += 1
-            self.msg_count_var.set(str(self.message_count))
+        # Safe from any thread: only queued here, drawn by pump_ui()
+        self.ui_events.append(("log", time.time(), text, level))
+
+    def pump_ui(self):
+        """Apply everything queued since the last tick, then redraw the log once."""
+        events = self.ui_events
+        logged = False
+        files = []
+        for _ in range(len(events)):
+            event = events.popleft()
+            if event[0] == "log":
+                self.log_view.append(*event[1:])
+                logged = True
+            else:
+                files.append(event[1:])
+        
+        if logged:
+            self.log_view.refresh()
+        for addr, path, mimetype in files:
+            self.show_received_file(addr, path, mimetype)
+        
+        self.root.after(UI_TICK_MS, self.pump_ui)
+
+    def refresh_stats(self):
+        """Redraw the counters (and the client list if it changed) at a fixed rate."""
+        if self.clients_dirty:
+            self.clients_dirty = False
+            self.refresh_clients_list()
+        if self.server:
+            self.msg_count_var.set(str(self.server.message_count))
+            self.file_count_var.set(str(self.server.file_count))
+            self.limit_count_var.set(f"{self.server.limits.refused} / "
+                                     f"{self.server.throttled_messages + self.server.upload_throttles}")
+        self.root.after(STATS_TICK_MS, self.refresh_stats)
+
+    def refresh_traffic(self):
+        """Update the traffic table in place, with rates since the previous tick."""
+        now = time.time()
+        records = self.server.traffic_snapshot() if self.server else []
+        tree = self.traffic_tree
+        prev, self.traffic_prev = self.traffic_prev, {}
+        self.traffic_rows = {}
+        
+        for r in records:
+            iid = str(r.id)
+            then, messages, uploaded = prev.get(r.id, (r.connected_at, 0, 0))
+            elapsed = max(now - then, 1e-3)
+            self.traffic_prev[r.id] = (now, r.messages, r.upload_bytes)
+            # Sort keys; the displayed strings are derived from them
+            row = {
+                "client": self.client_label(r.addr, False, r.name),
+                "room": r.room,
+                "connected": now - r.connected_at,
+                "idle": now - r.last_active,
+                "bytes_in": r.bytes_in,
+                "bytes_out": r.bytes_out,
+                "frames": r.frames_in + r.frames_out,
+                "msg_rate": (r.messages - messages) / elapsed,
+                "queued": r.queued,
+                "upload_rate": (r.upload_bytes - uploaded) / elapsed,
+                "throttled": r.throttled,
+            }
+            self.traffic_rows[iid] = row
+            values = (
+                ("🐢 " if r.lagging else "") + row["client"],
+                f"#{r.room}",
+                format_duration(row["connected"]),
+                f"{row['idle']:.0f}s",
+                format_bytes(r.bytes_in),
+                format_bytes(r.bytes_out),
+                f"{r.frames_in}/{r.frames_out}",
+                f"{row['msg_rate']:.1f}",
+                str(r.queued),
+                format_bytes(row["upload_rate"]),
+                str(r.throttled),
+            )
+            if tree.exists(iid):
+                tree.item(iid, values=values)
+            else:
+                tree.insert("", tk.END, iid=iid, values=values)
+        
+        for iid in tree.get_children():
+            if iid not in self.traffic_rows:
+                tree.delete(iid)
+        self.apply_traffic_sort()
+        self.refresh_rooms(now)
+        self.root.after(TRAFFIC_TICK_MS, self.refresh_traffic)
+
+    def refresh_rooms(self, now):
+        """Member counts and message rates per room, busiest room first."""
+        rooms = self.server.rooms_snapshot() if self.server else []
+        tree = self.rooms_tree
+        prev, self.rooms_prev = self.rooms_prev, {}
+        rates = {}
+        for room in rooms:
+            # A room seen for the first time starts at 0 msg/s
+            then, messages = prev.get(room.name, (now, room.messages))
+            self.rooms_prev[room.name] = (now, room.messages)
+            rates[room.name] = max(0, room.messages - messages) / max(now - then, 1e-3)
+        
+        rooms.sort(key=lambda r: (r.members, rates[r.name]), reverse=True)
+        for index, room in enumerate(rooms):
+            values = (f"#{room.name}", str(room.members), f"{rates[room.name]:.1f}")
+            if tree.exists(room.name):
+                tree.item(room.name, values=values)
+                tree.move(room.name, "", index)
+            else:
+                tree.insert("", index, iid=room.name, values=values)
+        for iid in tree.get_children():
+            if iid not in self.rooms_prev:
+                tree.delete(iid)
+
+    def sort_traffic(self, column):
+        current, descending = self.traffic_sort
+        # The same heading again flips the order; a new one starts biggest first
+        self.traffic_sort = (column, not descending if column == current else column != "client")
+        self.apply_traffic_sort()
+
+    def apply_traffic_sort(self):
+        column, descending = self.traffic_sort
+        rows = self.traffic_rows
+        order = sorted(rows, key=lambda iid: rows[iid][column], reverse=descending)
+        for index, iid in enumerate(order):
+            self.traffic_tree.move(iid, "", index)
+
+    # ---- ServerObserver hooks (called from the server's network thread,
+    # so they only queue work for the Tk thread)
+
+    def message(self, addr, text):
+        self.log(f"{addr}: {text}", "info")
+
+    def clients_changed(self):
+        self.clients_dirty = True
+
+    def file_received(self, addr, name, path, mimetype):
+        self.ui_events.append(("file", addr, path, mimetype))
+
+    def show_received_file(self, addr, path, mimetype):
+        # If image, show preview in a window
+        if mimetype.startswith("image"):
+            try:
+                self.show_image_preview(path, title=f"Image from {addr}")
+            except Exception as e:
+                self.log(f"⚠️ Could not preview image: {e}", "warning")
 
     def toggle_server(self):
         if not self.running:
-            # Start server
+            # Start server: the network engine runs on its own asyncio thread
+            federation = None
+            if PEERS or FEDERATION_PORT is not None:
+                federation = Federation(HOST, FEDERATION_PORT, PEERS, name=f"{socket.gethostname()}:{PORT}")
+            self.server = ChatServer(HOST, PORT, UPLOAD_DIR, observer=self, federation=federation)
             try:
-                self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                self.server_socket.bind((HOST, PORT))
-                self.server_socket.listen(5)
+                self.server.start()
             except Exception as e:
+                self.server = None
                 messagebox.showerror("Server Error", 
                                    f"Could not start server:\n\n{e}\n\nCheck if port {PORT} is available.")
                 return
@@ -390,12 +676,9 @@ class PremiumMultiServerGUI:
             self.server_status.config(text="🟢 Running", foreground=self.success_color)
             self.start_btn.config(text="🛑 Stop Server", style="Danger.TButton")
             self.draw_status_indicator("running")
-            self.log(f"Server started successfully on {HOST}:{PORT}", "success")
             self.status_var.set(f"Server running on {HOST}:{PORT} - Accepting connections")
+            self.limits_var.set(limits_text(self.server))
             self.broadcast_status.config(text="✅ Server ready - You can broadcast messages now!")
-            
-            self.accept_thread = threading.Thread(target=self.accept_connections, daemon=True)
-            self.accept_thread.start()
         else:
             # Stop server
             self.running = False
@@ -406,184 +689,94 @@ class PremiumMultiServerGUI:
             self.status_var.set("Server stopping...")
             self.broadcast_status.config(text="❌ Server stopped - Start server to broadcast")
             
-            try:
-                if self.server_socket:
-                    self.server_socket.close()
-            except:
-                pass
-            
-            with self.lock:
-                for conn, addr in list(self.clients):
-                    try:
-                        conn.shutdown(socket.SHUT_RDWR)
-                        conn.close()
-                    except:
-                        pass
-                self.clients.clear()
+            if self.server:
+                self.server.stop()
+                self.server = None
             
             self.refresh_clients_list()
-            self.log("Server stopped successfully", "system")
             self.status_var.set("Server stopped - Ready to start")
 
-    def accept_connections(self):
-        while self.running:
-            try:
-                conn, addr = self.server_socket.accept()
-            except Exception:
-                break  # socket closed or error -> exit
-            with self.lock:
-                self.clients.append((conn, addr))
-            self.log(f"✅ {addr} connected.", "success")
-            self.refresh_clients_list()
-            # notify other clients
-            self.broadcast(f"NOTIFY::Server: {addr} joined the chat.")
-            t = threading.Thread(target=self.handle_client, args=(conn, addr), daemon=True)
-            t.start()
+    def clients_snapshot(self):
+        return self.server.clients_snapshot() if self.server else []
+
+    def client_label(self, addr, lagging, name=None):
+        label = f"{name} ({addr[0]}:{addr[1]})" if name else f"{addr[0]}:{addr[1]}"
+        if lagging:
+            return f"🐢 {label} (lagging)"
+        return label
 
     def refresh_clients_list(self):
-        self.clients_listbox.delete(0, tk.END)
-        with self.lock:
-            for _, addr in self.clients:
-                self.clients_listbox.insert(tk.END, f"{addr[0]}:{addr[1]}")
-            self.client_count_var.set(str(len(self.clients)))
-            # Update broadcast status
-            if self.running:
-                client_count = len(self.clients)
-                if client_count > 0:
-                    self.broadcast_status.config(
-                        text=f"✅ Ready - {client_count} client(s) connected", 
-                        foreground=self.success_color
-                    )
+        """Apply joins, leaves and lag changes to the listbox row by row."""
+        clients = {cid: (addr, lagging, name) for cid, addr, lagging, name in self.clients_snapshot()}
+        rows = self.client_rows
+        
+        # Departed clients: one delete per contiguous run, bottom up so indexes stay valid
+        gone = [i for i, cid in enumerate(rows) if cid not in clients]
+        if gone:
+            runs = []
+            for i in gone:
+                if runs and runs[-1][1] == i - 1:
+                    runs[-1][1] = i
                 else:
-                    self.broadcast_status.config(
-                        text="⚠️ No clients connected - Wait for clients to join",
-                        foreground=self.warning_color
-                    )
-
-    def broadcast(self, message, exclude_conn=None):
-        # message is a text string already formatted to send as utf-8
-        with self.lock:
-            for conn, _ in list(self.clients):
-                if conn == exclude_conn:
-                    continue
-                try:
-                    conn.sendall(message.encode())
-                except:
-                    # remove dead client
-                    try:
-                        conn.close()
-                    except:
-                        pass
-                    self.clients = [(c,a) for (c,a) in self.clients if c!=conn]
-        self.refresh_clients_list()
+                    runs.append([i, i])
+            for first, last in reversed(runs):
+                self.clients_listbox.delete(first, last)
+            for i in gone:
+                del self.client_labels[rows[i]]
+            rows = self.client_rows = [cid for cid in rows if cid in clients]
+        
+        # Clients whose lag state flipped or who took a name
+        for i, cid in enumerate(rows):
+            label = self.client_label(*clients[cid])
+            if label != self.client_labels[cid]:
+                self.client_labels[cid] = label
+                self.clients_listbox.delete(i)
+                self.clients_listbox.insert(i, label)
+                if clients[cid][1]:
+                    self.clients_listbox.itemconfig(i, foreground=self.warning_color)
+        
+        # Newcomers go to the bottom
+        for cid, (addr, lagging, name) in clients.items():
+            if cid not in self.client_labels:
+                label = self.client_labels[cid] = self.client_label(addr, lagging, name)
+                rows.append(cid)
+                self.clients_listbox.insert(tk.END, label)
+                if lagging:
+                    self.clients_listbox.itemconfig(tk.END, foreground=self.warning_color)
+        
+        lagging = sum(1 for _, is_lagging, _ in clients.values() if is_lagging)
+        self.client_count_var.set(str(len(clients)))
+        dropped = self.server.dropped_clients if self.server else 0
+        self.slow_count_var.set(f"{lagging} / {dropped}")
+        # Update broadcast status
+        if self.running:
+            client_count = len(clients)
+            if client_count > 0:
+                self.broadcast_status.config(
+                    text=f"✅ Ready - {client_count} client(s) connected", 
+                    foreground=self.success_color
+                )
+            else:
+                self.broadcast_status.config(
+                    text="⚠️ No clients connected - Wait for clients to join",
+                    foreground=self.warning_color
+                )
 
-    def handle_client(self, conn, addr):
-        try:
-            while True:
-                header = conn.recv(6)  # try small peek; but we need to recv properly
-                if not header:
-                    break
-                # Since we can't be sure how much header we have, we'll read until newline marker.
-                # But our client protocol will send headers as ASCII lines terminated by '\n'
-                # So if first recv didn't include full header, read until newline.
-                data = header
-                while b'\n' not in data:
-                    more = conn.recv(1024)
-                    if not more:
-                        break
-                    data += more
-                if not data:
-                    break
-                header_line, _, remainder = data.partition(b'\n')
-                header_str = header_line.decode()
-                # Two protocol cases:
-                # 1) "MSG::<text>"
-                # 2) "FILE::<filename>::<filesize>::<mimetype>"
-                if header_str.startswith("MSG::"):
-                    text = header_str[5:]
-                    self.log(f"{addr}: {text}", "info")
-                    # broadcast full message
-                    self.broadcast(f"MSG::{addr}: {text}", exclude_conn=conn)
-                    # If remainder has extra content, ignore (shouldn't)
-                elif header_str.startswith("FILE::"):
-                    # parse
-                    # FILE::<filename>::<filesize>::<mimetype>
-                    parts = header_str.split("::", 3)
-                    if len(parts) < 4:
-                        self.log(f"⚠️ Bad file header from {addr}: {header_str}", "error")
-                        continue
-                    _, filename, filesize_str, mimetype = parts
-                    try:
-                        filesize = int(filesize_str)
-                    except:
-                        self.log(f"⚠️ Invalid filesize from {addr}: {filesize_str}", "error")
-                        continue
-                    safe_name = pathlib.Path(filename).name
-                    save_path = os.path.join(UPLOAD_DIR, safe_name)
-                    # If remainder contains some bytes of file, write them
-                    received = len(remainder)
-                    with open(save_path, "wb") as f:
-                        if remainder:
-                            f.write(remainder)
-                        # continue receiving remaining bytes
-                        while received < filesize:
-                            chunk = conn.recv(min(4096, filesize - received))
-                            if not chunk:
-                                break
-                            f.write(chunk)
-                            received += len(chunk)
-                    self.log(f"📁 Received file from {addr}: {safe_name} ({filesize} bytes) -> {save_path}", "success")
-                    self.file_count += 1
-                    self.file_count_var.set(str(self.file_count))
-                    # announce to other clients (they can download via separate mechanism; here we just notify)
-                    self.broadcast(f"NOTIFY::Server: {addr} sent file {safe_name}")
-                    # If image, show preview in a window
-                    if mimetype.startswith("image"):
-                        try:
-                            self.show_image_preview(save_path, title=f"Image from {addr}")
-                        except Exception as e:
-                            self.log(f"⚠️ Could not preview image: {e}", "warning")
-                else:
-                    # Unknown header: treat as text
-                    try:
-                        txt = header_str
-                        self.log(f"{addr}: {txt}", "info")
-                        self.broadcast(f"MSG::{addr}: {txt}", exclude_conn=conn)
-                    except:
-                        pass
-        except Exception as e:
-            self.log(f"⚠️ Connection error with {addr}: {e}", "error")
-        finally:
-            with self.lock:
-                self.clients = [(c,a) for (c,a) in self.clients if c!=conn]
-            try:
-                conn.close()
-            except:
-                pass
-            self.log(f"❌ {addr} disconnected.", "warning")
-            self.refresh_clients_list()
-            self.broadcast(f"NOTIFY::Server: {addr} left the chat.")
+    def selected_client(self):
+        """Connection id of the selected row, or None."""
+        sel = self.clients_listbox.curselection()
+        if not sel or sel[0] >= len(self.client_rows):
+            return None
+        return self.client_rows[sel[0]]
 
     def disconnect_selected(self):
-        sel = self.clients_listbox.curselection()
-        if not sel:
+        cid = self.selected_client()
+        if cid is None:
             messagebox.showwarning("No Selection", "Please select a client to disconnect.")
             return
-        idx = sel[0]
-        with self.lock:
-            if idx < len(self.clients):
-                conn, addr = self.clients[idx]
-                try:
-                    conn.shutdown(socket.SHUT_RDWR)
-                except:
-                    pass
-                try:
-                    conn.close()
-                except:
-                    pass
-                self.clients.pop(idx)
-        self.refresh_clients_list()
-        self.log(f"🔌 Disconnected {addr}", "system")
+        addr = self.server.disconnect(cid) if self.server else None
+        if addr:
+            self.log(f"🔌 Disconnected {addr}", "system")
 
     def send_from_server(self):
         """✅ SERVER MESSAGE KORAR OPTION - NOW EASY TO FIND!"""
@@ -598,18 +791,18 @@ class PremiumMultiServerGUI:
             return
         
         # Check if there are any clients connected
-        with self.lock:
-            if not self.clients:
-                messagebox.showinfo("No Clients", "No clients are connected to receive the message.")
-                return
+        client_count = self.server.client_count()
+        if not client_count:
+            messagebox.showinfo("No Clients", "No clients are connected to receive the message.")
+            return
         
         # Send the broadcast message
         try:
-            self.broadcast(f"MSG::🚀 Server: {msg}")
+            self.server.broadcast_threadsafe(MSG, f"🚀 Server: {msg}")
             self.log(f"📢 Server Broadcast: {msg}", "broadcast")
-            self.status_var.set(f"Broadcast sent to {len(self.clients)} client(s)")
+            self.status_var.set(f"Broadcast sent to {client_count} client(s)")
             self.broadcast_status.config(
-                text=f"✅ Last broadcast: '{msg}' to {len(self.clients)} client(s)", 
+                text=f"✅ Last broadcast: '{msg}' to {client_count} client(s)", 
                 foreground=self.success_color
             )
             
@@ -651,27 +844,33 @@ class PremiumMultiServerGUI:
         self.log("Display refreshed", "system")
 
     def clear_log(self):
-        self.chat_box.config(state=tk.NORMAL)
-        self.chat_box.delete(1.0, tk.END)
-        self.chat_box.config(state=tk.DISABLED)
+        self.log_view.clear()
         self.log("Log cleared", "system")
 
     def show_client_info(self):
-        sel = self.clients_listbox.curselection()
-        if not sel:
+        cid = self.selected_client()
+        if cid is None:
             messagebox.showinfo("Client Info", "Please select a client from the list.")
             return
         
-        idx = sel[0]
-        with self.lock:
-            if idx < len(self.clients):
-                conn, addr = self.clients[idx]
-                messagebox.showinfo("Client Information", 
-                                  f"📡 Client Address: {addr[0]}:{addr[1]}\n"
-                                  f"🔗 Connection Status: {'Active' if conn else 'Closed'}\n"
-                                  f"👥 Total Connected Clients: {len(self.clients)}\n"
-                                  f"📊 Messages Processed: {self.message_count}\n"
-                                  f"📁 Files Shared: {self.file_count}")
+        info = self.server.client_info(cid) if self.server else None
+        if info is None:
+            messagebox.showinfo("Client Info", "That client has already disconnected.")
+            return
+        now = time.time()
+        messagebox.showinfo("Client Information", 
+                          f"👤 Name: {info.name or '(none)'}\n"
+                          f"📡 Client Address: {info.addr[0]}:{info.addr[1]}\n"
+                          f"🔗 Connection ID: #{cid}{' (lagging)' if info.lagging else ''}\n"
+                          f"🏠 Room: #{info.room}\n"
+                          f"⏱️ Connected: {format_duration(now - info.connected_at)}, "
+                          f"idle {now - info.last_active:.0f}s\n"
+                          f"⬇️ In: {format_bytes(info.bytes_in)} in {info.frames_in} frames\n"
+                          f"⬆️ Out: {format_bytes(info.bytes_out)} in {info.frames_out} frames\n"
+                          f"💬 Messages Sent: {info.messages}\n"
+                          f"📁 Uploaded: {format_bytes(info.upload_bytes)}\n"
+                          f"📦 Queued Frames: {info.queued}\n"
+                          f"👥 Total Connected Clients: {self.server.client_count()}")
 
     @property
     def highlight_color(self):
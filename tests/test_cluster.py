@@ -0,0 +1,86 @@
+import asyncio
+import hashlib
+import json
+
+from chat_cluster import CLAIM, FILE, GRANT, HELLO, RELEASE, REVOKE, STORE, STORED, ClusterHub
+from chat_uploads import BlobStore
+
+
+class Link:
+    """A worker's end of the bus, as far as the hub can tell."""
+
+    def __init__(self):
+        self.worker = None
+        self.sent = []
+
+    def send(self, kind, payload):
+        self.sent.append((kind, payload))
+
+
+def hub_with(workers, upload_dir=None):
+    hub = ClusterHub("unused.sock", upload_dir=upload_dir)
+    links = [Link() for _ in range(workers)]
+    for worker, link in enumerate(links):
+        hub._frame(link, HELLO, b"%d" % worker)
+    return hub, links
+
+
+def test_claims_are_answered_first_come():
+    hub, (one, two) = hub_with(2)
+    hub._frame(one, CLAIM, b"1::alice")
+    hub._frame(two, CLAIM, b"7::alice")
+    assert one.sent == [(GRANT, b"1::alice")]
+    assert two.sent == [(REVOKE, b"7::alice")]
+
+
+def test_released_name_can_be_claimed_again():
+    hub, (one, two) = hub_with(2)
+    hub._frame(one, CLAIM, b"1::alice")
+    hub._frame(one, RELEASE, b"1::alice")
+    hub._frame(two, CLAIM, b"7::alice")
+    assert two.sent == [(GRANT, b"7::alice")]
+
+
+def test_names_of_a_lost_worker_are_free():
+    hub, (one, two) = hub_with(2)
+    hub._frame(one, CLAIM, b"1::alice")
+    hub._lost(one)
+    hub._frame(two, CLAIM, b"7::alice")
+    assert two.sent[-1] == (GRANT, b"7::alice")
+
+
+def put_blob(upload_dir, data):
+    # What a worker does before it sends STORE.
+    digest = hashlib.sha256(data).hexdigest()
+    src = upload_dir / digest
+    src.write_bytes(data)
+    BlobStore(str(upload_dir), writer=False).put(digest, len(data), "image/jpeg", src=str(src))
+    return digest
+
+
+def test_hub_names_files_stored_on_two_workers_at_once(tmp_path):
+    one_digest, two_digest = put_blob(tmp_path, b"one"), put_blob(tmp_path, b"two")
+
+    async def run():
+        hub, (one, two) = hub_with(2, str(tmp_path))
+        hub._frame(one, STORE, f"1::{one_digest}::3::image/jpeg::photo.jpg".encode())
+        hub._frame(two, STORE, f"1::{two_digest}::3::image/jpeg::photo.jpg".encode())
+        hub.links.clear()
+        hub.close()
+        return one, two
+
+    one, two = asyncio.run(run())
+    assert one.sent == [(STORED, f"1::{one_digest}::3::image/jpeg::photo.jpg".encode()),
+                        (FILE, f"{two_digest}::3::image/jpeg::photo (1).jpg".encode())]
+    assert two.sent == [(FILE, f"{one_digest}::3::image/jpeg::photo.jpg".encode()),
+                        (STORED, f"1::{two_digest}::3::image/jpeg::photo (1).jpg".encode())]
+    with open(tmp_path / "blobs" / "index.json", encoding="utf-8") as f:
+        assert json.load(f)["names"] == {"photo.jpg": one_digest, "photo (1).jpg": two_digest}
+
+
+def test_worker_store_never_writes_the_index(tmp_path):
+    put_blob(tmp_path, b"data")
+    blobs = BlobStore(str(tmp_path), writer=False)
+    blobs.adopt("a.txt", hashlib.sha256(b"data").hexdigest(), 4, "text/plain")
+    blobs.flush()
+    assert not (tmp_path / "blobs" / "index.json").exists()
@@ -0,0 +1,72 @@
+import chat_federation
+from chat_federation import RELAY, SEEN_TTL, SEEN_WINDOW, Federation, SeenWindow
+from chat_protocol import MSG
+
+
+def test_each_seq_is_new_once():
+    seen = SeenWindow()
+    assert seen.add(1)
+    assert not seen.add(1)
+    assert seen.add(3)
+    # A late copy that overtook nothing: still new.
+    assert seen.add(2)
+    assert not seen.add(2)
+
+
+def test_seqs_older_than_the_window_count_as_seen():
+    seen = SeenWindow()
+    assert seen.add(10 * SEEN_WINDOW)
+    assert not seen.add(10 * SEEN_WINDOW - SEEN_WINDOW)
+    assert seen.add(10 * SEEN_WINDOW - SEEN_WINDOW + 1)
+
+
+def test_window_stays_bounded():
+    seen = SeenWindow()
+    for seq in range(1, 5 * SEEN_WINDOW):
+        assert seen.add(seq)
+    assert len(seen.recent) <= 2 * SEEN_WINDOW + 1
+    assert not seen.add(SEEN_WINDOW)
+
+
+class Owner:
+    def __init__(self):
+        self.delivered = []
+
+    def log(self, text, level="info"):
+        pass
+
+    def _deliver_federated(self, kind, text, room_name):
+        self.delivered.append((kind, text, room_name))
+
+
+class Link:
+    origin = "peer"
+
+
+def relay(federation, origin, seq, text="hi"):
+    federation._frame(Link(), RELAY, f"{origin}::{seq}::{MSG}::lobby::{text}".encode())
+
+
+def test_relayed_broadcasts_are_delivered_once():
+    federation = Federation()
+    federation.owner = owner = Owner()
+    relay(federation, "a", 1)
+    relay(federation, "a", 1)
+    relay(federation, "b", 1)
+    relay(federation, federation.origin, 5)
+    assert len(owner.delivered) == 2
+    assert federation.duplicates == 2
+    assert set(federation.seen) == {"a", "b"}
+
+
+def test_windows_of_silent_origins_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(chat_federation.time, "monotonic", lambda: now[0])
+    federation = Federation()
+    federation.owner = Owner()
+    relay(federation, "restarted", 1)
+    now[0] += SEEN_TTL / 2
+    relay(federation, "alive", 1)
+    now[0] += SEEN_TTL / 2 + 1
+    relay(federation, "alive", 2)
+    assert set(federation.seen) == {"alive"}
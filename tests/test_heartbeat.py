@@ -0,0 +1,92 @@
+from chat_heartbeat import TimerWheel
+
+
+class Handle:
+    def cancel(self):
+        pass
+
+
+class FakeLoop:
+    """Just enough of an event loop for TimerWheel, with a clock we move by hand."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback):
+        return Handle()
+
+
+def wheel(**kwargs):
+    fired = []
+    timers = TimerWheel(fired.append, **kwargs)
+    timers.loop = FakeLoop()
+    timers.started = 0.0
+    return timers, fired
+
+
+def run_to(timers, now):
+    timers.loop.now = now
+    timers._advance()
+
+
+def test_timer_fires_once_rounded_up_to_a_tick():
+    timers, fired = wheel(tick=1.0, slots=8)
+    timers.add("a", 2.5)
+    run_to(timers, 2.0)
+    assert fired == []
+    run_to(timers, 3.0)
+    assert fired == ["a"]
+    run_to(timers, 20.0)
+    assert fired == ["a"]
+    assert len(timers) == 0
+
+
+def test_adding_again_reschedules():
+    timers, fired = wheel(tick=1.0, slots=8)
+    timers.add("a", 2)
+    timers.add("a", 5)
+    run_to(timers, 4.0)
+    assert fired == []
+    run_to(timers, 5.0)
+    assert fired == ["a"]
+
+
+def test_discarded_timer_never_fires():
+    timers, fired = wheel(tick=1.0, slots=8)
+    timers.add("a", 1)
+    timers.discard("a")
+    timers.discard("a")
+    run_to(timers, 10.0)
+    assert fired == []
+
+
+def test_delay_longer_than_a_turn_waits_whole_turns():
+    timers, fired = wheel(tick=1.0, slots=4)
+    timers.add("far", 10)
+    timers.add("near", 2)
+    run_to(timers, 9.0)
+    assert fired == ["near"]
+    run_to(timers, 10.0)
+    assert fired == ["near", "far"]
+
+
+def test_late_tick_catches_up_in_order():
+    timers, fired = wheel(tick=1.0, slots=8)
+    for name, delay in (("c", 3), ("a", 1), ("b", 2)):
+        timers.add(name, delay)
+    run_to(timers, 6.0)
+    assert fired == ["a", "b", "c"]
+
+
+def test_callback_may_add_the_item_back():
+    fired = []
+    timers = TimerWheel(lambda item: (fired.append(item), timers.add(item, 2)), tick=1.0, slots=8)
+    timers.loop = FakeLoop()
+    timers.started = 0.0
+    timers.add("a", 1)
+    run_to(timers, 5.0)
+    assert fired == ["a", "a", "a"]
+    assert len(timers) == 1
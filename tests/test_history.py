@@ -0,0 +1,50 @@
+import os
+
+from chat_history import ChatHistory, default_history_path
+
+
+def filled(tmp_path, count, recent=4):
+    history = ChatHistory(str(tmp_path / "history.db"), recent=recent)
+    for n in range(1, count + 1):
+        history.append(f"line {n}", "" if n == 5 else ("a" if n % 2 else "b"))
+    return history
+
+
+def test_page_from_the_ring(tmp_path):
+    history = filled(tmp_path, 10, recent=10)
+    entries, below, missing = history.recent_page(3, 11, "a")
+    # Room "a" has the odd lines; line 5 is server-wide and shows in every room.
+    assert [e[2] for e in entries] == ["line 5", "line 7", "line 9"]
+    assert (below, missing) == (5, 0)
+    history.close()
+
+
+def test_older_pages_come_from_the_database(tmp_path):
+    history = filled(tmp_path, 10)
+    entries, below, missing = history.recent_page(4, 11, "b")
+    # The ring only holds lines 7-10: two of them are room "b"'s.
+    assert [e[2] for e in entries] == ["line 8", "line 10"]
+    assert (below, missing) == (7, 2)
+    assert [row[2] for row in history.older(below, missing, "b")] == ["line 5", "line 6"]
+    assert [row[2] for row in history.older(5, 10, "b")] == ["line 2", "line 4"]
+    history.close()
+
+
+def test_history_survives_a_restart(tmp_path):
+    filled(tmp_path, 6).close()
+    history = ChatHistory(str(tmp_path / "history.db"), recent=4)
+    assert history.next_seq == 7
+    assert history.append("after") == 7
+    history.close()
+
+
+def test_default_path_is_beside_the_upload_folder(tmp_path):
+    uploads = tmp_path / "uploads"
+    uploads.mkdir()
+    # Left inside by an older version: moved out, -wal included.
+    for suffix in ("", "-wal"):
+        (uploads / f"history.db{suffix}").write_bytes(b"old")
+    path = default_history_path(str(uploads))
+    assert path == str(tmp_path / "uploads-history.db")
+    assert os.listdir(uploads) == []
+    assert sorted(os.listdir(tmp_path)) == ["uploads", "uploads-history.db", "uploads-history.db-wal"]
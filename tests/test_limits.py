@@ -0,0 +1,58 @@
+from chat_limits import ConnectionLimits, TokenBucket
+
+
+def test_take_spends_the_burst_then_the_rate():
+    bucket = TokenBucket(rate=2, burst=3, now=0.0)
+    assert [bucket.take(0.0) for _ in range(4)] == [True, True, True, False]
+    assert not bucket.take(0.25)
+    assert bucket.take(0.5)
+    # Never more than the burst saved up.
+    assert [bucket.take(100.0) for _ in range(4)] == [True, True, True, False]
+
+
+def test_take_spends_nothing_when_short():
+    bucket = TokenBucket(rate=1, burst=5, now=0.0)
+    assert not bucket.take(0.0, 6)
+    assert bucket.take(0.0, 5)
+
+
+def test_debit_runs_into_debt_and_says_how_long_it_lasts():
+    bucket = TokenBucket(rate=1000, burst=1000, now=0.0)
+    assert bucket.debit(0.0, 600) == 0.0
+    assert bucket.debit(0.0, 900) == 0.5
+    assert bucket.debit(0.25, 0) == 0.25
+    assert bucket.debit(0.5, 0) == 0.0
+
+
+def test_admit_enforces_the_per_ip_cap():
+    limits = ConnectionLimits(max_total=100, max_per_ip=2)
+    assert limits.admit("10.0.0.1") is None
+    assert limits.admit("10.0.0.1") is None
+    assert "10.0.0.1" in limits.admit("10.0.0.1")
+    assert limits.admit("10.0.0.2") is None
+    assert limits.refused == 1
+    limits.release("10.0.0.1")
+    assert limits.admit("10.0.0.1") is None
+
+
+def test_admit_enforces_the_total_cap():
+    limits = ConnectionLimits(max_total=2, max_per_ip=0)
+    assert limits.admit("a") is None
+    assert limits.admit(None) is None
+    assert "server full" in limits.admit("b")
+    limits.release(None)
+    assert limits.admit("b") is None
+    assert limits.total == 2
+
+
+def test_release_forgets_addresses_with_no_connections():
+    limits = ConnectionLimits()
+    limits.admit("a")
+    limits.release("a")
+    assert limits.total == 0
+    assert "a" not in limits.per_ip
+
+
+def test_zero_turns_the_caps_off():
+    limits = ConnectionLimits(max_total=0, max_per_ip=0)
+    assert all(limits.admit("a") is None for _ in range(1000))
@@ -0,0 +1,65 @@
+import pytest
+
+import chat_protocol as proto
+from chat_protocol import BODY, MSG, NAME, FrameReader, ProtocolError
+
+
+def feed(reader, data, step=None):
+    """Push ``data`` through the reader ``step`` bytes at a time; the events, as bytes."""
+    events = []
+    step = step or len(data) or 1
+    while data:
+        window = reader.writable()
+        n = min(step, len(window), len(data))
+        window[:n] = data[:n]
+        data = data[n:]
+        reader.commit(n)
+        # Views are only good until the next writable() call.
+        events += [(kind, bytes(payload)) for kind, payload in reader.events()]
+    return events
+
+
+def test_pipelined_frames_come_out_of_one_recv():
+    reader = FrameReader(version=2)
+    data = b"".join(proto.encode_v2(MSG, b"line %d" % i) for i in range(50))
+    assert feed(reader, data) == [(MSG, b"line %d" % i) for i in range(50)]
+
+
+@pytest.mark.parametrize("step", [1, 3, 5, 7])
+def test_split_frames_wait_for_their_last_byte(step):
+    reader = FrameReader(version=2)
+    data = proto.encode_v2(MSG, b"hello") + proto.encode_v2(NAME, b"") + proto.encode_v2(MSG, b"x" * 40)
+    assert feed(reader, data, step) == [(MSG, b"hello"), (NAME, b""), (MSG, b"x" * 40)]
+
+
+def test_frame_larger_than_the_buffer_grows_it():
+    reader = FrameReader(size=16, version=2)
+    payload = bytes(range(256)) * 40
+    assert feed(reader, proto.encode_v2(MSG, payload), 1000) == [(MSG, payload)]
+
+
+def test_oversized_frame_is_refused_from_its_header():
+    reader = FrameReader(version=2, max_frame=100)
+    with pytest.raises(ProtocolError):
+        feed(reader, proto.encode_v2(MSG, b"x" * 101)[:proto.HEADER.size])
+
+
+def test_overlong_v1_line_is_refused():
+    reader = FrameReader(version=1, max_line=64)
+    with pytest.raises(ProtocolError):
+        feed(reader, b"MSG::" + b"x" * 100)
+
+
+def test_body_bytes_are_not_parsed_as_frames():
+    reader = FrameReader(version=2)
+    body = proto.encode_v2(MSG, b"not a frame")
+    reader.expect_body(len(body))
+    events = feed(reader, body + proto.encode_v2(MSG, b"after"), 4)
+    assert b"".join(p for kind, p in events if kind == BODY) == body
+    assert events[-1] == (MSG, b"after")
+
+
+def test_v1_lines_and_plain_text():
+    reader = FrameReader(version=1)
+    events = feed(reader, b"NAME::alice\nhello there\nMSG::a::b\n", 2)
+    assert events == [(NAME, b"alice"), (MSG, b"hello there"), (MSG, b"a::b")]
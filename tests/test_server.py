@@ -0,0 +1,274 @@
+import socket
+import sys
+import time
+
+import pytest
+
+import chat_protocol as proto
+from chat_protocol import DM, ERROR, JOIN, LEAVE, MSG, NAME, NOTIFY, ROOMS
+import chat_server
+from chat_server import ChatServer
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = ChatServer(host="127.0.0.1", port=0, upload_dir=str(tmp_path), history_path="",
+                        heartbeat=0, max_per_ip=0, message_rate=0)
+    server.start()
+    yield server
+    server.stop()
+
+
+def connect(server):
+    port = server.server.sockets[0].getsockname()[1]
+    sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+    sock.settimeout(0.1)
+    return sock
+
+
+def read_until(sock, expected, timeout=5):
+    data = b""
+    deadline = time.monotonic() + timeout
+    while expected not in data and time.monotonic() < deadline:
+        try:
+            chunk = sock.recv(65536)
+        except socket.timeout:
+            continue
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def test_hello_opts_into_v2(server):
+    with connect(server) as sock:
+        sock.sendall(proto.HELLO_LINE)
+        assert read_until(sock, proto.HELLO_LINE).startswith(proto.HELLO_LINE)
+        sock.sendall(proto.encode_v2(NAME, b"alice"))
+        assert proto.encode_v2(NAME, b"alice") in read_until(sock, proto.encode_v2(NAME, b"alice"))
+
+
+def test_hello_and_frames_pipelined_in_one_segment(server):
+    with connect(server) as sock:
+        sock.sendall(proto.HELLO_LINE + proto.encode_v2(NAME, b"bob") + proto.encode_v2(MSG, b"hi"))
+        data = read_until(sock, proto.encode_v2(NAME, b"bob"))
+        assert data.startswith(proto.HELLO_LINE)
+        assert proto.encode_v2(NAME, b"bob") in data
+
+
+def test_anything_else_first_is_served_in_v1(server):
+    with connect(server) as sock:
+        sock.sendall(b"NAME::carol\n")
+        data = read_until(sock, b"joined the chat.\n")
+        assert proto.HELLO_LINE not in data
+        assert data.startswith(b"NAME::carol\n")
+        assert proto.encode_legacy(NOTIFY, b"Server: carol joined the chat.") in data
+
+
+def test_v1_and_v2_clients_see_each_other(server):
+    with connect(server) as old, connect(server) as new:
+        new.sendall(proto.HELLO_LINE + proto.encode_v2(NAME, b"new"))
+        read_until(new, proto.encode_v2(NAME, b"new"))
+        old.sendall(b"NAME::old\n")
+        read_until(old, b"NAME::old\n")
+        read_until(new, b"old joined the chat.")
+        old.sendall(b"MSG::hello v2\n")
+        assert proto.encode_v2(MSG, b"old: hello v2") in read_until(new, b"old: hello v2")
+
+
+@pytest.fixture
+def file_server(tmp_path):
+    uploads = tmp_path / "uploads"
+    uploads.mkdir()
+    (uploads / "old.txt").write_bytes(b"0123456789")
+    # A history kept inside the folder by --history is never served.
+    server = ChatServer(host="127.0.0.1", port=0, upload_dir=str(uploads),
+                        history_path=str(uploads / "chat.db"), heartbeat=0, max_per_ip=0, message_rate=0)
+    server.start()
+    yield server, uploads
+    server.stop()
+
+
+def test_range_get_of_a_file_from_before_the_blob_store(file_server):
+    server, _ = file_server
+    with connect(server) as sock:
+        sock.sendall(b"GET::old.txt::3::4\n")
+        assert b"FILEDATA::old.txt::3::4::10::text/plain\n3456" in read_until(sock, b"3456")
+        sock.sendall(b"GET::old.txt::8\n")
+        assert b"FILEDATA::old.txt::8::2::10::text/plain\n89" in read_until(sock, b"\n89")
+        sock.sendall(b"GET::old.txt::11::1\n")
+        assert b"range not satisfiable (size 10)" in read_until(sock, b"(size 10)")
+
+
+@pytest.mark.parametrize("name", ["chat.db", "chat.db-wal", "later.txt", "index.json", ".partial"])
+def test_get_serves_nothing_but_stored_uploads(file_server, name):
+    server, uploads = file_server
+    (uploads / "later.txt").write_bytes(b"appeared after startup")
+    (uploads / "chat.db-wal").write_bytes(b"secret chat")
+    with connect(server) as sock:
+        sock.sendall(f"GET::{name}\n".encode())
+        assert f"GET {name}: no such file".encode() in read_until(sock, b"no such file")
+
+
+def test_downloads_queued_per_connection_are_capped(file_server):
+    server, _ = file_server
+    with connect(server) as sock:
+        sock.sendall(b"NAME::dave\n")
+        read_until(sock, b"joined the chat.\n")
+        session = next(s for s in server.clients.values())
+        session.pending_files = chat_server.MAX_DOWNLOADS
+        sock.sendall(b"GET::old.txt\n")
+        assert b"too many downloads queued" in read_until(sock, b"queued (max")
+
+
+def test_full_queue_behind_a_download_counts_as_slow():
+    session = chat_server.ClientSession(None, 1, max_queue=2)
+    session.sending_file = True
+    assert session.enqueue(b"a") and session.enqueue(b"b")
+    assert not session.enqueue(b"c")
+    assert not session.enqueue_file(b"header", object())
+    assert session.pending_files == 0
+
+
+class FakeTransport:
+    def __init__(self):
+        self.buffered = []
+        self.aborted = False
+
+    def get_write_buffer_size(self):
+        return sum(map(len, self.buffered))
+
+    def writelines(self, data):
+        self.buffered.extend(bytes(d) for d in data)
+
+    def abort(self):
+        self.aborted = True
+
+
+class ShortWriteSocket:
+    """Takes only the first ``room`` bytes of each sendmsg()."""
+
+    def __init__(self, room):
+        self.room = room
+        self.sent = []
+
+    def sendmsg(self, buffers):
+        data = b"".join(buffers)[:self.room]
+        self.sent.append(data)
+        return len(data)
+
+
+def test_flush_leaves_the_rest_of_a_partial_write_to_the_transport():
+    session = chat_server.ClientSession(None, 1)
+    session.transport = FakeTransport()
+    session.sock = ShortWriteSocket(5)
+    for frame in (b"abc", b"defgh", b"ij"):
+        session.enqueue(frame)
+    session.flush()
+    assert session.sock.sent == [b"abcde"]
+    assert session.transport.buffered == [b"fgh", b"ij"]
+    assert session.transport.get_write_buffer_size() == 5
+    assert session.stats.bytes_out == 10 and session.stats.frames_out == 3
+    # With the transport still holding bytes, nothing may overtake them.
+    session.enqueue(b"kl")
+    session.flush()
+    assert session.sock.sent == [b"abcde"]
+    assert b"".join(session.transport.buffered) == b"fghijkl"
+
+
+def test_sendmsg_socket_falls_back_without_a_private_socket():
+    class Wrapper:
+        def fileno(self):
+            return 3
+
+    class Transport:
+        def get_extra_info(self, name):
+            return Wrapper() if name == "socket" else None
+
+    assert chat_server.sendmsg_socket(Transport()) is None
+
+
+@pytest.mark.skipif(sys.version_info >= (3, 12), reason="writelines() already uses sendmsg()")
+def test_sendmsg_socket_finds_the_real_socket(server):
+    with connect(server) as sock:
+        sock.sendall(b"NAME::erin\n")
+        read_until(sock, b"joined the chat.\n")
+        session = next(iter(server.clients.values()))
+        assert isinstance(session.sock, socket.socket)
+
+
+def stalled_client(tmp_path, policy):
+    server = ChatServer(upload_dir=str(tmp_path), history_path="", max_queue=3, slow_policy=policy)
+    session = chat_server.ClientSession(server, 1, max_queue=server.max_queue)
+    session.transport = FakeTransport()
+    session._writable.clear()  # the kernel buffer is full: the client stopped reading
+    return server, session
+
+
+def test_slow_client_is_dropped_at_its_high_water_mark(tmp_path):
+    server, session = stalled_client(tmp_path, "drop")
+    assert all(server._deliver(session, b"frame") for _ in range(3))
+    assert not server._deliver(session, b"one too many")
+    assert session.closed and session.transport.aborted
+    assert server.dropped_clients == 1
+
+
+def test_lagging_client_skips_frames_but_stays(tmp_path):
+    server, session = stalled_client(tmp_path, "lag")
+    for _ in range(5):
+        server._deliver(session, b"frame")
+    assert session.lagging and not session.closed
+    assert len(session.queue) == 3 and session.dropped_frames == 2
+    assert server.dropped_clients == 0
+    with pytest.raises(ValueError):
+        ChatServer(upload_dir=str(tmp_path), history_path="", slow_policy="block")
+
+
+def named(server, name):
+    sock = connect(server)
+    sock.sendall(proto.HELLO_LINE + proto.encode_v2(NAME, name.encode()))
+    read_until(sock, proto.encode_v2(NAME, name.encode()))
+    return sock
+
+
+def test_chat_stays_in_its_room(server):
+    with named(server, "alice") as alice, named(server, "bob") as bob:
+        alice.sendall(proto.encode_v2(JOIN, b"dev"))
+        assert proto.encode_v2(JOIN, b"dev::1") in read_until(alice, proto.encode_v2(JOIN, b"dev::1"))
+        bob.sendall(proto.encode_v2(MSG, b"only the lobby hears this"))
+        bob.sendall(proto.encode_v2(JOIN, b"dev"))
+        assert proto.encode_v2(JOIN, b"dev::2") in read_until(bob, proto.encode_v2(JOIN, b"dev::2"))
+        bob.sendall(proto.encode_v2(ROOMS, b""))
+        rooms = proto.encode_v2(ROOMS, b"lobby::0::dev::2")
+        assert rooms in read_until(bob, rooms)
+        bob.sendall(proto.encode_v2(MSG, b"hi dev"))
+        data = read_until(alice, b"bob: hi dev")
+        assert proto.encode_v2(NOTIFY, b"Server: bob joined #dev.") in data
+        assert proto.encode_v2(MSG, b"bob: hi dev") in data
+        assert b"only the lobby hears this" not in data
+        alice.sendall(proto.encode_v2(LEAVE, b""))
+        assert proto.encode_v2(JOIN, b"lobby::1") in read_until(alice, proto.encode_v2(JOIN, b"lobby::1"))
+        assert proto.encode_v2(NOTIFY, b"Server: alice left #dev.") in read_until(bob, b"left #dev.")
+
+
+def test_direct_message_reaches_only_its_user(server):
+    with named(server, "alice") as alice, named(server, "bob") as bob, named(server, "carol") as carol:
+        # Rooms do not matter for a DM.
+        bob.sendall(proto.encode_v2(JOIN, b"dev"))
+        read_until(bob, proto.encode_v2(JOIN, b"dev::1"))
+        alice.sendall(proto.encode_v2(DM, b"bob::psst"))
+        assert proto.encode_v2(DM, b"alice::psst") in read_until(bob, b"alice::psst")
+        alice.sendall(proto.encode_v2(DM, b"dave::anyone?"))
+        assert proto.encode_v2(ERROR, b"DM: dave is not online") in read_until(alice, b"not online")
+        alice.sendall(proto.encode_v2(MSG, b"done"))
+        assert b"psst" not in read_until(carol, b"alice: done")
+
+
+def test_direct_message_follows_a_new_name(server):
+    with named(server, "alice") as alice, named(server, "bob") as bob:
+        bob.sendall(proto.encode_v2(NAME, b"robert"))
+        read_until(bob, proto.encode_v2(NAME, b"robert"))
+        alice.sendall(proto.encode_v2(DM, b"bob::hello?"))
+        assert b"DM: bob is not online" in read_until(alice, b"not online")
+        alice.sendall(proto.encode_v2(DM, b"robert::hello"))
+        assert proto.encode_v2(DM, b"alice::hello") in read_until(bob, b"alice::hello")
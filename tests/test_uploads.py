@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+from chat_uploads import BlobStore, ChunkUpload, UploadStore
+
+CONTENT = os.urandom(3 * 4096 + 123)
+DIGEST = hashlib.sha256(CONTENT).hexdigest()
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def send_chunk(partial, data, digest=None, length=None):
+    """Receive one CHUNK body the way the server does, minus the threads."""
+    chunk = ChunkUpload(partial, len(data) if length is None else length, digest or sha256(data),
+                        [bytearray(4096), bytearray(4096)])
+    chunk.write(data)
+    chunk.close()
+    return chunk
+
+
+def part_size(partial):
+    return os.path.getsize(partial.part_path)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return UploadStore(str(tmp_path))
+
+
+def test_upload_resumes_after_a_restart(tmp_path, store):
+    partial = store.begin("big.bin", len(CONTENT), "application/octet-stream", DIGEST)
+    first = send_chunk(partial, CONTENT[:5000])
+    assert first.verified
+    store.commit(first)
+
+    restarted = UploadStore(str(tmp_path))
+    partial = restarted.get(partial.id)
+    assert partial.offset == 5000
+    assert partial.hasher is None  # rebuilt from the part file when needed
+    assert restarted.begin("big.bin", len(CONTENT), "application/octet-stream", DIGEST) is partial
+
+    rest = send_chunk(partial, CONTENT[5000:])
+    assert rest.verified
+    restarted.commit(rest)
+    blobs = BlobStore(str(tmp_path))
+    assert restarted.complete(partial, blobs) is True
+    assert blobs.assign("big.bin", DIGEST) == "big.bin"
+    blobs = BlobStore(str(tmp_path))
+    path, size = blobs.lookup("big.bin")
+    with open(path, "rb") as f:
+        assert f.read() == CONTENT
+    assert not os.path.exists(partial.part_path)
+    assert not os.path.exists(partial.meta_path)
+
+
+def test_chunk_with_a_bad_checksum_is_rolled_back(store):
+    partial = store.begin("a.bin", len(CONTENT), "application/octet-stream", DIGEST)
+    store.commit(send_chunk(partial, CONTENT[:4096]))
+    bad = send_chunk(partial, CONTENT[4096:8192], digest="0" * 64)
+    assert not bad.verified
+    assert part_size(partial) == 8192
+    partial.rollback()
+    assert partial.offset == 4096
+    assert part_size(partial) == 4096
+    # The running whole-file hash did not take the bad chunk in.
+    store.commit(send_chunk(partial, CONTENT[4096:]))
+    assert partial.file_hasher().hexdigest() == DIGEST
+
+
+def test_interrupted_chunk_is_cut_back_to_the_committed_offset(tmp_path, store):
+    partial = store.begin("a.bin", len(CONTENT), "application/octet-stream", DIGEST)
+    store.commit(send_chunk(partial, CONTENT[:4096]))
+    cut = send_chunk(partial, CONTENT[4096:6000], length=len(CONTENT) - 4096)
+    assert not cut.verified
+    assert part_size(partial) == 6000
+    partial.rollback()
+    assert part_size(partial) == 4096
+    # A restart also cuts back to what was committed.
+    send_chunk(partial, CONTENT[4096:6000], length=len(CONTENT) - 4096)
+    assert UploadStore(str(tmp_path)).get(partial.id).offset == part_size(partial) == 4096
+
+
+def test_file_that_does_not_match_its_digest_is_discarded(tmp_path, store):
+    partial = store.begin("a.bin", len(CONTENT), "application/octet-stream", "f" * 64)
+    store.commit(send_chunk(partial, CONTENT))
+    assert store.complete(partial, BlobStore(str(tmp_path))) is None
+    assert store.get(partial.id) is None
+    assert not os.path.exists(partial.part_path)
+
+
+def test_unknown_ids_are_not_looked_up_on_disk(store):
+    assert store.get("../../etc/passwd") is None
+
+
+# ---- BlobStore
+
+def stored(name, data, blobs):
+    src = blobs.temp_path()
+    with open(src, "wb") as f:
+        f.write(data)
+    return blobs.add(name, sha256(data), len(data), "text/plain", src=src)
+
+
+def blob_files(blobs):
+    return [f for d in os.listdir(blobs.dir) if len(d) == 2 for f in os.listdir(os.path.join(blobs.dir, d))]
+
+
+def test_same_content_is_stored_once(tmp_path):
+    blobs = BlobStore(str(tmp_path))
+    assert stored("a.txt", b"same", blobs) == ("a.txt", True)
+    assert stored("a.txt", b"same", blobs) == ("a.txt", False)
+    assert stored("b.txt", b"same", blobs) == ("b.txt", False)
+    assert blobs.names == {"a.txt": sha256(b"same"), "b.txt": sha256(b"same")}
+    assert blob_files(blobs) == [sha256(b"same")]
+    assert os.listdir(blobs.tmp_dir) == []
+
+
+def test_hash_first_upload_needs_an_existing_blob(tmp_path):
+    blobs = BlobStore(str(tmp_path))
+    with pytest.raises(KeyError):
+        blobs.add("a.txt", sha256(b"new"), 3, "text/plain")
+    stored("a.txt", b"new", blobs)
+    assert blobs.add("copy.txt", sha256(b"new"), 3, "text/plain") == ("copy.txt", False)
+
+
+def test_different_content_under_one_name_gets_a_new_name(tmp_path):
+    blobs = BlobStore(str(tmp_path))
+    stored("photo.jpg", b"one", blobs)
+    assert stored("photo.jpg", b"two", blobs) == ("photo (1).jpg", True)
+    (tmp_path / "notes.txt").write_bytes(b"saved before the blob store")
+    assert stored("notes.txt", b"three", blobs) == ("notes (1).txt", True)
+
+
+def test_index_is_reloaded(tmp_path):
+    blobs = BlobStore(str(tmp_path))
+    stored("a.txt", b"kept", blobs)
+    stored("b.txt", b"kept", blobs)
+    with open(os.path.join(blobs.tmp_dir, "leftover"), "wb") as f:
+        f.write(b"cut off by a restart")
+    again = BlobStore(str(tmp_path))
+    assert again.names == blobs.names
+    assert again.blobs == blobs.blobs
+    assert again.lookup("a.txt") == (blobs.blob_path(sha256(b"kept")), 4)
+    assert os.listdir(again.tmp_dir) == []
+
+
+def test_index_writes_wait_for_flush_with_on_change(tmp_path):
+    calls = []
+    blobs = BlobStore(str(tmp_path), on_change=lambda: calls.append(1))
+    stored("a.txt", b"later", blobs)
+    stored("b.txt", b"later", blobs)
+    assert calls and blobs.dirty
+    assert not os.path.exists(blobs.index_path)
+    blobs.flush()
+    assert not blobs.dirty
+    with open(blobs.index_path, encoding="utf-8") as f:
+        assert json.load(f)["names"] == blobs.names